@@ -6,6 +6,7 @@ and needs to be converted to a Class.
 
 import logging
 import pprint
+import threading
 import time
 from collections import OrderedDict
 from datetime import datetime, timedelta
@@ -19,18 +20,32 @@ from soco.plugins.sharelink import ShareLinkPlugin  # type: ignore
 from xmltodict import parse  # type: ignore
 
 from soco_cli import alarms
+from soco_cli.circuit_breaker import (
+    READ,
+    WRITE,
+    action_policy,
+    circuit_breaker,
+    is_connection_failure,
+)
 from soco_cli.play_local_file import play_local_file
 from soco_cli.play_local_file_lists import play_directory_files, play_m3u_file
+from soco_cli.read_cache import read_scope
+from soco_cli.soap_requests import request_scope
 from soco_cli.speaker_info import print_speaker_table
+from soco_cli.state_cache import state_cache
 from soco_cli.utils import (
+    ActionResult,
+    cancelled,
     convert_to_seconds,
     create_list_of_items_from_range,
+    current_context,
     error_report,
     event_unsubscribe,
     forget_event_sub,
     get_queue_insertion_position,
     get_right_hand_speaker,
     get_speaker,
+    interruptible_sleep,
     one_or_more_parameters,
     one_or_two_parameters,
     one_parameter,
@@ -45,6 +60,7 @@ from soco_cli.utils import (
     seconds_until,
     two_parameters,
     unsub_all_remembered_event_subs,
+    use_context,
     zero_one_or_two_parameters,
     zero_or_one_parameter,
     zero_parameters,
@@ -220,26 +236,68 @@ def on_off_action(speaker, action, args, soco_function, use_local_speaker_list):
         soco_function = "mute"
     np = len(args)
     if np == 0:
-        state = "on" if getattr(speaker, soco_function) else "off"
-        print(state)
+        state = bool(getattr(speaker, soco_function))
+        _record_state(speaker, soco_function, state)
+        return ActionResult(state, _print_on_off)
     elif np == 1:
         arg = args[0].lower()
         if arg == "on":
-            setattr(speaker, soco_function, True)
+            state = True
         elif arg == "off":
-            setattr(speaker, soco_function, False)
+            state = False
         else:
             parameter_type_error(action, "on|off")
             return False
+        if _elide_write(speaker, soco_function, state):
+            return ActionResult({"elided": True}, _print_nothing)
+        setattr(speaker, soco_function, state)
+        _record_state(speaker, soco_function, state)
     return True
 
 
+def _record_state(speaker, attribute, value):
+    """Record a value read from or written to a speaker, for write elision. For
+    a group, forget the state of its members instead."""
+    if isinstance(speaker, soco.SoCo):
+        state_cache().record(speaker.ip_address, attribute, value)
+    else:
+        for member in speaker.members:
+            state_cache().invalidate(member.ip_address)
+
+
+def _elide_write(speaker, attribute, value):
+    """Whether to skip setting a speaker attribute, because write elision is
+    enabled and the speaker is known to have the value already."""
+    if not current_context().elide_writes or not isinstance(speaker, soco.SoCo):
+        return False
+    state_cache().watch(speaker)
+    known, current = state_cache().get(speaker.ip_address, attribute)
+    if known and current == value:
+        logging.info(
+            "Speaker at {} already has {} = {}: skipping write".format(
+                speaker.ip_address, attribute, value
+            )
+        )
+        return True
+    return False
+
+
+def _print_nothing(data):
+    pass
+
+
 @zero_parameters
 def true_false_action(speaker, action, args, soco_function, use_local_speaker_list):
     """Method to deal with status actions that have 'true|false semantics"""
-    state = "yes" if getattr(speaker, soco_function) else "no"
-    print(state)
-    return True
+    return ActionResult(bool(getattr(speaker, soco_function)), _print_yes_no)
+
+
+def _print_on_off(state):
+    print("on" if state else "off")
+
+
+def _print_yes_no(state):
+    print("yes" if state else "no")
 
 
 @zero_parameters
@@ -252,10 +310,8 @@ def no_args_no_output(speaker, action, args, soco_function, use_local_speaker_li
 def no_args_one_output(speaker, action, args, soco_function, use_local_speaker_list):
     result = getattr(speaker, soco_function)
     if callable(result):
-        print(getattr(speaker, soco_function)())
-    else:
-        print(result)
-    return True
+        result = result()
+    return ActionResult(result)
 
 
 @zero_or_one_parameter
@@ -315,8 +371,9 @@ def volume_actions(speaker, action, args, soco_function, use_local_speaker_list)
 
     np = len(args)
     if np == 0:
-        print(speaker.volume)
-        return True
+        volume = speaker.volume
+        _record_state(speaker, "volume", volume)
+        return ActionResult(volume)
     if np == 1:
         try:
             vol = int(args[0])
@@ -328,9 +385,14 @@ def volume_actions(speaker, action, args, soco_function, use_local_speaker_list)
         if soco_function == "ramp_to_volume":
             logging.info("Ramping to volume {}".format(vol))
             print(speaker.ramp_to_volume(vol))
+            state_cache().invalidate(speaker.ip_address)
+            return True
         else:
+            if _elide_write(speaker, "volume", vol):
+                return ActionResult({"elided": True}, _print_nothing)
             logging.info("Setting volume to {}".format(vol))
             speaker.volume = vol
+        _record_state(speaker, "volume", vol)
         return True
 
 
@@ -365,8 +427,9 @@ def track(speaker, action, args, soco_function, use_local_speaker_list):
     state = speaker.get_current_transport_info()["current_transport_state"]
 
     if speaker.is_playing_line_in:
-        print("Using Line In (state: {})".format(state))
-        return True
+        return ActionResult(
+            {"state": state, "line_in": True, "details": OrderedDict()}, _print_track
+        )
 
     def title_not_useful(title):
         indicators = ["m3u", "stream", "sonos", "http", "=", "ZPSTR_"]
@@ -377,7 +440,6 @@ def track(speaker, action, args, soco_function, use_local_speaker_list):
 
     stream = False
 
-    print(" Playback is {}:".format(playback_state(state)))
     track_info = speaker.get_current_track_info()
     logging.info("Current track info:\n{}".format(track_info))
 
@@ -564,9 +626,18 @@ def track(speaker, action, args, soco_function, use_local_speaker_list):
     # Add any elements we've missed
     ordered_elements.update(elements)
 
-    logging.info("Items to be printed: {}".format(ordered_elements))
-    pretty_print_values(ordered_elements, indent=3, spacing=5, sort_by_key=False)
-    return True
+    logging.info("Track details: {}".format(ordered_elements))
+    return ActionResult(
+        {"state": state, "line_in": False, "details": ordered_elements}, _print_track
+    )
+
+
+def _print_track(track):
+    if track["line_in"]:
+        print("Using Line In (state: {})".format(track["state"]))
+        return
+    print(" Playback is {}:".format(playback_state(track["state"])))
+    pretty_print_values(track["details"], indent=3, spacing=5, sort_by_key=False)
 
 
 @zero_or_one_parameter
@@ -636,8 +707,7 @@ def repeat(speaker, action, args, soco_function, use_local_speaker_list):
 
 @zero_parameters
 def transport_state(speaker, action, args, soco_function, use_local_speaker_list):
-    print(speaker.get_current_transport_info()["current_transport_state"])
-    return True
+    return ActionResult(speaker.get_current_transport_info()["current_transport_state"])
 
 
 def play_favourite_core(speaker, favourite, favourite_number=None):
@@ -961,6 +1031,9 @@ def operate_on_all(speaker, action, args, soco_function, use_local_speaker_list)
     zones = speaker.all_zones
     for zone in zones:
         if zone.is_visible:
+            if circuit_breaker().is_open(zone.ip_address):
+                logging.info("Speaker at {} not responding".format(zone.ip_address))
+                continue
             try:
                 logging.info(
                     "Executing '{}' on speaker '{}'".format(
@@ -968,8 +1041,10 @@ def operate_on_all(speaker, action, args, soco_function, use_local_speaker_list)
                     )
                 )
                 getattr(zone, soco_function)()
-            except:
+            except Exception as e:
                 logging.info("Operation failed ... continuing")
+                if is_connection_failure(e):
+                    circuit_breaker().record_failure(zone.ip_address)
                 # Ignore errors here; don't want to halt on
                 # a failed pause (e.g., if speaker isn't playing)
                 continue
@@ -1603,6 +1678,11 @@ def wait_stop_core(speaker, not_paused=False):
         return False
 
     while True:
+        if cancelled():
+            logging.info("Cancelled while waiting for stop")
+            event_unsubscribe(sub)
+            forget_event_sub(sub)
+            return True
         try:
             event = sub.events.get(timeout=1.0)
             if event.variables["transport_state"] not in playing_states:
@@ -1637,6 +1717,8 @@ def wait_stopped_for_core(speaker, action, duration_arg, not_paused=False):
     logging.info("Waiting until playback stopped for {}s".format(duration))
 
     wait_stop_core(speaker, not_paused=not_paused)
+    if cancelled():
+        return True
 
     playing_states = ["PLAYING", "TRANSITIONING"]
     if not_paused:
@@ -1666,10 +1748,9 @@ def wait_stopped_for_core(speaker, action, duration_arg, not_paused=False):
                 int(remaining_time),
             )
         )
-        if remaining_time <= poll_interval:
-            time.sleep(remaining_time)
-        else:
-            time.sleep(poll_interval)
+        if not interruptible_sleep(min(remaining_time, poll_interval)):
+            logging.info("Cancelled while waiting")
+            return True
         current_time = time.time()
     logging.info(
         "Timer expired after 'STOPPED' for {}s | total elapsed = {}s".format(
@@ -1701,6 +1782,11 @@ def wait_start(speaker, action, args, soco_function, use_local_speaker_list):
         error_report("Exception {}".format(e))
         return False
     while True:
+        if cancelled():
+            logging.info("Cancelled while waiting for start")
+            event_unsubscribe(sub)
+            forget_event_sub(sub)
+            return True
         try:
             event = sub.events.get(timeout=1.0)
             if event.variables["transport_state"] == "PLAYING":
@@ -2479,6 +2565,11 @@ def wait_end_track(speaker, action, args, soco_function, use_local_speaker_list)
     initial_radio_show = None
 
     while True:
+        if cancelled():
+            logging.info("Cancelled while waiting for end of track")
+            event_unsubscribe(sub)
+            forget_event_sub(sub)
+            return True
         try:
             event = sub.events.get(timeout=1.0)
             logging.info("Transport event received")
@@ -2743,25 +2834,159 @@ def process_wait_action(speaker, action, args, soco_function, use_local_speaker_
     return True
 
 
-def process_action(speaker, action, args, use_local_speaker_list=False) -> bool:
-    sonos_function = actions.get(action, None)
+def process_action(
+    speaker,
+    action,
+    args,
+    use_local_speaker_list=False,
+    sonos_function=None,
+    context=None,
+) -> bool:
+    # The action's SonosFunction can be supplied if it's already been looked up
+    if sonos_function is None:
+        sonos_function = actions.get(action, None)
     if sonos_function:
-        if sonos_function.switch_to_coordinator:
-            if not speaker.is_coordinator:
-                speaker = speaker.group.coordinator
-                logging.info(
-                    "Switching to coordinator speaker '{}'".format(speaker.player_name)
+        # Use the supplied context, if any, for the duration of the action
+        with use_context(context):
+            if getattr(_dispatch, "active", False):
+                # Already inside the circuit breaker, e.g., for the action
+                # controlled by a conditional modifier
+                return _process_action(
+                    speaker, action, args, use_local_speaker_list, sonos_function
                 )
-        return sonos_function.processing_function(
-            speaker,
-            action,
-            args,
-            sonos_function.soco_function,
-            use_local_speaker_list,
-        )
+            kind = action_class(sonos_function, args)
+            if kind == WRITE:
+                _forget_state(speaker, sonos_function)
+            _dispatch.active = True
+            try:
+                with request_scope(), _read_scope(action, sonos_function):
+                    return circuit_breaker().call(
+                        speaker.ip_address,
+                        action_policy(kind),
+                        lambda: _process_action(
+                            speaker,
+                            action,
+                            args,
+                            use_local_speaker_list,
+                            sonos_function,
+                        ),
+                    )
+            finally:
+                _dispatch.active = False
     return False
 
 
+# Set while an action is being processed by the current thread
+_dispatch = threading.local()
+
+
+def _read_scope(action, sonos_function):
+    """Memoise the reads made by an action, except for the wait actions, which
+    poll the speaker."""
+    return read_scope(
+        action,
+        enabled=not sonos_function.processing_function.__name__.startswith("wait_"),
+    )
+
+
+def _forget_state(speaker, sonos_function):
+    """Forget the known state of the speaker before a write action, unless the
+    action maintains the state itself. Group actions can change the state of
+    any speaker."""
+    if sonos_function.processing_function.__name__ in STATE_FUNCTIONS:
+        return
+    if (sonos_function.soco_function or "").startswith("group_"):
+        state_cache().invalidate()
+    else:
+        state_cache().invalidate(speaker.ip_address)
+
+
+def _process_action(speaker, action, args, use_local_speaker_list, sonos_function):
+    if sonos_function.switch_to_coordinator:
+        if not speaker.is_coordinator:
+            speaker = speaker.group.coordinator
+            logging.info(
+                "Switching to coordinator speaker '{}'".format(speaker.player_name)
+            )
+    return sonos_function.processing_function(
+        speaker,
+        action,
+        args,
+        sonos_function.soco_function,
+        use_local_speaker_list,
+    )
+
+
+# Processing functions that only read from the speaker
+READ_FUNCTIONS = [
+    "album_art",
+    "audio_format",
+    "available_actions",
+    "battery",
+    "get_channel",
+    "get_uri",
+    "groups",
+    "groupstatus",
+    "info",
+    "is_indexing",
+    "last_search",
+    "list_albums",
+    "list_all_playlist_tracks",
+    "list_artists",
+    "list_libraries",
+    "list_library_playlist_tracks",
+    "list_numbered_things",
+    "list_playlist_tracks",
+    "list_queue",
+    "mic_enabled",
+    "no_args_one_output",
+    "queue_position",
+    "reboot_count",
+    "search_albums",
+    "search_artists",
+    "search_library",
+    "search_tracks",
+    "system_info",
+    "track",
+    "tracks_in_album",
+    "transport_state",
+    "true_false_action",
+    "zones",
+]
+
+# Processing functions that read from the speaker when called without
+# parameters, and write to it otherwise
+GETTER_SETTER_FUNCTIONS = [
+    "balance",
+    "buttons",
+    "eq",
+    "fixed_volume",
+    "on_off_action",
+    "playback_mode",
+    "repeat",
+    "shuffle",
+    "sleep_timer",
+    "sub_gain",
+    "surround_volume",
+    "trueplay",
+    "tv_audio_delay",
+    "volume_actions",
+]
+
+
+# Processing functions that maintain the speaker state used for write elision
+STATE_FUNCTIONS = ["on_off_action", "volume_actions"]
+
+
+def action_class(sonos_function, args) -> str:
+    """Classify an action as a read or a write, to select its timeout and
+    retry policy."""
+    name = sonos_function.processing_function.__name__
+    if name in READ_FUNCTIONS or (name in GETTER_SETTER_FUNCTIONS and len(args) == 0):
+        return READ
+    return WRITE
+
+
 class SonosFunction:
     """Maps actions into processing functions."""
 
@@ -2849,9 +3074,9 @@ def list_actions(
 # Actions and associated processing functions
 actions = {
     "mute": SonosFunction(on_off_action, "mute"),
-    "cross_fade": SonosFunction(on_off_action, "cross_fade"),
-    "crossfade": SonosFunction(on_off_action, "cross_fade"),
-    "fade": SonosFunction(on_off_action, "cross_fade"),
+    "cross_fade": SonosFunction(on_off_action, "cross_fade", True),
+    "crossfade": SonosFunction(on_off_action, "cross_fade", True),
+    "fade": SonosFunction(on_off_action, "cross_fade", True),
     "loudness": SonosFunction(on_off_action, "loudness"),
     "status_light": SonosFunction(on_off_action, "status_light"),
     "light": SonosFunction(on_off_action, "status_light"),
@@ -0,0 +1,562 @@
+"""The SoCo-CLI asyncio API.
+
+Provides 'async' versions of the functions in 'soco_cli.api', for use in
+asyncio programs.
+
+SoCo's network operations are blocking, so short operations are run on a
+shared pool of worker threads. The wait actions ('wait_start', 'wait_stop',
+'wait_end_track', etc.) are implemented natively: they wait on event
+subscriptions whose events are delivered to the event loop, and renew the
+subscriptions from the event loop, so a waiting command doesn't occupy a
+thread.
+
+The functions take an optional 'context' parameter, as for the functions in
+'soco_cli.api'.
+"""
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import StringIO
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from soco import SoCo  # type: ignore
+
+from soco_cli import api
+from soco_cli.action_processor import actions
+from soco_cli.planner import ActionStep, LoopStep, ParallelStep, Plan, Planner, WaitStep
+from soco_cli.sequence_processor import execute_plan, loop_finished
+from soco_cli.speaker_sets import is_speaker_set
+from soco_cli.utils import (
+    SoCoCLIContext,
+    api_mode,
+    capture_output,
+    check_parameter_count,
+    convert_to_seconds,
+    current_context,
+    seconds_until,
+    use_context,
+)
+
+# The maximum number of blocking operations to run at the same time
+AIO_MAX_WORKERS = 32
+
+# Renew event subscriptions when this fraction of their timeout has elapsed
+RENEWAL_FRACTION = 0.85
+
+PLAYING_STATES = ["PLAYING", "TRANSITIONING"]
+
+_executor = None  # type: Optional[ThreadPoolExecutor]
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=AIO_MAX_WORKERS)
+        return _executor
+
+
+def set_max_workers(max_workers: int) -> None:
+    """Set the maximum number of blocking operations to run at the same time.
+    Operations already running are unaffected."""
+    global AIO_MAX_WORKERS, _executor
+    if max_workers < 1:
+        raise ValueError("'max_workers' must be at least 1")
+    with _executor_lock:
+        AIO_MAX_WORKERS = max_workers
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+async def run_blocking(function: Callable, *args, **kwargs):
+    """Run a blocking function on the shared pool of worker threads, and
+    return its result."""
+    return await _run_blocking(function, *args, **kwargs)
+
+
+async def _run_blocking(function: Callable, *args, **kwargs):
+    """Run a blocking function on the worker threads, using the context of the
+    calling thread."""
+    return await _run_blocking_in(current_context(), function, *args, **kwargs)
+
+
+async def _run_blocking_in(
+    run_context: SoCoCLIContext, function: Callable, *args, **kwargs
+):
+    """Run a blocking function on the worker threads, using 'run_context'."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _get_executor(),
+        partial(_run_in_context, run_context, function, *args, **kwargs),
+    )
+
+
+def _run_in_context(calling_context, function: Callable, *args, **kwargs):
+    with use_context(calling_context):
+        return function(*args, **kwargs)
+
+
+async def run_command(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    *args: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None
+) -> Tuple[int, str, str]:
+    """Use SoCo-CLI to run a sonos command. The parameters and return value
+    are the same as for 'soco_cli.api.run_command()'.
+
+    The 'wait_for' and 'wait_until' actions are also supported. Cancelling the
+    task running a wait action ends the wait, and cancels any event
+    subscription.
+    """
+    action = action.lower()
+
+    if action in ["wait_for", "wait_until"]:
+        return await _wait_for_time(action, args)
+
+    if action not in _WAIT_ACTIONS or is_speaker_set(speaker_name):
+        # Speaker sets are run by 'api.run_command()'
+        return await _run_blocking(
+            api.run_command,
+            speaker_name,
+            action,
+            *args,
+            use_local_speaker_list=use_local_speaker_list,
+            context=context,
+        )
+
+    message = check_parameter_count(
+        actions[action].processing_function, action, list(args)
+    )
+    if message:
+        return 1, "", "Error: " + message
+
+    if isinstance(speaker_name, SoCo):
+        speaker = speaker_name  # type: Optional[SoCo]
+        error_msg = ""
+    else:
+        speaker, error_msg = await get_soco_object(
+            speaker_name,
+            use_local_speaker_list=use_local_speaker_list,
+            context=context,
+        )
+    if not speaker:
+        return 1, "", "Speaker '{}' not found: {}".format(speaker_name, error_msg)
+
+    try:
+        # Wait actions operate on the group coordinator
+        speaker = await _run_blocking(_coordinator, speaker)
+        return await _WAIT_ACTIONS[action](speaker, action, args)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.info("Exception: {}".format(e))
+        return 1, "", "Error: {}".format(e)
+
+
+async def run_command_structured(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    *args: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None
+) -> api.CommandResult:
+    """Use SoCo-CLI to run a sonos command, returning structured data. The
+    parameters and return value are the same as for
+    'soco_cli.api.run_command_structured()'. The wait actions return their
+    output string as the data."""
+    if not is_speaker_set(speaker_name) and (
+        action.lower() in _WAIT_ACTIONS or action.lower() in ["wait_for", "wait_until"]
+    ):
+        exit_code, output, error_msg = await run_command(
+            speaker_name,
+            action,
+            *args,
+            use_local_speaker_list=use_local_speaker_list,
+            context=context,
+        )
+        return api.CommandResult(exit_code, output, error_msg, output=output)
+    return await _run_blocking(
+        api.run_command_structured,
+        speaker_name,
+        action,
+        *args,
+        use_local_speaker_list=use_local_speaker_list,
+        context=context,
+    )
+
+
+async def get_soco_object(
+    speaker_name: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None,
+) -> Tuple[Union[SoCo, None], str]:
+    """Uses the full set of soco_cli strategies to find a speaker. The
+    parameters and return value are the same as for
+    'soco_cli.api.get_soco_object()'."""
+    return await _run_blocking(
+        api.get_soco_object,
+        speaker_name,
+        use_local_speaker_list=use_local_speaker_list,
+        context=context,
+    )
+
+
+async def rescan_speakers(
+    timeout: float = None, context: Optional[SoCoCLIContext] = None
+) -> None:
+    """Run full network scan to find speakers."""
+    await _run_blocking(api.rescan_speakers, timeout=timeout, context=context)
+
+
+async def rediscover_speakers(context: Optional[SoCoCLIContext] = None) -> None:
+    """Run normal SoCo discovery to discover speakers."""
+    await _run_blocking(api.rediscover_speakers, context=context)
+
+
+async def run_sequences(
+    sequences: List,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None,
+) -> Tuple[int, str]:
+    """Run a list of command sequences (as produced by 'CLIParser'), as for the
+    'sonos' command. Returns the cumulative exit code, and the output and
+    error messages combined.
+
+    Actions on a single speaker and the wait actions are run using
+    'run_command()', so waits don't occupy a worker thread; loops and
+    parallel blocks are run by the event loop. Actions on '_all_' speakers
+    and on speaker sets, and 'track_follow', are run on the worker threads.
+    """
+    context = context if context is not None else current_context()
+    output = StringIO()
+    planner = Planner(use_local_speaker_list=use_local_speaker_list)
+    plan = await _run_blocking_in(context, planner.plan, sequences)
+    if plan.errors:
+        for message in plan.errors:
+            print("Error:", message, file=output)
+        return len(plan.errors), output.getvalue()
+    exit_code = await _execute_plan(
+        plan, planner, use_local_speaker_list, context, output
+    )
+    return exit_code, output.getvalue()
+
+
+async def _execute_plan(
+    plan: Plan,
+    planner: Planner,
+    use_local_speaker_list: bool,
+    context: SoCoCLIContext,
+    output: StringIO,
+) -> int:
+    """The asyncio equivalent of 'sequence_processor.execute_plan()', writing
+    the output of each step to 'output'."""
+    cumulative_exit_code = 0
+    steps = plan.steps
+    index = 0
+    loop_pointer = -1
+    loop_state = {}  # type: Dict[int, Tuple]
+    while index < len(steps):
+        step = steps[index]
+        if isinstance(step, LoopStep):
+            if step.action == "loop_to_start":
+                loop_pointer = -1
+                index = 0
+            elif loop_finished(step, index, loop_state):
+                loop_pointer = index
+                index += 1
+            else:
+                index = loop_pointer + 1
+            continue
+        try:
+            cumulative_exit_code += await _execute_step(
+                step, planner, use_local_speaker_list, context, output
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Error:", str(e), file=output)
+            cumulative_exit_code += 1
+        index += 1
+    return cumulative_exit_code
+
+
+async def _execute_step(
+    step,
+    planner: Planner,
+    use_local_speaker_list: bool,
+    context: SoCoCLIContext,
+    output: StringIO,
+) -> int:
+    if isinstance(step, WaitStep):
+        # 'wait' is a synonym for 'wait_for'
+        action = "wait_for" if step.sequence[0] == "wait" else step.sequence[0]
+        exit_code, _, error_msg = await _wait_for_time(action, step.sequence[1:])
+        if error_msg:
+            print(error_msg, file=output)
+        return exit_code
+
+    if isinstance(step, ParallelStep):
+        return await _execute_parallel_block(
+            step, planner, use_local_speaker_list, context, output
+        )
+
+    if isinstance(step, ActionStep) and step.all_speakers is None:
+        speaker = step.speaker or await _run_blocking_in(
+            context, planner.resolve_speaker, step.speaker_name
+        )
+        if not speaker:
+            print(
+                "Error: Speaker '{}' not found".format(step.speaker_name), file=output
+            )
+            return 1
+        step.speaker = speaker
+        exit_code, output_msg, error_msg = await run_command(
+            speaker,
+            step.action,
+            *step.args,
+            use_local_speaker_list=use_local_speaker_list,
+            context=context,
+        )
+        if exit_code == 0 and output_msg:
+            print(output_msg, file=output)
+        elif error_msg:
+            print(error_msg, file=output)
+        return exit_code
+
+    # Other steps are run by the 'sonos' command's sequence processor
+    single_step = Plan()
+    single_step.steps.append(step)
+    return await _run_blocking_in(
+        context,
+        _execute_captured,
+        single_step,
+        planner,
+        use_local_speaker_list,
+        output,
+    )
+
+
+def _execute_captured(
+    plan: Plan, planner: Planner, use_local_speaker_list: bool, output: StringIO
+) -> int:
+    with capture_output(output, output), api_mode():
+        return execute_plan(
+            plan, planner, use_local_speaker_list=use_local_speaker_list
+        )
+
+
+async def _execute_parallel_block(
+    step: ParallelStep,
+    planner: Planner,
+    use_local_speaker_list: bool,
+    context: SoCoCLIContext,
+    output: StringIO,
+) -> int:
+    """Run the branches of a parallel block concurrently, then write the output
+    of each branch in branch order, with each line labelled with the branch
+    number."""
+    branch_outputs = [StringIO() for _ in step.branches]
+    exit_codes = await asyncio.gather(*[
+        _execute_plan(branch, planner, use_local_speaker_list, context, branch_output)
+        for branch, branch_output in zip(step.branches, branch_outputs)
+    ])
+    for number, branch_output in enumerate(branch_outputs, start=1):
+        for line in branch_output.getvalue().splitlines():
+            print("[{}] {}".format(number, line), file=output)
+    return sum(exit_codes)
+
+
+def _coordinator(speaker: SoCo) -> SoCo:
+    if speaker.is_coordinator:
+        return speaker
+    return speaker.group.coordinator
+
+
+class _LoopQueue:
+    """Passes events from SoCo's event listener thread to an asyncio queue.
+
+    SoCo puts received events on a subscription's queue by calling 'put()'.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.queue = asyncio.Queue()  # type: asyncio.Queue
+
+    def put(self, event, *args, **kwargs) -> None:
+        self._loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+
+class _TransportEvents:
+    """An AVTransport event subscription, used as an async context manager.
+    The subscription is renewed from the event loop until it's exited."""
+
+    def __init__(self, speaker: SoCo):
+        self._speaker = speaker
+        self._subscription = None
+        self._renewal = None  # type: Optional[asyncio.Future]
+        self._events = None  # type: Optional[_LoopQueue]
+        self.last_event = None
+
+    async def __aenter__(self):
+        self._events = _LoopQueue(asyncio.get_event_loop())
+        self._subscription = await _run_blocking(
+            self._speaker.avTransport.subscribe, event_queue=self._events
+        )
+        logging.info(
+            "Subscribed to transport events from {}".format(self._speaker.ip_address)
+        )
+        self._renewal = asyncio.ensure_future(self._renew())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._renewal.cancel()
+        logging.info("Unsubscribing '{}'".format(self._subscription))
+        try:
+            await _run_blocking(self._subscription.unsubscribe)
+        except Exception as e:
+            logging.info("Failed to unsubscribe: {}".format(e))
+        return False
+
+    async def _renew(self) -> None:
+        while True:
+            timeout = self._subscription.timeout
+            await asyncio.sleep(
+                timeout * RENEWAL_FRACTION if timeout else 3600 * RENEWAL_FRACTION
+            )
+            try:
+                await _run_blocking(self._subscription.renew)
+            except Exception as e:
+                logging.info("Failed to renew subscription: {}".format(e))
+
+    async def next_state(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Return the transport state from the next event, or None if there's
+        no event within 'timeout' seconds. Events without a transport state are
+        skipped."""
+        loop = asyncio.get_event_loop()
+        end_time = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if end_time is None else max(0, end_time - loop.time())
+            try:
+                event = await asyncio.wait_for(self._events.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            state = event.variables.get("transport_state")
+            if state is not None:
+                self.last_event = event
+                return state
+
+
+async def _wait_start(speaker: SoCo, action: str, args) -> Tuple[int, str, str]:
+    async with _TransportEvents(speaker) as events:
+        while await events.next_state() != "PLAYING":
+            pass
+    return 0, "", ""
+
+
+def _playing_states(action: str) -> list:
+    if action in [
+        "wait_stop_not_pause",
+        "wsnp",
+        "wait_stopped_for_not_pause",
+        "wsfnp",
+    ]:
+        # Also treat 'paused' as a playing state
+        return PLAYING_STATES + ["PAUSED_PLAYBACK"]
+    return PLAYING_STATES
+
+
+async def _wait_stop(speaker: SoCo, action: str, args) -> Tuple[int, str, str]:
+    playing_states = _playing_states(action)
+    async with _TransportEvents(speaker) as events:
+        while await events.next_state() in playing_states:
+            pass
+    return 0, "", ""
+
+
+async def _wait_stopped_for(speaker: SoCo, action: str, args) -> Tuple[int, str, str]:
+    try:
+        duration = convert_to_seconds(args[0])
+    except ValueError:
+        return (
+            1,
+            "",
+            "Error: Action '{}' requires parameter of type 'Time h/m/s or"
+            " HH:MM:SS'".format(action),
+        )
+    playing_states = _playing_states(action)
+    loop = asyncio.get_event_loop()
+    async with _TransportEvents(speaker) as events:
+        # Wait for playback to stop, then for it to stay stopped for the
+        # duration; restart the timer if playback restarts
+        while True:
+            while await events.next_state() in playing_states:
+                pass
+            logging.info("Stopped: waiting for {}s".format(duration))
+            end_time = loop.time() + duration
+            while True:
+                remaining = end_time - loop.time()
+                if remaining <= 0:
+                    return 0, "", ""
+                state = await events.next_state(timeout=remaining)
+                if state in playing_states:
+                    logging.info("Restarting the timer")
+                    break
+
+
+async def _wait_end_track(speaker: SoCo, action: str, args) -> Tuple[int, str, str]:
+    async with _TransportEvents(speaker) as events:
+        initial = None
+        while True:
+            state = await events.next_state()
+            if state not in PLAYING_STATES:
+                logging.info("Speaker is not playing")
+                return 0, "", ""
+            track_info = await _run_blocking(speaker.get_current_track_info)
+            try:
+                radio_show = events.last_event.variables[
+                    "current_track_meta_data"
+                ].radio_show
+            except Exception:
+                radio_show = None
+            current = (track_info.get("title"), track_info.get("duration"), radio_show)
+            logging.info("Current title, duration, radio show = {}".format(current))
+            if initial is None:
+                initial = current
+            elif current != initial:
+                logging.info("Track/show has changed")
+                return 0, "", ""
+
+
+async def _wait_for_time(action: str, args) -> Tuple[int, str, str]:
+    if len(args) != 1:
+        return 1, "", "Error: Action '{}' requires 1 parameter".format(action)
+    try:
+        if action == "wait_for":
+            duration = convert_to_seconds(args[0])
+        else:
+            duration = seconds_until(args[0])
+    except ValueError:
+        return 1, "", "Error: Invalid parameter for '{}': {}".format(action, args[0])
+    logging.info("Waiting for {}s".format(duration))
+    await asyncio.sleep(duration)
+    return 0, "", ""
+
+
+_WAIT_ACTIONS = {
+    "wait_start": _wait_start,
+    "wait_stop": _wait_stop,
+    "wait_stop_not_pause": _wait_stop,
+    "wsnp": _wait_stop,
+    "wait_stopped_for": _wait_stopped_for,
+    "wsf": _wait_stopped_for,
+    "wait_stopped_for_not_pause": _wait_stopped_for,
+    "wsfnp": _wait_stopped_for,
+    "wait_end_track": _wait_end_track,
+}
@@ -1,7 +1,6 @@
 """Processing module for alarm actions."""
 
 import logging
-import time
 from copy import copy
 from datetime import datetime
 
@@ -12,6 +11,7 @@ from soco.alarms import Alarm, get_alarms
 from soco.core import SoCo
 from soco.exceptions import SoCoUPnPException  # type: ignore
 
+from soco_cli.limiter import ALARMS, limiter
 from soco_cli.utils import (
     convert_true_false,
     error_report,
@@ -21,8 +21,12 @@ from soco_cli.utils import (
     zero_parameters,
 )
 
-# Stabilisation delay (in seconds) when operating on multiple alarms
-ALARM_OPERATION_DELAY = 1.0
+
+def _alarm_update(speaker):
+    """Make an alarm update. Alarms are shared by the speakers in a household,
+    so updates are made one at a time for each household, and paced by the
+    alarms limiter to allow the speakers to stabilise."""
+    return limiter(ALARMS).slot(speaker.household_id)
 
 
 @zero_parameters
@@ -96,7 +100,8 @@ def remove_alarms(speaker, action, args, soco_function, use_local_speaker_list):
     if args[0].lower() == "all":
         for alarm in alarms:
             logging.info("Removing alarm ID '{}'".format(alarm.alarm_id))
-            alarm.remove()
+            with _alarm_update(speaker):
+                alarm.remove()
         return True
 
     alarm_ids_to_delete = args[0].split(",")
@@ -109,17 +114,11 @@ def remove_alarms(speaker, action, args, soco_function, use_local_speaker_list):
     valid_alarm_ids_to_delete = alarm_ids.intersection(alarm_ids_to_delete)
     logging.info("Valid alarm ID(s) to delete: {}".format(valid_alarm_ids_to_delete))
 
-    deleted_counter = 0
     for alarm in alarms:
         if alarm.alarm_id in valid_alarm_ids_to_delete:
             logging.info("Deleting alarm ID: {}".format(alarm.alarm_id))
-            alarm.remove()
-            deleted_counter += 1
-            if deleted_counter < len(valid_alarm_ids_to_delete):
-                logging.info(
-                    "Waiting for {}s for stabilisation".format(ALARM_OPERATION_DELAY)
-                )
-                time.sleep(ALARM_OPERATION_DELAY)
+            with _alarm_update(speaker):
+                alarm.remove()
 
     alarms_invalid = alarm_ids_to_delete.difference(valid_alarm_ids_to_delete)
     if len(alarms_invalid) != 0:
@@ -135,7 +134,8 @@ def add_alarm(speaker, action, args, soco_function, use_local_speaker_list):
         return False
 
     try:
-        new_alarm.save()
+        with _alarm_update(speaker):
+            new_alarm.save()
     except SoCoUPnPException as e:
         error_report("Failed to create alarm: {}".format(e))
         return False
@@ -159,20 +159,13 @@ def modify_alarm(speaker, action, args, soco_function, use_local_speaker_list):
             else:
                 print("Alarm ID '{}' not found".format(alarm_id))
 
-    for index, alarm in enumerate(alarms):
+    for alarm in alarms:
         if not _modify_alarm_object(speaker, alarm, args[1]):
             continue
         try:
             logging.info("Saving alarm '{}'".format(alarm.alarm_id))
-            alarm.save()
-            if index < len(alarms) - 1:
-                # Allow alarm update to stabilise
-                logging.info(
-                    "Waiting {}s after saving alarm '{}'".format(
-                        ALARM_OPERATION_DELAY, alarm.alarm_id
-                    )
-                )
-                time.sleep(ALARM_OPERATION_DELAY)
+            with _alarm_update(speaker):
+                alarm.save()
         except SoCoUPnPException as e:
             error_report("Failed to modify alarm {}: {}".format(alarm.alarm_id, e))
             continue
@@ -209,7 +202,8 @@ def move_or_copy_alarm(speaker, alarm_id, copy=True):
     if copy is True:
         alarm._alarm_id = None
     try:
-        alarm.save()
+        with _alarm_update(speaker):
+            alarm.save()
     except SoCoUPnPException as e:
         error_report("Failed to copy/move alarm: {}".format(e))
         return False
@@ -251,21 +245,14 @@ def set_alarms(speaker, alarm_ids, enabled=True):
                 alarm.enabled = enabled
                 logging.info("Saving alarm '{}'".format(alarm.alarm_id))
                 try:
-                    alarm.save()
+                    with _alarm_update(speaker):
+                        alarm.save()
                 except SoCoUPnPException as e:
                     error_report(
                         "Failed to change state of alarm {}: {}".format(
                             alarm.alarm_id, e
                         )
                     )
-                if len(alarm_ids) != 0 or all_alarms:
-                    # Stabilisation delay
-                    logging.info(
-                        "Waiting {}s after saving alarm '{}'".format(
-                            ALARM_OPERATION_DELAY, alarm.alarm_id
-                        )
-                    )
-                    time.sleep(ALARM_OPERATION_DELAY)
             alarm_ids.discard(alarm.alarm_id)
 
     if len(alarm_ids) != 0:
@@ -357,7 +344,8 @@ def copy_modify_alarm(speaker, action, args, soco_function, use_local_speaker_li
 
     # Save the new alarm
     try:
-        new_alarm.save()
+        with _alarm_update(speaker):
+            new_alarm.save()
     except SoCoUPnPException as e:
         error_report(
             "Failed to copy/move alarm; did you remember to modify the start time?: {}"
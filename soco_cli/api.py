@@ -5,23 +5,40 @@ to be used in other programs.
 """
 
 import logging
-import sys
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from signal import SIGINT, signal
-from typing import Tuple, Union
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 from soco import SoCo  # type: ignore
 
-from soco_cli.action_processor import process_action
-from soco_cli.speakers import Speakers
+from soco_cli.action_processor import SonosFunction, process_action
+from soco_cli.circuit_breaker import (  # noqa: F401
+    READ,
+    WRITE,
+    DeviceUnavailableError,
+    circuit_breaker,
+    set_action_policy,
+)
+from soco_cli.keyed_executor import KeyedExecutor
+from soco_cli.limiter import ALARMS, COORDINATOR, DEVICE, set_limits  # noqa: F401
+from soco_cli.speaker_sets import is_speaker_set, speaker_set_members
 from soco_cli.utils import (
+    ActionResult,
+    SoCoCLIContext,
+    SpeakerCache,
+    api_mode,
+    capture_output,
     configure_logging,
-    create_speaker_cache,
+    current_context,
     get_speaker,
-    set_api,
-    set_speaker_list,
+    set_cancel_event,
     sig_handler,
-    speaker_cache,
+    use_context,
 )
 
 
@@ -29,7 +46,9 @@ def run_command(
     speaker_name: Union[str, SoCo],
     action: str,
     *args: str,  # Means that all args are strings
-    use_local_speaker_list: bool = False
+    use_local_speaker_list: bool = False,
+    sonos_function: Optional[SonosFunction] = None,
+    context: Optional[SoCoCLIContext] = None
 ) -> Tuple[int, str, str]:
     """Use SoCo-CLI to run a sonos command.
 
@@ -42,25 +61,120 @@ def run_command(
 
     Args:
         speaker_name (str or SoCo): The name of the speaker, or its IP address.
-            Alternatively, a 'SoCo' object can be supplied.
+            Alternatively, a 'SoCo' object can be supplied. A speaker set
+            name (e.g., '@downstairs') runs the action on each speaker in the
+            set concurrently.
         action (str): The The name of the SoCo-CLI action to perform.
         *args (list[str]): The set of arguments that accompany the action.
         use_local_speaker_list (bool, optional): Whether to use the local
             speaker cache.
+        sonos_function (SonosFunction, optional): The action's processing
+            function, if it has already been looked up (e.g., by the planner).
+        context (SoCoCLIContext, optional): The context to use, if not the
+            current context.
 
     Returns:
         (int, str, str): a three-tuple of exit_code, output_string and
         error_msg.
     """
+    with use_context(context):
+        result = _run_command(
+            speaker_name, action, args, use_local_speaker_list, sonos_function, True
+        )
+    return_tuple = (result.exit_code, result.output, result.error_msg)
+    logging.info("Return value: {}".format(return_tuple))
+    return return_tuple
 
-    # Prevent errors from causing exit
-    set_api()
 
-    # Capture stdout and stderr for the duration of this command
-    output = StringIO()
-    sys.stdout = output
-    error = StringIO()
-    sys.stderr = error
+class CommandResult:
+    """The result of a command run by 'run_command_structured()'.
+
+    Attributes:
+        exit_code (int): The exit code of the command.
+        data: The structured data returned by the action (e.g., a dict, a
+            str or an int), or the output string if the action doesn't
+            return structured data.
+        error_msg (str): The error message, if the exit code is non-zero.
+    """
+
+    def __init__(
+        self,
+        exit_code: int,
+        data: Any,
+        error_msg: str,
+        output: Optional[str] = None,
+        action_result: Optional[ActionResult] = None,
+    ):
+        self.exit_code = exit_code
+        self.data = data
+        self.error_msg = error_msg
+        self._output = output
+        self._action_result = action_result
+
+    @property
+    def output(self) -> str:
+        """The output string, as it would be printed by the 'sonos' command."""
+        if self._output is None:
+            # Render the structured data on first use
+            output = StringIO()
+            with capture_output(output, StringIO()):
+                self._action_result.render()
+            self._output = _format_output(output.getvalue())
+        return self._output
+
+    def __repr__(self) -> str:
+        return "CommandResult(exit_code={}, data={!r}, error_msg={!r})".format(
+            self.exit_code, self.data, self.error_msg
+        )
+
+
+def run_command_structured(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    *args: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None
+) -> CommandResult:
+    """Use SoCo-CLI to run a sonos command, returning structured data.
+
+    The parameters are the same as for 'run_command()'. Actions that return
+    structured data (e.g., 'track', 'state', 'volume') return it without
+    rendering it as text; other actions return their output string as the
+    data. For a speaker set, the data is a dict of speaker name -> data.
+
+    Returns:
+        CommandResult: The exit code, data and error message. The text output
+        is available as the 'output' attribute.
+    """
+    with use_context(context):
+        result = _run_command(speaker_name, action, args, use_local_speaker_list)
+    logging.info("Return value: {}".format(result))
+    return result
+
+
+def _run_command(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    args: Sequence[str],
+    use_local_speaker_list: bool = False,
+    sonos_function: Optional[SonosFunction] = None,
+    render: bool = False,
+    output: Optional[Any] = None,
+    error: Optional[Any] = None,
+) -> CommandResult:
+    if is_speaker_set(speaker_name):
+        return _run_on_speaker_set(
+            speaker_name, action, args, use_local_speaker_list, sonos_function, render
+        )
+
+    # Capture stdout and stderr for the duration of this command, and prevent
+    # errors from causing exit. Both are per-thread, so run_command() can be
+    # called from multiple threads at once. The caller can supply the streams,
+    # e.g., to stream the output as it's printed.
+    if output is None:
+        output = StringIO()
+    if error is None:
+        error = StringIO()
 
     speaker = None
     exception_error = None
@@ -71,60 +185,390 @@ def run_command(
 
     elif isinstance(speaker_name, str):
         try:
-            speaker = _get_soco_object(
-                speaker_name, use_local_speaker_list=use_local_speaker_list
-            )
+            with capture_output(output, error), api_mode():
+                speaker = _get_soco_object(
+                    speaker_name, use_local_speaker_list=use_local_speaker_list
+                )
         except Exception as e:
             logging.info("Exception: {}".format(e))
             exception_error = e
 
-    if speaker:
-        action_return = False
-        try:
+    if not speaker:
+        return CommandResult(
+            1,
+            "",
+            "Speaker '{}' not found: {}".format(speaker_name, exception_error),
+            output="",
+        )
+
+    action_return = False
+    try:
+        with capture_output(output, error), api_mode():
             action_return = process_action(
-                speaker, action, args, use_local_speaker_list=use_local_speaker_list
+                speaker,
+                action,
+                args,
+                use_local_speaker_list=use_local_speaker_list,
+                sonos_function=sonos_function,
             )
+            if render and isinstance(action_return, ActionResult):
+                action_return.render()
+    except Exception as e:
+        logging.info("Exception: {}".format(e))
+        exception_error = e
+
+    output_msg = _format_output(output.getvalue())
+    error_out = error.getvalue().rstrip()
+
+    if exception_error:
+        if error_out:
+            error_out = error_out + "\nError: " + str(exception_error)
+        else:
+            error_out = "Error: " + str(exception_error)
+
+    # An exception can also be raised while rendering an action's result
+    if action_return is False or exception_error:
+        if error_out == "":
+            hint = " ... missing spaces around ':'?" if ":" in action else ""
+            error_out = "Error: Action '{}' not recognised{}".format(action, hint)
+        return CommandResult(1, output_msg, error_out, output=output_msg)
+
+    if isinstance(action_return, ActionResult):
+        if not render:
+            return CommandResult(
+                0, action_return.data, error_out, action_result=action_return
+            )
+        return CommandResult(0, action_return.data, error_out, output=output_msg)
+    return CommandResult(0, output_msg, error_out, output=output_msg)
+
+
+# The actions that follow a speaker's track changes
+TRACK_FOLLOW_ACTIONS = ["track_follow", "tf", "track_follow_compact", "tfc"]
+
+
+def stream_command(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    *args: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None,
+    max_buffered: int = 1000
+) -> Iterator[Tuple[str, Any]]:
+    """Use SoCo-CLI to run a sonos command, yielding its output as it's
+    printed, instead of when the command finishes.
+
+    The parameters are the same as for 'run_command()'. The 'track_follow'
+    actions are also supported. The command runs in a separate thread; if the
+    consumer stops iterating (e.g., by closing the generator), the command is
+    cancelled where the action supports it (e.g., 'track_follow').
+
+    At most 'max_buffered' chunks of output are held while waiting for the
+    consumer; the command waits while the buffer is full.
+
+    Yields:
+        (str, Any): Events of the form ("output", text) and ("error", text)
+        as the command prints them, followed by ("result", CommandResult) when
+        the command finishes. The result's 'output' is empty, and its 'data'
+        holds the structured data returned by the action, if any.
+    """
+    if context is None:
+        context = current_context()
+    events = queue.Queue(maxsize=max_buffered)  # type: queue.Queue
+    cancel_event = threading.Event()
+    output = _StreamWriter(events, "output", cancel_event)
+    error = _StreamWriter(events, "error", cancel_event, keep=True)
+
+    def run():
+        set_cancel_event(cancel_event)
+        try:
+            with use_context(context):
+                if action.lower() in TRACK_FOLLOW_ACTIONS:
+                    result = _stream_track_follow(
+                        speaker_name, action.lower(), use_local_speaker_list, output
+                    )
+                else:
+                    result = _run_command(
+                        speaker_name,
+                        action,
+                        args,
+                        use_local_speaker_list,
+                        render=True,
+                        output=output,
+                        error=error,
+                    )
         except Exception as e:
-            logging.info("Exception: {}".format(e))
-            exception_error = e
+            result = CommandResult(1, "", "Error: {}".format(e), output="")
+        output.flush()
+        error.flush()
+        output.put(("result", result))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            yield event
+            if event[0] == "result":
+                return
+    finally:
+        cancel_event.set()
+
+
+def _stream_track_follow(
+    speaker_name: Union[str, SoCo],
+    action: str,
+    use_local_speaker_list: bool,
+    output: "_StreamWriter",
+) -> CommandResult:
+    # Imported here, because 'track_follow' uses this module
+    from soco_cli.track_follow import track_follow
 
-        output_msg = output.getvalue().rstrip()
-        error_out = error.getvalue().rstrip()
-
-        if output_msg != "":
-            lines = output_msg.splitlines()
-            if len(lines) > 1 and lines[0] != "":
-                output_msg = "\n" + output_msg
-            if len(lines) > 1 and output_msg[len(lines) - 1] != "":
-                output_msg = output_msg + "\n"
-
-        if exception_error:
-            if error_out:
-                error_out = error_out + "\nError: " + str(exception_error)
-            else:
-                error_out = "Error: " + str(exception_error)
-
-        if action_return is False:
-            if error_out == "":
-                hint = " ... missing spaces around ':'?" if ":" in action else ""
-                error_out = "Error: Action '{}' not recognised{}".format(action, hint)
-            return_tuple = (1, output_msg, error_out)
-        else:
-            return_tuple = (0, output_msg, error_out)
+    if isinstance(speaker_name, SoCo):
+        speaker, error_msg = speaker_name, ""  # type: Tuple[Any, str]
     else:
-        return_tuple = (
+        speaker, error_msg = get_soco_object(
+            speaker_name, use_local_speaker_list=use_local_speaker_list
+        )
+    if not speaker:
+        return CommandResult(
             1,
             "",
-            "Speaker '{}' not found: {}".format(speaker_name, exception_error),
+            "Speaker '{}' not found: {}".format(speaker_name, error_msg),
+            output="",
+        )
+    with capture_output(output, output), api_mode():
+        track_follow(
+            speaker,
+            use_local_speaker_list=use_local_speaker_list,
+            break_on_pause=False,
+            compact=action in ["track_follow_compact", "tfc"],
         )
+    return CommandResult(0, "", "", output="")
 
-    # Restore stdout and stderr
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
 
-    logging.info("Return value: {}".format(return_tuple))
+class _StreamWriter:
+    """A file-like object that passes the text written to it to a queue, a
+    line at a time (or when flushed), as events of the form (kind, text).
 
-    return return_tuple
+    The text written is dropped once 'closed' is set, so that a command whose
+    output is no longer being consumed doesn't block forever.
+    """
+
+    # Prevents 'release_output()' from releasing the streamed output
+    streaming = True
+
+    def __init__(
+        self,
+        events: queue.Queue,
+        kind: str,
+        closed: threading.Event,
+        keep: bool = False,
+    ):
+        self._events = events
+        self._kind = kind
+        self._closed = closed
+        self._kept = StringIO() if keep else None
+        self._line = ""
+
+    def write(self, text: str) -> int:
+        if self._kept is not None:
+            self._kept.write(text)
+        self._line += text
+        end = self._line.rfind("\n") + 1
+        if end > 0:
+            self.put((self._kind, self._line[:end]))
+            self._line = self._line[end:]
+        return len(text)
+
+    def put(self, event: Tuple[str, Any]) -> None:
+        while not self._closed.is_set():
+            try:
+                self._events.put(event, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def flush(self) -> None:
+        if self._line:
+            self.put((self._kind, self._line))
+            self._line = ""
+
+    def getvalue(self) -> str:
+        """Return the text written, if it's being kept."""
+        return self._kept.getvalue() if self._kept is not None else ""
+
+
+def _run_on_speaker_set(
+    set_name: str,
+    action: str,
+    args: Sequence[str],
+    use_local_speaker_list: bool,
+    sonos_function: Optional[SonosFunction],
+    render: bool,
+) -> CommandResult:
+    """Run a command on each speaker in a set, concurrently. The output and
+    errors are labelled with speaker names, in speaker name order; the exit
+    code is 1 if the command failed on any speaker."""
+    try:
+        members = speaker_set_members(set_name)
+    except ValueError as e:
+        return CommandResult(1, "", "Error: {}".format(e), output="")
+    context = current_context()
+
+    def run(member):
+        with use_context(context):
+            return member, _run_command(
+                member, action, args, use_local_speaker_list, sonos_function, render
+            )
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(members), 8))) as executor:
+        results = sorted(executor.map(run, members), key=lambda r: r[0].lower())
+
+    data = OrderedDict()  # type: OrderedDict
+    output_lines = []
+    error_lines = []
+    for name, result in results:
+        if result.exit_code == 0:
+            data[name] = result.data
+            output_lines.append("{}: {}".format(name, result.output.strip() or "OK"))
+        else:
+            error_lines.append("{}: {}".format(name, result.error_msg))
+    exit_code = 1 if error_lines else 0
+    output_msg = "\n".join(output_lines) if exit_code == 0 else ""
+    return CommandResult(
+        exit_code,
+        data if not render else output_msg,
+        "\n".join(error_lines),
+        output=output_msg,
+    )
+
+
+def _format_output(output_msg: str) -> str:
+    output_msg = output_msg.rstrip()
+    if output_msg != "":
+        lines = output_msg.splitlines()
+        if len(lines) > 1 and lines[0] != "":
+            output_msg = "\n" + output_msg
+        if len(lines) > 1 and output_msg[len(lines) - 1] != "":
+            output_msg = output_msg + "\n"
+    return output_msg
+
+
+def run_commands(
+    commands: Sequence[Sequence[Union[str, SoCo]]],
+    max_parallel: int = 8,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None,
+) -> List[Tuple[int, str, str, float]]:
+    """Use SoCo-CLI to run a batch of sonos commands.
+
+    Each command is a sequence of the form (speaker_name, action, *args), taking
+    the same values as the parameters of run_command().
+
+    Commands for the same speaker, or for speakers in the same group, are run
+    one at a time in the order supplied. Commands for different speakers and
+    groups are run concurrently.
+
+    Args:
+        commands (list): The commands to run.
+        max_parallel (int, optional): The maximum number of commands to run
+            at the same time.
+        use_local_speaker_list (bool, optional): Whether to use the local
+            speaker cache.
+        context (SoCoCLIContext, optional): The context to use, if not the
+            current context.
+
+    Returns:
+        list[(int, str, str, float)]: A four-tuple for each command, in the
+        same order as the commands, consisting of exit_code, output_string,
+        error_msg and the time taken in seconds.
+    """
+    if context is None:
+        context = current_context()
+    commands = [list(command) for command in commands]
+    for command in commands:
+        if len(command) < 2:
+            raise ValueError(
+                "Commands require a speaker and an action: '{}'".format(command)
+            )
+
+    # Resolve each distinct speaker once, and find its group coordinator
+    targets = {}  # type: Dict[str, Union[str, SoCo]]
+    for command in commands:
+        targets.setdefault(_target_id(command[0]), command[0])
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(targets), max_parallel))
+    ) as executor:
+        resolved = dict(
+            zip(
+                targets.keys(),
+                executor.map(
+                    lambda target: _resolve_speaker(
+                        target, use_local_speaker_list, context
+                    ),
+                    targets.values(),
+                ),
+            )
+        )  # type: Dict[str, Tuple[Union[str, SoCo], str]]
+
+    def run(speaker, action, args):
+        start_time = time.time()
+        result = run_command(
+            speaker,
+            action,
+            *args,
+            use_local_speaker_list=use_local_speaker_list,
+            context=context,
+        )
+        return result + (round(time.time() - start_time, 4),)
+
+    with KeyedExecutor(max_workers=max_parallel) as executor:
+        futures = []
+        for command in commands:
+            speaker, key = resolved[_target_id(command[0])]
+            futures.append(
+                executor.submit(
+                    key, run, speaker, str(command[1]), [str(a) for a in command[2:]]
+                )
+            )
+        return [future.result() for future in futures]
+
+
+def _target_id(speaker: Union[str, SoCo]) -> str:
+    if isinstance(speaker, SoCo):
+        return "soco:" + speaker.ip_address
+    return "name:" + str(speaker).lower()
+
+
+def _resolve_speaker(
+    speaker: Union[str, SoCo], use_local_speaker_list: bool, context: SoCoCLIContext
+) -> Tuple[Union[str, SoCo], str]:
+    """Find a speaker, and the key used to order its commands. Speakers that
+    can't be found are returned by name, so that run_command() reports the
+    error."""
+    if not isinstance(speaker, SoCo):
+        try:
+            with capture_output(StringIO(), StringIO()), api_mode(), use_context(
+                context
+            ):
+                soco = _get_soco_object(speaker, use_local_speaker_list)
+        except Exception as e:
+            logging.info("Unable to resolve speaker '{}': {}".format(speaker, e))
+            soco = None
+        if not soco:
+            return speaker, _target_id(speaker)
+        speaker = soco
+    return speaker, _coordinator_key(speaker)
+
+
+def _coordinator_key(speaker: SoCo) -> str:
+    """Commands for speakers in the same group share the IP address of the group
+    coordinator as their key, because actions can be redirected to the
+    coordinator."""
+    try:
+        return speaker.group.coordinator.ip_address
+    except Exception as e:
+        logging.info("Unable to get group for '{}': {}".format(speaker, e))
+        return speaker.ip_address
 
 
 def set_log_level(log_level: str = "None") -> None:
@@ -141,32 +585,40 @@ def handle_sigint() -> None:
     signal(SIGINT, sig_handler)
 
 
-def rescan_speakers(timeout: float = None) -> None:
+def rescan_speakers(
+    timeout: float = None, context: Optional[SoCoCLIContext] = None
+) -> None:
     """Run full network scan to find speakers."""
-    _check_for_speaker_cache()
-    speaker_cache().scan(reset=True, scan_timeout_override=timeout)
+    with use_context(context):
+        _speaker_cache().scan(reset=True, scan_timeout_override=timeout)
 
 
-def rediscover_speakers() -> None:
+def rediscover_speakers(context: Optional[SoCoCLIContext] = None) -> None:
     """Run normal SoCo discovery to discover speakers."""
-    _check_for_speaker_cache()
-    speaker_cache().discover(reset=True)
+    with use_context(context):
+        _speaker_cache().discover(reset=True)
 
 
-def get_all_speakers(use_scan: bool = False) -> list:
+def get_all_speakers(
+    use_scan: bool = False, context: Optional[SoCoCLIContext] = None
+) -> list:
     """Return all SoCo instances."""
-    _check_for_speaker_cache()
-    return [s[0] for s in speaker_cache().get_all_speakers(use_scan=use_scan)]
+    with use_context(context):
+        return [s[0] for s in _speaker_cache().get_all_speakers(use_scan=use_scan)]
 
 
-def get_all_speaker_names(use_scan: bool = False) -> list:
+def get_all_speaker_names(
+    use_scan: bool = False, context: Optional[SoCoCLIContext] = None
+) -> list:
     """Return all speaker names."""
-    _check_for_speaker_cache()
-    return speaker_cache().get_all_speaker_names(use_scan=use_scan)
+    with use_context(context):
+        return _speaker_cache().get_all_speaker_names(use_scan=use_scan)
 
 
 def get_soco_object(
-    speaker_name: str, use_local_speaker_list: bool = False
+    speaker_name: str,
+    use_local_speaker_list: bool = False,
+    context: Optional[SoCoCLIContext] = None,
 ) -> Tuple[Union[SoCo, None], str]:
     """Uses the full set of soco_cli strategies to find a speaker.
 
@@ -174,19 +626,16 @@ def get_soco_object(
         speaker_name (str): The name of the speaker to find.
         use_local_speaker_list (bool, optional): Whether to use the local
             speaker cache.
+        context (SoCoCLIContext, optional): The context to use, if not the
+            current context.
 
     Returns:
         (SoCo, str): Tuple of SoCo object, or None if no speaker is found,
         and an error message.
     """
-    set_api()
-
     error = StringIO()
-    sys.stderr = error
-
-    speaker = _get_soco_object(speaker_name, use_local_speaker_list)
-
-    sys.stderr = sys.__stderr__
+    with capture_output(StringIO(), error), api_mode(), use_context(context):
+        speaker = _get_soco_object(speaker_name, use_local_speaker_list)
 
     error_msg = error.getvalue().rstrip()
     if not speaker and error_msg == "":
@@ -199,29 +648,14 @@ def _get_soco_object(speaker_name: str, use_local_speaker_list: bool = False) ->
     """Internal helper version that doesn't redirect stderr."""
 
     if use_local_speaker_list:
-        _setup_local_speaker_list()
+        current_context().ensure_speaker_list()
 
-    _check_for_speaker_cache()
+    _speaker_cache()
 
     return get_speaker(speaker_name, use_local_speaker_list)
 
 
-def _check_for_speaker_cache() -> None:
-    if not speaker_cache():
-        create_speaker_cache(max_threads=256, scan_timeout=1.0, min_netmask=24)
-
-
-# For local speaker list operations
-speaker_list_set = False
-
-
-def _setup_local_speaker_list() -> None:
-    global speaker_list_set
-    if not speaker_list_set:
-        speaker_list = Speakers()
-        if not speaker_list.load():
-            logging.info("Start speaker discovery")
-            speaker_list.discover()
-            speaker_list.save()
-        set_speaker_list(speaker_list)
-    speaker_list_set = True
+def _speaker_cache() -> SpeakerCache:
+    """Return the speaker cache of the current context, creating it if
+    necessary."""
+    return current_context().ensure_speaker_cache()
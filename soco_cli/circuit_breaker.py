@@ -0,0 +1,273 @@
+"""Per-device circuit breakers, and request timeout and retry policies.
+
+When a speaker stops responding (e.g., it's switched off or unplugged), each
+request to it stalls until the request times out. The circuit breaker for a
+device 'opens' after a number of consecutive connection failures. While it's
+open, actions on the device fail immediately, and the device is probed in the
+background; the circuit closes again as soon as the device responds.
+
+Only failures to connect count towards opening a circuit. A request that
+times out after connecting is not a device failure: some reads (e.g.,
+searching a large library) are slow on healthy devices.
+
+Actions are classified as reads or writes, and each class has its own request
+timeout and number of retries. By default, reads use SoCo's request timeout
+and are retried once, and writes are not retried because repeating a write
+(e.g., 'next') may not be safe.
+"""
+
+import logging
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from io import StringIO
+from typing import Callable, Dict, Optional
+
+import requests  # type: ignore
+
+from soco_cli.utils import (
+    capture_output,
+    errors_exit,
+    output_streamed,
+    output_targets,
+)
+
+READ = "read"
+WRITE = "write"
+
+# The port used to probe speakers
+SONOS_PORT = 1400
+
+
+class DeviceUnavailableError(Exception):
+    """An action was attempted on a device whose circuit is open."""
+
+
+class ActionPolicy:
+    """The request timeout (in seconds; None for SoCo's default) and the
+    number of retries after a connection failure, for a class of actions."""
+
+    def __init__(
+        self, timeout: Optional[float] = None, retries: int = 0, retry_delay=0.5
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+_policies = {
+    READ: ActionPolicy(timeout=None, retries=1),
+    WRITE: ActionPolicy(timeout=10.0, retries=0),
+}  # type: Dict[str, ActionPolicy]
+
+
+def set_action_policy(
+    action_class: str,
+    timeout: Optional[float] = None,
+    retries: Optional[int] = None,
+    retry_delay: Optional[float] = None,
+) -> None:
+    """Change the policy for 'read' or 'write' actions."""
+    policy = _policies[action_class]
+    if timeout is not None:
+        policy.timeout = timeout
+    if retries is not None:
+        policy.retries = retries
+    if retry_delay is not None:
+        policy.retry_delay = retry_delay
+
+
+def action_policy(action_class: str) -> ActionPolicy:
+    return _policies[action_class]
+
+
+def is_connection_failure(exception: BaseException) -> bool:
+    """Whether an exception means that the device couldn't be connected to,
+    as opposed to responding with an error or responding slowly. (A
+    'ConnectTimeout' is also a 'requests.exceptions.ConnectionError'.)"""
+    return isinstance(exception, (requests.exceptions.ConnectionError, ConnectionError))
+
+
+# Request timeout override for the current thread, used by 'send_with_timeout()'
+_request_timeout = threading.local()
+
+
+def send_with_timeout(send_command, service, action, args=None, cache=None, **kwargs):
+    """Send a request using 'send_command', applying the request timeout set
+    for the current thread, if any. Used by 'soap_requests'."""
+    timeout = getattr(_request_timeout, "timeout", None)
+    if timeout is not None:
+        kwargs.setdefault("timeout", timeout)
+    return send_command(service, action, args=args, cache=cache, **kwargs)
+
+
+@contextmanager
+def request_timeout(timeout: Optional[float]):
+    """Set the timeout for SoCo requests made by the current thread."""
+    saved = getattr(_request_timeout, "timeout", None)
+    _request_timeout.timeout = timeout
+    try:
+        yield
+    finally:
+        _request_timeout.timeout = saved
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = 2,
+        probe_interval: float = 5.0,
+        probe_timeout: float = 1.0,
+    ):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        # Consecutive connection failures, by IP address
+        self._failures = {}  # type: Dict[str, int]
+        # The IP addresses of devices whose circuits are open
+        self._open = set()  # type: set
+
+    def is_open(self, ip_address: str) -> bool:
+        with self._lock:
+            return ip_address in self._open
+
+    def check(self, ip_address: str) -> None:
+        """Raise DeviceUnavailableError if the device's circuit is open."""
+        if self.is_open(ip_address):
+            raise DeviceUnavailableError(
+                "Speaker at {} is not responding".format(ip_address)
+            )
+
+    def record_success(self, ip_address: str) -> None:
+        with self._lock:
+            self._failures.pop(ip_address, None)
+            if ip_address in self._open:
+                logging.info("Closing circuit for {}".format(ip_address))
+                self._open.discard(ip_address)
+
+    def record_failure(self, ip_address: str) -> None:
+        with self._lock:
+            failures = self._failures.get(ip_address, 0) + 1
+            self._failures[ip_address] = failures
+            if failures < self.failure_threshold or ip_address in self._open:
+                return
+            logging.info(
+                "Opening circuit for {} after {} failure(s)".format(
+                    ip_address, failures
+                )
+            )
+            self._open.add(ip_address)
+        threading.Thread(target=self._probe, args=(ip_address,), daemon=True).start()
+
+    def _probe(self, ip_address: str) -> None:
+        """Probe a device until it responds, then close its circuit."""
+        while self.is_open(ip_address):
+            time.sleep(self.probe_interval)
+            try:
+                socket.create_connection(
+                    (ip_address, SONOS_PORT), timeout=self.probe_timeout
+                ).close()
+            except OSError as e:
+                logging.info("Probe of {} failed: {}".format(ip_address, e))
+                continue
+            self.record_success(ip_address)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._failures.clear()
+            self._open.clear()
+
+    def call(self, ip_address: str, policy: ActionPolicy, function: Callable):
+        """Call 'function', which operates on the device at 'ip_address',
+        applying the policy's timeout and retries.
+
+        When retries are allowed, the output of each attempt is held back and
+        only printed once the attempt has completed, so that a retried
+        attempt doesn't print its output twice. Output isn't held back if
+        it's streamed (see 'api.stream_command()'), or if an error report
+        would exit the program before the output is printed; instead, an
+        attempt is only retried if it hasn't printed anything.
+
+        Raises:
+            DeviceUnavailableError: If the device's circuit is open.
+        """
+        attempt = 0
+        pass_through = output_streamed() or errors_exit()
+        while True:
+            self.check(ip_address)
+            output = StringIO()
+            error = StringIO()
+            printed = (
+                [_PrintTracker(stream) for stream in output_targets()]
+                if pass_through
+                else []
+            )
+            try:
+                with request_timeout(policy.timeout):
+                    if policy.retries > 0 and pass_through:
+                        with capture_output(*printed):
+                            result = function()
+                    elif policy.retries > 0:
+                        with capture_output(output, error):
+                            result = function()
+                    else:
+                        result = function()
+            except Exception as e:
+                if not is_connection_failure(e):
+                    _replay(output, error)
+                    raise
+                logging.info(
+                    "Connection failure for {} (attempt {}): {}".format(
+                        ip_address, attempt + 1, e
+                    )
+                )
+                self.record_failure(ip_address)
+                if (
+                    attempt >= policy.retries
+                    or self.is_open(ip_address)
+                    or any(tracker.printed for tracker in printed)
+                ):
+                    raise
+                attempt += 1
+                time.sleep(policy.retry_delay)
+                continue
+            self.record_success(ip_address)
+            _replay(output, error)
+            return result
+
+
+class _PrintTracker:
+    """Passes the text written to it to a stream, recording whether anything
+    has been written."""
+
+    streaming = True
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.printed = False
+
+    def write(self, text: str) -> int:
+        if text:
+            self.printed = True
+        return self._stream.write(text)
+
+    def __getattr__(self, attribute):
+        return getattr(self._stream, attribute)
+
+
+def _replay(output: StringIO, error: StringIO) -> None:
+    if output.getvalue():
+        print(output.getvalue(), end="", flush=True)
+    if error.getvalue():
+        print(error.getvalue(), end="", file=sys.stderr, flush=True)
+
+
+# Device health is shared by all contexts, since it describes the devices
+_circuit_breaker = CircuitBreaker()
+
+
+def circuit_breaker() -> CircuitBreaker:
+    return _circuit_breaker
@@ -1,18 +1,64 @@
-"""Parse sequential command lines, using ':' as a command separator."""
+"""Parse sequential command lines, using ':' as a command separator.
+
+Sequences can also be grouped into parallel blocks, whose branches are run
+concurrently, using either of the forms:
+
+    par [ A : B ] [ C : D ]
+    { A : B } & { C : D }
+"""
+
+
+class ParallelSequences:
+    """A parallel block: a list of branches, each of which is a list of command
+    sequences."""
+
+    def __init__(self, branches):
+        self.branches = branches
+
+    def __repr__(self):
+        return "ParallelSequences({})".format(self.branches)
+
+    def __eq__(self, other):
+        return isinstance(other, ParallelSequences) and self.branches == other.branches
 
 
 class CLIParser:
-    def __init__(self):
+    def __init__(self, parallel_blocks=True):
         self._args = None
         self._sequences = None
         self._separator = ":"
+        self._parallel_blocks = parallel_blocks
 
     def parse(self, args):
+        """Parse a list of arguments into command sequences.
+
+        Raises:
+            ValueError: If a parallel block is malformed.
+        """
         self._args = args
+        self._sequences, _ = self._parse_sequences(args, 0)
 
+    def _parse_sequences(self, args, position, closing=None):
+        """Parse command sequences starting at 'position', up to the 'closing'
+        bracket (if any). Returns the sequences and the position after them."""
         sequence = []  # A single command sequence
         sequences = []  # A list of command sequences
-        for arg in args:
+        while position < len(args):
+            arg = args[position]
+            position += 1
+            if closing is not None and arg == closing:
+                if sequence:
+                    sequences.append(sequence)
+                return sequences, position
+            if sequence is None and arg != self._separator:
+                raise ValueError(
+                    "Expected ':' after parallel block, found '{}'".format(arg)
+                )
+            if sequence == [] and self._starts_parallel_block(args, position - 1):
+                block, position = self._parse_parallel_block(args, position - 1)
+                sequences.append(block)
+                sequence = None
+                continue
             # if len(arg) > 1 and self._separator in arg:
             #     # Catch special cases of colon use: HH:MM(:SS) time formats,
             #     # and URLs
@@ -44,12 +90,47 @@ class CLIParser:
             if arg != self._separator:
                 sequence.append(arg)
             else:
-                sequences.append(sequence)
+                if sequence is not None:
+                    sequences.append(sequence)
                 sequence = []
+        if closing is not None:
+            raise ValueError("Missing '{}' in parallel block".format(closing))
         if sequence:
             sequences.append(sequence)
+        return sequences, position
+
+    def _starts_parallel_block(self, args, position):
+        if not self._parallel_blocks:
+            return False
+        arg = args[position]
+        if arg == "{":
+            return True
+        return (
+            arg.lower() == "par"
+            and position + 1 < len(args)
+            and args[position + 1] == "["
+        )
 
-        self._sequences = sequences
+    def _parse_parallel_block(self, args, position):
+        branches = []
+        if args[position] == "{":
+            # { A : B } & { C : D } ...
+            while True:
+                branch, position = self._parse_sequences(args, position + 1, "}")
+                branches.append(branch)
+                if position < len(args) and args[position] == "&":
+                    if position + 1 >= len(args) or args[position + 1] != "{":
+                        raise ValueError("Expected '{' after '&'")
+                    position += 1
+                    continue
+                break
+        else:
+            # par [ A : B ] [ C : D ] ...
+            position += 1
+            while position < len(args) and args[position] == "[":
+                branch, position = self._parse_sequences(args, position + 1, "]")
+                branches.append(branch)
+        return ParallelSequences(branches), position
 
     def get_sequences(self):
         return self._sequences
@@ -0,0 +1,254 @@
+"""Shared speaker event subscriptions, fanned out to asyncio clients.
+
+Used by the HTTP API server's '/events' endpoints. Each client asks for events
+of one or more types from a set of speakers:
+
+    transport   AVTransport events (state, track, play mode, ...)
+    rendering   RenderingControl events (volume, mute, EQ, ...)
+    topology    ZoneGroupTopology events (grouping, speakers added/removed)
+
+There is at most one subscription for each speaker and event type, however
+many clients want its events; it's cancelled when the last such client is
+removed. Topology events describe the whole household, so there is one
+topology subscription per household.
+
+Each client has a bounded queue. If a client doesn't keep up, further events
+are dropped for that client, and counted.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Set, Tuple
+
+from soco import SoCo  # type: ignore
+
+TRANSPORT = "transport"
+RENDERING = "rendering"
+TOPOLOGY = "topology"
+
+EVENT_TYPES = [TRANSPORT, RENDERING, TOPOLOGY]
+
+_SERVICES = {
+    TRANSPORT: "avTransport",
+    RENDERING: "renderingControl",
+    TOPOLOGY: "zoneGroupTopology",
+}
+
+# The maximum number of events queued for each client
+CLIENT_MAX_QUEUED = 100
+
+
+class EventClient:
+    """A consumer of events. Read the events (dicts) from 'queue'."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_queued: int):
+        self._loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queued)  # type: asyncio.Queue
+        # The (IP address, event type) subscriptions whose events are wanted
+        self.keys = set()  # type: Set[Tuple[str, str]]
+        self.dropped = 0
+
+    def offer(self, message: Dict) -> None:
+        """Queue an event. Called from SoCo's event listener thread."""
+        try:
+            self._loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
+
+    def _put(self, message: Dict) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+
+class EventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (IP address, event type) -> [subscription, number of clients]
+        self._subscriptions = {}  # type: Dict[Tuple[str, str], List]
+        self._clients = set()  # type: Set[EventClient]
+        # IP address -> speaker name
+        self._names = {}  # type: Dict[str, str]
+        # Household ID -> the key of the household's topology subscription
+        self._topologies = {}  # type: Dict[str, Tuple[str, str]]
+
+    def add_client(
+        self,
+        speakers: List[SoCo],
+        event_types: List[str],
+        loop: asyncio.AbstractEventLoop,
+        max_queued: int = CLIENT_MAX_QUEUED,
+    ) -> EventClient:
+        """Create a client for events of the given types from the speakers,
+        subscribing to events where necessary. Makes network calls."""
+        client = EventClient(loop, max_queued)
+        households = set()  # type: Set[str]
+        try:
+            for speaker in speakers:
+                self._names[speaker.ip_address] = speaker.player_name
+                for event_type in event_types:
+                    key = (speaker.ip_address, event_type)
+                    if event_type == TOPOLOGY:
+                        household_id = speaker.household_id
+                        if household_id in households:
+                            continue
+                        households.add(household_id)
+                        key = self._topology_key(household_id, key)
+                    # The household's topology subscription may be through
+                    # another speaker
+                    subscriber = speaker
+                    if key[0] != speaker.ip_address:
+                        subscriber = SoCo(key[0])
+                    if self._subscribe(subscriber, key):
+                        client.keys.add(key)
+        except Exception:
+            self.remove_client(client)
+            raise
+        with self._lock:
+            self._clients.add(client)
+        return client
+
+    def remove_client(self, client: EventClient) -> None:
+        """Remove a client, cancelling the subscriptions that no other client
+        uses. Makes network calls."""
+        unused = []
+        with self._lock:
+            self._clients.discard(client)
+            for key in list(client.keys):
+                entry = self._subscriptions.get(key)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._subscriptions[key]
+                    self._forget_topology(key)
+                    unused.append(entry[0])
+        for subscription in unused:
+            _unsubscribe(subscription)
+
+    def client_count(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+    def subscription_count(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    def close(self) -> None:
+        """Cancel all subscriptions."""
+        with self._lock:
+            subscriptions = [entry[0] for entry in self._subscriptions.values()]
+            self._subscriptions.clear()
+            self._topologies.clear()
+        for subscription in subscriptions:
+            _unsubscribe(subscription)
+
+    def _topology_key(self, household_id: str, key: Tuple[str, str]) -> Tuple[str, str]:
+        """Return the key of the household's topology subscription, which is
+        'key' if there isn't one yet."""
+        with self._lock:
+            return self._topologies.setdefault(household_id, key)
+
+    def _forget_topology(self, key: Tuple[str, str]) -> None:
+        """Forget a household's topology subscription. Call with the lock
+        held."""
+        for household_id, topology_key in list(self._topologies.items()):
+            if topology_key == key:
+                del self._topologies[household_id]
+
+    def _subscribe(self, speaker: SoCo, key: Tuple[str, str]) -> bool:
+        with self._lock:
+            entry = self._subscriptions.get(key)
+            if entry is not None:
+                entry[1] += 1
+                return True
+        try:
+            subscription = getattr(speaker, _SERVICES[key[1]]).subscribe(
+                auto_renew=True, event_queue=_EventDispatcher(self, key)
+            )
+        except Exception as e:
+            logging.info("Failed to subscribe to {}: {}".format(key, e))
+            with self._lock:
+                if key not in self._subscriptions:
+                    self._forget_topology(key)
+            return False
+        logging.info("Subscribed to {} events".format(key))
+        subscription.auto_renew_fail = lambda e: self._subscription_failed(key)
+        with self._lock:
+            entry = self._subscriptions.get(key)
+            if entry is None:
+                self._subscriptions[key] = [subscription, 1]
+                return True
+            # Another client subscribed at the same time
+            entry[1] += 1
+        _unsubscribe(subscription)
+        return True
+
+    def _subscription_failed(self, key: Tuple[str, str]) -> None:
+        logging.info("Subscription to {} events failed".format(key))
+        with self._lock:
+            self._subscriptions.pop(key, None)
+            self._forget_topology(key)
+            clients = [c for c in self._clients if key in c.keys]
+            for client in clients:
+                client.keys.discard(key)
+        for client in clients:
+            client.offer({
+                "speaker": self._names.get(key[0], key[0]),
+                "ip_address": key[0],
+                "type": "error",
+                "error_msg": "Lost the subscription to '{}' events".format(key[1]),
+            })
+
+    def dispatch(self, key: Tuple[str, str], event) -> None:
+        """Pass an event to the clients that want it."""
+        message = {
+            "speaker": self._names.get(key[0], key[0]),
+            "ip_address": key[0],
+            "type": key[1],
+            "seq": getattr(event, "seq", None),
+            "variables": _to_json(getattr(event, "variables", {})),
+        }
+        with self._lock:
+            clients = [c for c in self._clients if key in c.keys]
+        for client in clients:
+            client.offer(message)
+
+
+class _EventDispatcher:
+    """SoCo puts received events on a subscription's queue by calling
+    'put()'."""
+
+    def __init__(self, hub: EventHub, key: Tuple[str, str]):
+        self._hub = hub
+        self._key = key
+
+    def put(self, event, *args, **kwargs) -> None:
+        self._hub.dispatch(self._key, event)
+
+
+def _unsubscribe(subscription) -> None:
+    try:
+        subscription.unsubscribe()
+    except Exception as e:
+        logging.info("Failed to unsubscribe: {}".format(e))
+
+
+def _to_json(value: Any) -> Any:
+    """Convert event variables (which can include DIDL objects) to values that
+    can be serialised as JSON."""
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if hasattr(value, "to_dict"):
+        try:
+            return _to_json(value.to_dict())
+        except Exception:
+            pass
+    return str(value)
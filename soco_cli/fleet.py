@@ -0,0 +1,222 @@
+"""Run batches of commands across a pool of worker processes.
+
+For very large numbers of speakers, a single process is limited by the GIL,
+and by its socket and event listener limits. A 'FleetRunner' divides a batch of
+commands into shards, by the household or the subnet of each command's
+speaker, and runs each shard in one of a pool of worker processes. Within a
+worker, a shard's commands are run using 'api.run_commands()', so commands for
+the same speaker or group run in order.
+
+Each worker keeps its own context (speaker cache) for the lifetime of the
+runner, so it stays warm across batches. The worker contexts take their
+settings (e.g., 'elide_writes'), and the action timeout and retry policies,
+from the context in use when the first batch is run. The results are returned
+in the same order as the commands.
+
+All the speakers in a subnet (or household) are in the same shard, so they're
+handled by a single worker process.
+"""
+
+import ipaddress
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from soco import SoCo  # type: ignore
+
+from soco_cli.api import get_soco_object, run_commands
+from soco_cli.circuit_breaker import READ, WRITE, action_policy, set_action_policy
+from soco_cli.utils import SoCoCLIContext, current_context
+
+SHARD_BY_SUBNET = "subnet"
+SHARD_BY_HOUSEHOLD = "household"
+
+# The prefix length used to find a speaker's subnet
+SUBNET_PREFIX_LENGTH = 24
+
+# The maximum number of commands run at the same time by each worker
+WORKER_MAX_PARALLEL = 8
+
+# The context used by the commands run in a worker process
+_worker_context = None  # type: Optional[SoCoCLIContext]
+
+
+def _worker_settings(context: SoCoCLIContext) -> Dict[str, Any]:
+    """The settings passed to worker processes, taken from a context and the
+    action policies."""
+    return {
+        "context": {
+            "max_threads": context.max_threads,
+            "scan_timeout": context.scan_timeout,
+            "min_netmask": context.min_netmask,
+            "elide_writes": context.elide_writes,
+        },
+        "policies": {
+            action_class: vars(action_policy(action_class))
+            for action_class in [READ, WRITE]
+        },
+    }
+
+
+def _init_worker(settings: Dict[str, Any]) -> None:
+    global _worker_context
+    _worker_context = SoCoCLIContext(api=True, **settings["context"])
+    for action_class, policy in settings["policies"].items():
+        set_action_policy(action_class, **policy)
+
+
+def _run_shard(
+    shard: List[Tuple[int, str, str, List[str]]], use_local_speaker_list: bool = False
+) -> List[Tuple[int, Tuple]]:
+    """Run a shard's commands in a worker process. The commands use IP
+    addresses, so no discovery is needed to find their speakers."""
+    results = run_commands(
+        [[ip_address, action] + args for _, ip_address, action, args in shard],
+        max_parallel=WORKER_MAX_PARALLEL,
+        use_local_speaker_list=use_local_speaker_list,
+        context=_worker_context,
+    )
+    return [(command[0], result) for command, result in zip(shard, results)]
+
+
+class FleetRunner:
+    """A pool of worker processes for running batches of commands. Use as a
+    context manager, or call 'close()' when finished.
+
+    Args:
+        processes (int, optional): The number of worker processes (default:
+            the number of CPUs).
+        shard_by (str): 'subnet' (the default) or 'household'. Finding a
+            speaker's household requires a network request.
+    """
+
+    def __init__(
+        self, processes: Optional[int] = None, shard_by: str = SHARD_BY_SUBNET
+    ):
+        if shard_by not in [SHARD_BY_SUBNET, SHARD_BY_HOUSEHOLD]:
+            raise ValueError("'shard_by' must be 'subnet' or 'household'")
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shard_by = shard_by
+        self._pool = None  # type: Optional[multiprocessing.pool.Pool]
+
+    def __enter__(self) -> "FleetRunner":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _get_pool(self, context: SoCoCLIContext):
+        if self._pool is None:
+            logging.info("Starting {} worker process(es)".format(self.processes))
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                self.processes,
+                initializer=_init_worker,
+                initargs=(_worker_settings(context),),
+            )
+        return self._pool
+
+    def run(
+        self,
+        commands: Sequence[Sequence[Union[str, SoCo]]],
+        use_local_speaker_list: bool = False,
+    ) -> List[Tuple[int, str, str, float]]:
+        """Run a batch of commands. The commands and the results take the same
+        form as for 'api.run_commands()'. Speakers are looked up in this
+        process, using the current context."""
+        commands = [list(command) for command in commands]
+        for command in commands:
+            if len(command) < 2:
+                raise ValueError(
+                    "Commands require a speaker and an action: '{}'".format(command)
+                )
+
+        # Look up each distinct speaker once, and find its shard
+        context = current_context()
+        targets = {}  # type: Dict[str, Union[str, SoCo]]
+        for command in commands:
+            targets.setdefault(_target_id(command[0]), command[0])
+        with ThreadPoolExecutor(max_workers=max(1, min(len(targets), 32))) as executor:
+            resolved = dict(
+                zip(
+                    targets.keys(),
+                    executor.map(
+                        lambda target: self._resolve(
+                            target, use_local_speaker_list, context
+                        ),
+                        targets.values(),
+                    ),
+                )
+            )  # type: Dict[str, Tuple[Optional[str], str, str]]
+
+        results = [None] * len(commands)  # type: List
+        shards = {}  # type: Dict[str, List[Tuple[int, str, str, List[str]]]]
+        for index, command in enumerate(commands):
+            ip_address, shard_key, error_msg = resolved[_target_id(command[0])]
+            if ip_address is None:
+                results[index] = (1, "", error_msg, 0.0)
+                continue
+            shards.setdefault(shard_key, []).append(
+                (index, ip_address, str(command[1]), [str(a) for a in command[2:]])
+            )
+
+        logging.info(
+            "Running {} command(s) in {} shard(s)".format(len(commands), len(shards))
+        )
+        if shards:
+            for shard_results in self._get_pool(context).imap_unordered(
+                partial(_run_shard, use_local_speaker_list=use_local_speaker_list),
+                list(shards.values()),
+            ):
+                for index, result in shard_results:
+                    results[index] = tuple(result)
+        return results
+
+    def _resolve(
+        self,
+        speaker: Union[str, SoCo],
+        use_local_speaker_list: bool,
+        context: SoCoCLIContext,
+    ) -> Tuple[Optional[str], str, str]:
+        """Return the speaker's IP address and shard key, or None and an error
+        message."""
+        if not isinstance(speaker, SoCo):
+            speaker_name = speaker
+            speaker, error_msg = get_soco_object(
+                speaker_name,
+                use_local_speaker_list=use_local_speaker_list,
+                context=context,
+            )
+            if not speaker:
+                return (
+                    None,
+                    "",
+                    "Speaker '{}' not found: {}".format(speaker_name, error_msg),
+                )
+        try:
+            return speaker.ip_address, self._shard_key(speaker), ""
+        except Exception as e:
+            return None, "", "Error: {}".format(e)
+
+    def _shard_key(self, speaker: SoCo) -> str:
+        if self.shard_by == SHARD_BY_HOUSEHOLD:
+            return speaker.household_id
+        return str(
+            ipaddress.ip_network(
+                "{}/{}".format(speaker.ip_address, SUBNET_PREFIX_LENGTH), strict=False
+            )
+        )
+
+
+def _target_id(speaker: Union[str, SoCo]) -> str:
+    if isinstance(speaker, SoCo):
+        return "soco:" + speaker.ip_address
+    return "name:" + str(speaker).lower()
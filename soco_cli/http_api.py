@@ -7,21 +7,39 @@ if version_info.major == 3 and version_info.minor < 7:
     exit(1)
 
 import argparse
+import asyncio
+import json
 import pprint
 import shlex
+import time
+from contextvars import ContextVar
 from os.path import abspath
-from subprocess import STDOUT, CalledProcessError, check_output
-from typing import Dict, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import uvicorn  # type: ignore
-from fastapi import FastAPI
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
 
+from soco_cli import aio, metrics
 from soco_cli.__init__ import __version__ as version  # type: ignore
+from soco_cli.action_processor import actions
 from soco_cli.api import get_all_speaker_names
 from soco_cli.api import get_soco_object as get_speaker
-from soco_cli.api import rescan_speakers
-from soco_cli.api import run_command as sc_run
+from soco_cli.api import run_commands, stream_command
+from soco_cli.cmd_parser import CLIParser
+from soco_cli.event_hub import EVENT_TYPES, EventClient, EventHub
+from soco_cli.result_cache import CachedResult, ResultCache
+from soco_cli.speaker_sets import SET_PREFIX, is_speaker_set, load_speaker_sets
 from soco_cli.speakers import Speakers
+from soco_cli.utils import SoCoCLIContext
 from soco_cli.utils import version as print_version
 
 # Globals
@@ -34,8 +52,100 @@ MACROS: Dict[str, str] = {}
 MACRO_FILE = ""
 PP = pprint.PrettyPrinter(indent=len(PREFIX_MACRO))
 
-# Gets used with the local speaker list only
-SPEAKER_LIST = Speakers(network_timeout=1.0)
+# The server's speaker cache and local speaker list
+CONTEXT = SoCoCLIContext(speaker_list=Speakers(network_timeout=1.0))
+
+# The cache of read-only action results; None if disabled
+RESULT_CACHE: Optional[ResultCache] = ResultCache()
+
+# Shared speaker event subscriptions for '/events' clients
+EVENT_HUB = EventHub()
+
+# The interval (in seconds) between keep-alive messages on '/events'
+EVENTS_KEEPALIVE = 15.0
+
+# The maximum number of commands in a '/batch' request
+BATCH_MAX_COMMANDS = 500
+
+# The durations of the phases of the current request, reported in its
+# 'Server-Timing' header
+TIMINGS: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "TIMINGS", default=None
+)
+
+# Metrics, served by '/metrics'. Labels for speakers and actions that aren't
+# known are replaced by this value, so that requests can't create unlimited
+# numbers of time series.
+UNKNOWN = "unknown"
+HTTP_REQUESTS = metrics.REGISTRY.counter(
+    "sococli_http_requests_total",
+    "HTTP requests handled",
+    ["route", "method", "status"],
+)
+HTTP_DURATION = metrics.REGISTRY.histogram(
+    "sococli_http_request_duration_seconds",
+    "The time taken to start the response to HTTP requests",
+    ["route"],
+)
+HTTP_IN_FLIGHT = metrics.REGISTRY.gauge(
+    "sococli_http_requests_in_flight", "HTTP requests being handled"
+)
+COMMANDS = metrics.REGISTRY.counter(
+    "sococli_commands_total",
+    "Commands run, including those in batches",
+    ["speaker", "action", "exit_code", "cached"],
+)
+COMMAND_DURATION = metrics.REGISTRY.histogram(
+    "sococli_command_duration_seconds",
+    "The time taken to run commands, including those in batches",
+    ["speaker", "action"],
+)
+MACROS_RUN = metrics.REGISTRY.counter(
+    "sococli_macros_total", "Macros run", ["macro", "exit_code"]
+)
+MACRO_DURATION = metrics.REGISTRY.histogram(
+    "sococli_macro_duration_seconds", "The time taken to run macros", ["macro"]
+)
+SPEAKER_LOOKUPS = metrics.REGISTRY.counter(
+    "sococli_speaker_lookups_total",
+    "Speaker name lookups, by how they were resolved: 'direct' lookups are "
+    "speaker cache hits",
+    ["method"],
+    function=lambda: {
+        (method,): count
+        for method, count in (
+            CONTEXT.speaker_cache.lookups if CONTEXT.speaker_cache else {}
+        ).items()
+    },
+)
+RESULT_CACHE_REQUESTS = metrics.REGISTRY.counter(
+    "sococli_result_cache_requests_total",
+    "Result cache lookups, by whether a cached result was used",
+    ["result"],
+    function=lambda: (
+        {("hit",): RESULT_CACHE.hits, ("miss",): RESULT_CACHE.misses}
+        if RESULT_CACHE is not None
+        else {}
+    ),
+)
+EVENT_SUBSCRIPTIONS = metrics.REGISTRY.gauge(
+    "sococli_event_subscriptions",
+    "Speaker event subscriptions held, by their user",
+    ["user"],
+    function=lambda: dict(
+        [(("events",), EVENT_HUB.subscription_count())]
+        + (
+            [(("result_cache",), RESULT_CACHE.subscription_count())]
+            if RESULT_CACHE is not None
+            else []
+        )
+    ),
+)
+EVENT_CLIENTS = metrics.REGISTRY.gauge(
+    "sococli_event_clients",
+    "Connected '/events' clients",
+    function=lambda: {(): EVENT_HUB.client_count()},
+)
 
 
 sc_app = FastAPI(
@@ -50,18 +160,149 @@ sc_app = FastAPI(
 )
 
 
-def command_core(
-    speaker: str, action: str, *args: str, use_local: bool = False
+@sc_app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """Record request metrics, and add a 'Server-Timing' header reporting the
+    phases of the request."""
+    HTTP_IN_FLIGHT.inc()
+    timings: List[Tuple[str, float]] = []
+    token = TIMINGS.set(timings)
+    start_time = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        duration = time.monotonic() - start_time
+        TIMINGS.reset(token)
+        HTTP_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.inc(route_path, request.method, status)
+        HTTP_DURATION.observe(duration, route_path)
+    response.headers["Server-Timing"] = ", ".join(
+        "{};dur={:.1f}".format(name, phase_duration * 1000)
+        for name, phase_duration in timings + [("total", duration)]
+    )
+    return response
+
+
+def _command_labels(speaker: Optional[str], action: str) -> Tuple[str, str]:
+    """The speaker and action labels for the metrics of a command. 'speaker'
+    is a resolved speaker name, a speaker set, or None if not resolved."""
+    if speaker is not None and is_speaker_set(speaker):
+        if speaker.lstrip(SET_PREFIX).lower() in load_speaker_sets():
+            speaker = speaker.lower()
+        else:
+            speaker = None
+    action = action.lower()
+    return speaker or UNKNOWN, action if action in actions else UNKNOWN
+
+
+def _known_speaker_names() -> Dict[str, str]:
+    """Map the lower case names of the speakers known to the server to their
+    names, without making network calls."""
+    if USE_LOCAL:
+        names = CONTEXT.speaker_list.get_all_speaker_names()
+    elif CONTEXT.speaker_cache is not None:
+        names = CONTEXT.speaker_cache.names()
+    else:
+        names = []
+    return {name.lower(): name for name in names}
+
+
+def _record_timing(name: str, start_time: float) -> None:
+    """Record the duration of a phase of the current request."""
+    timings = TIMINGS.get()
+    if timings is not None:
+        timings.append((name, time.monotonic() - start_time))
+
+
+async def command_core(
+    speaker: str, action: str, *args: str, use_local: bool = False, fresh: bool = False
 ) -> Dict:
-    device, error_msg = get_speaker(speaker, use_local_speaker_list=use_local)
+    # Blocking operations run on the 'aio' worker threads, and wait actions
+    # wait for events without occupying a thread
+    start_time = time.monotonic()
+    cacheable = (
+        RESULT_CACHE is not None
+        and not is_speaker_set(speaker)
+        and RESULT_CACHE.cacheable(action, args)
+    )
+    if cacheable and not fresh:
+        cached = RESULT_CACHE.get(speaker, action)
+        _record_timing("cache", start_time)
+        if cached is not None:
+            labels = _command_labels(cached.player_name, action)
+            COMMANDS.inc(*labels, cached.exit_code, "true")
+            COMMAND_DURATION.observe(time.monotonic() - start_time, *labels)
+            print(
+                PREFIX
+                + "Command = 'sonos {} {}', cached result".format(
+                    _quote_if_contains_space(cached.player_name), action
+                )
+            )
+            return {
+                "speaker": cached.player_name,
+                "action": action,
+                "args": args,
+                "exit_code": cached.exit_code,
+                "result": cached.output,
+                "data": cached.data,
+                "error_msg": cached.error_msg,
+                "cached": True,
+                "age": round(time.monotonic() - cached.recorded, 3),
+            }
+
+    requested_speaker = speaker
+    dependencies = None
+    phase_start_time = time.monotonic()
+    if is_speaker_set(speaker):
+        # Speaker sets are resolved by 'run_command_structured()'
+        device, error_msg = speaker, ""
+    else:
+        device, error_msg = await aio.get_soco_object(
+            speaker, use_local_speaker_list=use_local, context=CONTEXT
+        )
     if device:
-        speaker = device.player_name
-        exit_code, result, error_msg = sc_run(
-            device, action, *args, use_local_speaker_list=use_local
+        if not is_speaker_set(device):
+            speaker = await aio.run_blocking(getattr, device, "player_name")
+        _record_timing("resolve", phase_start_time)
+        if cacheable:
+            phase_start_time = time.monotonic()
+            dependencies = await aio.run_blocking(RESULT_CACHE.watch, device, action)
+            generation = RESULT_CACHE.generation
+            _record_timing("subscribe", phase_start_time)
+        phase_start_time = time.monotonic()
+        command_result = await aio.run_command_structured(
+            device, action, *args, use_local_speaker_list=use_local, context=CONTEXT
         )
+        _record_timing("action", phase_start_time)
+        exit_code = command_result.exit_code
+        result = command_result.output
+        data = command_result.data if exit_code == 0 else None
+        error_msg = command_result.error_msg
+        if RESULT_CACHE is not None:
+            if dependencies is not None and exit_code == 0:
+                RESULT_CACHE.store(
+                    requested_speaker,
+                    action,
+                    CachedResult(
+                        speaker, exit_code, result, data, error_msg, time.monotonic()
+                    ),
+                    dependencies,
+                    generation,
+                )
+            elif RESULT_CACHE.is_write(action, args):
+                RESULT_CACHE.invalidate()
     else:
+        _record_timing("resolve", phase_start_time)
         exit_code = 1
         result = ""
+        data = None
+    labels = _command_labels(speaker if device else None, action)
+    COMMANDS.inc(*labels, exit_code, "false")
+    COMMAND_DURATION.observe(time.monotonic() - start_time, *labels)
 
     # Quote speaker names & arguments containing spaces
     if " " in speaker:
@@ -75,22 +316,18 @@ def command_core(
         else:
             new_args.append(args[i])
 
-    # Print the equivalent 'sonos' command and exit code
+    # Print the equivalent 'sonos' command and exit code. Commands can run
+    # concurrently, so the line is printed using a single 'print()' call.
     if len(new_args) != 0:
         arguments = " ".join(new_args).rstrip()
-        print(
-            PREFIX
-            + "Command = 'sonos {} {} {}', ".format(quoted_speaker, action, arguments),
-            end="",
-        )
+        command = "sonos {} {} {}".format(quoted_speaker, action, arguments)
     else:
-        print(
-            PREFIX + "Command = 'sonos {} {}', ".format(quoted_speaker, action), end=""
-        )
+        command = "sonos {} {}".format(quoted_speaker, action)
     if exit_code == 0:
-        print("exit code = {}".format(exit_code))
+        status = "exit code = {}".format(exit_code)
     else:
-        print("exit code = {} [{}]".format(exit_code, error_msg))
+        status = "exit code = {} [{}]".format(exit_code, error_msg)
+    print(PREFIX + "Command = '{}', {}".format(command, status))
 
     return {
         "speaker": speaker,
@@ -98,99 +335,310 @@ def command_core(
         "args": args,
         "exit_code": exit_code,
         "result": result,
+        "data": data,
         "error_msg": error_msg,
+        "cached": False,
+        "age": 0.0,
+    }
+
+
+class BatchRequest(BaseModel):
+    """A '/batch' request: a list of commands, each of the form
+    [speaker, action, arg, ...]."""
+
+    commands: List[List[str]]
+    max_parallel: int = 8
+
+
+@sc_app.post("/batch")
+async def batch(request: BatchRequest) -> Dict:
+    """Run a batch of commands. Commands for the same speaker or group run in
+    the order supplied; commands for different speakers run concurrently."""
+    if len(request.commands) > BATCH_MAX_COMMANDS:
+        raise HTTPException(
+            status_code=400,
+            detail="A batch can contain at most {} commands".format(BATCH_MAX_COMMANDS),
+        )
+    for command in request.commands:
+        if len(command) < 2:
+            raise HTTPException(
+                status_code=400,
+                detail="Commands require a speaker and an action: {}".format(command),
+            )
+    if request.max_parallel < 1:
+        raise HTTPException(status_code=400, detail="'max_parallel' must be >= 1")
+
+    start_time = time.time()
+    results = await aio.run_blocking(
+        run_commands,
+        request.commands,
+        max_parallel=request.max_parallel,
+        use_local_speaker_list=USE_LOCAL,
+        context=CONTEXT,
+    )
+    duration = time.time() - start_time
+    if RESULT_CACHE is not None and any(
+        RESULT_CACHE.is_write(command[1], command[2:]) for command in request.commands
+    ):
+        RESULT_CACHE.invalidate()
+    names = _known_speaker_names()
+    for command, (exit_code, _, _, command_duration) in zip(request.commands, results):
+        # Speakers in a batch are labelled only if they're named exactly
+        labels = _command_labels(
+            command[0] if is_speaker_set(command[0]) else names.get(command[0].lower()),
+            command[1],
+        )
+        COMMANDS.inc(*labels, exit_code, "false")
+        COMMAND_DURATION.observe(command_duration, *labels)
+    failed = sum(1 for result in results if result[0] != 0)
+    print(
+        PREFIX
+        + "Batch of {} command(s), {} failed, in {:.3f}s".format(
+            len(results), failed, duration
+        )
+    )
+
+    return {
+        "results": [
+            {
+                "speaker": command[0],
+                "action": command[1],
+                "args": command[2:],
+                "exit_code": exit_code,
+                "result": output if exit_code == 0 else "",
+                "error_msg": error_msg,
+                "duration": command_duration,
+            }
+            for command, (exit_code, output, error_msg, command_duration) in zip(
+                request.commands, results
+            )
+        ],
+        "failed": failed,
+        "duration": duration,
     }
 
 
+async def _add_event_client(speaker: Optional[str], event_type: Optional[str]):
+    """Create an event client for a comma-separated list of speakers (default:
+    all speakers) and event types (default: all types).
+
+    Raises:
+        HTTPException: If a speaker isn't found, or a type isn't valid.
+    """
+    if event_type is None:
+        event_types = EVENT_TYPES
+    else:
+        event_types = [t.strip().lower() for t in event_type.split(",")]
+        for name in event_types:
+            if name not in EVENT_TYPES:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Event type '{}' not one of {}".format(name, EVENT_TYPES),
+                )
+    if speaker is None:
+        names = await _speaker_names()
+    else:
+        names = [name.strip() for name in speaker.split(",")]
+    devices = []
+    for name in names:
+        device, error_msg = await aio.get_soco_object(
+            name, use_local_speaker_list=USE_LOCAL, context=CONTEXT
+        )
+        if not device:
+            raise HTTPException(
+                status_code=404,
+                detail="Speaker '{}' not found: {}".format(name, error_msg),
+            )
+        devices.append(device)
+    client = await aio.run_blocking(
+        EVENT_HUB.add_client, devices, event_types, asyncio.get_event_loop()
+    )
+    print(
+        PREFIX
+        + "Events client added: speakers = {}, types = {}".format(names, event_types)
+    )
+    return client
+
+
+def _remove_event_client(client: EventClient) -> None:
+    print(PREFIX + "Events client removed ({} events dropped)".format(client.dropped))
+    asyncio.ensure_future(aio.run_blocking(EVENT_HUB.remove_client, client))
+
+
+@sc_app.get("/events")
+async def events(
+    request: Request,
+    speaker: Optional[str] = None,
+    event_type: Optional[str] = Query(None, alias="type"),
+) -> StreamingResponse:
+    """Stream speaker events as server-sent events. Filter using the 'speaker'
+    and 'type' parameters (comma-separated lists)."""
+    client = await _add_event_client(speaker, event_type)
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        client.queue.get(), EVENTS_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "event: {}\ndata: {}\n\n".format(
+                    message["type"], json.dumps(message)
+                )
+        finally:
+            _remove_event_client(client)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@sc_app.websocket("/events/ws")
+async def events_websocket(
+    websocket: WebSocket,
+    speaker: Optional[str] = None,
+    event_type: Optional[str] = Query(None, alias="type"),
+) -> None:
+    """Stream speaker events as WebSocket JSON messages. Filter using the
+    'speaker' and 'type' parameters (comma-separated lists)."""
+    try:
+        client = await _add_event_client(speaker, event_type)
+    except HTTPException as error:
+        await websocket.close(code=1008, reason=str(error.detail))
+        return
+    await websocket.accept()
+
+    async def receive() -> None:
+        # Messages from the client are ignored; this detects disconnection
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    receiver = asyncio.ensure_future(receive())
+    try:
+        while True:
+            getter = asyncio.ensure_future(client.queue.get())
+            done, _ = await asyncio.wait(
+                [getter, receiver], return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+                break
+            await websocket.send_json(getter.result())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        _remove_event_client(client)
+
+
 @sc_app.get("/")
 def root() -> Dict:
     return {"info": INFO}
 
 
-@sc_app.get("/speakers")
-def speakers() -> Dict:
+@sc_app.get("/metrics")
+def prometheus_metrics() -> Response:
+    """Metrics in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def _speaker_names() -> List[str]:
     if USE_LOCAL:
-        speakers = SPEAKER_LIST.get_all_speaker_names()
-    else:
-        speakers = get_all_speaker_names()
+        return CONTEXT.speaker_list.get_all_speaker_names()
+    return await aio.run_blocking(get_all_speaker_names, context=CONTEXT)
+
+
+@sc_app.get("/speakers")
+async def speakers() -> Dict:
+    speakers = await _speaker_names()
     print(PREFIX + "Speakers: {}".format(speakers))
     return {"speakers": speakers}
 
 
 @sc_app.get("/rediscover")
-def rediscover() -> Dict:
+async def rediscover() -> Dict:
     if USE_LOCAL:
-        SPEAKER_LIST.discover()
-        SPEAKER_LIST.save()
+        await aio.run_blocking(CONTEXT.speaker_list.discover)
+        CONTEXT.speaker_list.save()
         print(PREFIX + "Saved new local speaker list")
-        speakers = SPEAKER_LIST.get_all_speaker_names()
+        speakers = CONTEXT.speaker_list.get_all_speaker_names()
     else:
-        rescan_speakers(timeout=2.0)
-        speakers = get_all_speaker_names()
+        await aio.rescan_speakers(timeout=2.0, context=CONTEXT)
+        speakers = await aio.run_blocking(get_all_speaker_names, context=CONTEXT)
     print(PREFIX + "Speakers (re)discovered: {}".format(speakers))
     return {"speakers_discovered": speakers}
 
 
 # Deprecated
 @sc_app.get("/macros", include_in_schema=False)
-def macros() -> Dict:
+async def macros() -> Dict:
     return MACROS
 
 
 @sc_app.get("/macros/list")
-def macros_list() -> Dict:
+async def macros_list() -> Dict:
     return MACROS
 
 
 @sc_app.get("/macros/reload")
-def macros_reload() -> Dict:
+async def macros_reload() -> Dict:
     global MACROS
-    _load_macros(MACROS, filename=MACRO_FILE)
+    await aio.run_blocking(_load_macros, MACROS, filename=MACRO_FILE)
     return MACROS
 
 
 @sc_app.get("/macro/{macro_name}")
-def run_macro(macro_name: str) -> Dict:
-    command, result = _process_macro(macro_name)
+async def run_macro(macro_name: str) -> Dict:
+    command, result = await _process_macro(macro_name)
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}")
-def run_macro_1(macro_name: str, arg_1: str) -> Dict:
-    command, result = _process_macro(macro_name, arg_1)
+async def run_macro_1(macro_name: str, arg_1: str) -> Dict:
+    command, result = await _process_macro(macro_name, arg_1)
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}/{arg_2}")
-def run_macro_2(macro_name: str, arg_1: str, arg_2: str) -> Dict:
-    command, result = _process_macro(macro_name, arg_1, arg_2)
+async def run_macro_2(macro_name: str, arg_1: str, arg_2: str) -> Dict:
+    command, result = await _process_macro(macro_name, arg_1, arg_2)
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}")
-def run_macro_3(macro_name: str, arg_1: str, arg_2: str, arg_3: str) -> Dict:
-    command, result = _process_macro(macro_name, arg_1, arg_2, arg_3)
+async def run_macro_3(macro_name: str, arg_1: str, arg_2: str, arg_3: str) -> Dict:
+    command, result = await _process_macro(macro_name, arg_1, arg_2, arg_3)
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}")
-def run_macro_4(
+async def run_macro_4(
     macro_name: str, arg_1: str, arg_2: str, arg_3: str, arg_4: str
 ) -> Dict:
-    command, result = _process_macro(macro_name, arg_1, arg_2, arg_3, arg_4)
+    command, result = await _process_macro(macro_name, arg_1, arg_2, arg_3, arg_4)
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}/{arg_5}")
-def run_macro_5(
+async def run_macro_5(
     macro_name: str, arg_1: str, arg_2: str, arg_3: str, arg_4: str, arg_5: str
 ) -> Dict:
-    command, result = _process_macro(macro_name, arg_1, arg_2, arg_3, arg_4, arg_5)
+    command, result = await _process_macro(
+        macro_name, arg_1, arg_2, arg_3, arg_4, arg_5
+    )
     return {"command": command, "result": result}
 
 
 @sc_app.get("/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}/{arg_5}/{arg_6}")
-def run_macro_6(
+async def run_macro_6(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -199,7 +647,7 @@ def run_macro_6(
     arg_5: str,
     arg_6: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name, arg_1, arg_2, arg_3, arg_4, arg_5, arg_6
     )
     return {"command": command, "result": result}
@@ -208,7 +656,7 @@ def run_macro_6(
 @sc_app.get(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}/{arg_5}/{arg_6}/{arg_7}"
 )
-def run_macro_7(
+async def run_macro_7(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -218,7 +666,7 @@ def run_macro_7(
     arg_6: str,
     arg_7: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name, arg_1, arg_2, arg_3, arg_4, arg_5, arg_6, arg_7
     )
     return {"command": command, "result": result}
@@ -227,7 +675,7 @@ def run_macro_7(
 @sc_app.get(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}/{arg_5}/{arg_6}/{arg_7}/{arg_8}"
 )
-def run_macro_8(
+async def run_macro_8(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -238,7 +686,7 @@ def run_macro_8(
     arg_7: str,
     arg_8: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name, arg_1, arg_2, arg_3, arg_4, arg_5, arg_6, arg_7, arg_8
     )
     return {"command": command, "result": result}
@@ -247,7 +695,7 @@ def run_macro_8(
 @sc_app.get(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}/{arg_5}/{arg_6}/{arg_7}/{arg_8}/{arg_9}"
 )
-def run_macro_9(
+async def run_macro_9(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -259,7 +707,7 @@ def run_macro_9(
     arg_8: str,
     arg_9: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name, arg_1, arg_2, arg_3, arg_4, arg_5, arg_6, arg_7, arg_8, arg_9
     )
     return {"command": command, "result": result}
@@ -269,7 +717,7 @@ def run_macro_9(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}"
     "/{arg_5}/{arg_6}/{arg_7}/{arg_8}/{arg_9}/{arg_10}"
 )
-def run_macro_10(
+async def run_macro_10(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -282,7 +730,7 @@ def run_macro_10(
     arg_9: str,
     arg_10: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name,
         arg_1,
         arg_2,
@@ -302,7 +750,7 @@ def run_macro_10(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}"
     "/{arg_5}/{arg_6}/{arg_7}/{arg_8}/{arg_9}/{arg_10}/{arg_11}"
 )
-def run_macro_11(
+async def run_macro_11(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -316,7 +764,7 @@ def run_macro_11(
     arg_10: str,
     arg_11: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name,
         arg_1,
         arg_2,
@@ -337,7 +785,7 @@ def run_macro_11(
     "/macro/{macro_name}/{arg_1}/{arg_2}/{arg_3}/{arg_4}"
     "/{arg_5}/{arg_6}/{arg_7}/{arg_8}/{arg_9}/{arg_10}/{arg_11}/{arg_12}"
 )
-def run_macro_12(
+async def run_macro_12(
     macro_name: str,
     arg_1: str,
     arg_2: str,
@@ -352,7 +800,7 @@ def run_macro_12(
     arg_11: str,
     arg_12: str,
 ) -> Dict:
-    command, result = _process_macro(
+    command, result = await _process_macro(
         macro_name,
         arg_1,
         arg_2,
@@ -370,32 +818,79 @@ def run_macro_12(
     return {"command": command, "result": result}
 
 
+def stream_core(speaker: str, action: str, *args: str) -> StreamingResponse:
+    """Relay a command's output as newline-delimited JSON objects while it
+    runs: {"output": text} or {"error": text} for each line printed, then
+    {"exit_code": ..., "error_msg": ..., "data": ...} when it finishes."""
+
+    def events() -> Iterator[str]:
+        for kind, value in stream_command(
+            speaker, action, *args, use_local_speaker_list=USE_LOCAL, context=CONTEXT
+        ):
+            if kind == "result":
+                if RESULT_CACHE is not None and RESULT_CACHE.is_write(action, args):
+                    RESULT_CACHE.invalidate()
+                print(
+                    PREFIX
+                    + "Stream = '{}', exit code = {}".format(
+                        " ".join((speaker, action) + args), value.exit_code
+                    )
+                )
+                line = {
+                    "exit_code": value.exit_code,
+                    "error_msg": value.error_msg,
+                    "data": value.data if value.exit_code == 0 else None,
+                }
+            else:
+                line = {kind: value}
+            yield json.dumps(line, default=str) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@sc_app.get("/stream/{speaker}/{action}")
+def stream_0(speaker: str, action: str) -> StreamingResponse:
+    return stream_core(speaker, action)
+
+
+@sc_app.get("/stream/{speaker}/{action}/{arg_1}")
+def stream_1(speaker: str, action: str, arg_1: str) -> StreamingResponse:
+    return stream_core(speaker, action, arg_1)
+
+
+@sc_app.get("/stream/{speaker}/{action}/{arg_1}/{arg_2}")
+def stream_2(speaker: str, action: str, arg_1: str, arg_2: str) -> StreamingResponse:
+    return stream_core(speaker, action, arg_1, arg_2)
+
+
 @sc_app.get("/{speaker}/{action}")
-def action_0(speaker: str, action: str) -> Dict:
-    return command_core(speaker, action, use_local=USE_LOCAL)
+async def action_0(speaker: str, action: str, fresh: bool = False) -> Dict:
+    return await command_core(speaker, action, use_local=USE_LOCAL, fresh=fresh)
 
 
 @sc_app.get("/{speaker}/{action}/{arg_1}")
-def action_1(speaker: str, action: str, arg_1: str) -> Dict:
-    return command_core(speaker, action, arg_1, use_local=USE_LOCAL)
+async def action_1(speaker: str, action: str, arg_1: str) -> Dict:
+    return await command_core(speaker, action, arg_1, use_local=USE_LOCAL)
 
 
 @sc_app.get("/{speaker}/{action}/{arg_1:path}")
-def action_1_path(speaker: str, action: str, arg_1: str) -> Dict:
+async def action_1_path(speaker: str, action: str, arg_1: str) -> Dict:
     """
     Handle the case where 'arg_1' is a path.
     """
-    return command_core(speaker, action, arg_1, use_local=USE_LOCAL)
+    return await command_core(speaker, action, arg_1, use_local=USE_LOCAL)
 
 
 @sc_app.get("/{speaker}/{action}/{arg_1}/{arg_2}")
-def action_2(speaker: str, action: str, arg_1: str, arg_2: str) -> Dict:
-    return command_core(speaker, action, arg_1, arg_2, use_local=USE_LOCAL)
+async def action_2(speaker: str, action: str, arg_1: str, arg_2: str) -> Dict:
+    return await command_core(speaker, action, arg_1, arg_2, use_local=USE_LOCAL)
 
 
 @sc_app.get("/{speaker}/{action}/{arg_1}/{arg_2}/{arg_3}")
-def action_3(speaker: str, action: str, arg_1: str, arg_2: str, arg_3: str) -> Dict:
-    return command_core(speaker, action, arg_1, arg_2, arg_3, use_local=USE_LOCAL)
+async def action_3(
+    speaker: str, action: str, arg_1: str, arg_2: str, arg_3: str
+) -> Dict:
+    return await command_core(speaker, action, arg_1, arg_2, arg_3, use_local=USE_LOCAL)
 
 
 def args_processor() -> None:
@@ -436,6 +931,18 @@ def args_processor() -> None:
         type=str,
         help="Only with '-l': specify the networks or IP addresses to search",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Don't answer queries such as 'volume' from the event-driven cache",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=aio.AIO_MAX_WORKERS,
+        help="The maximum number of speaker operations to run at the same time",
+    )
 
     args = parser.parse_args()
 
@@ -447,11 +954,20 @@ def args_processor() -> None:
     if args.port is not None:
         PORT = args.port
 
+    if args.max_workers < 1:
+        print(PREFIX + "'--max-workers' must be at least 1")
+        exit(1)
+    aio.set_max_workers(args.max_workers)
+
+    global RESULT_CACHE
+    if args.no_cache:
+        RESULT_CACHE = None
+
     global USE_LOCAL
     USE_LOCAL = args.use_local_speaker_list
     if USE_LOCAL and args.subnets is not None:
         subnets = args.subnets.split(",")
-        SPEAKER_LIST.set_subnets_no_check(subnets)
+        CONTEXT.speaker_list.set_subnets_no_check(subnets)
         print(PREFIX + "/rediscover will use subnets = {}".format(subnets))
     if not USE_LOCAL and args.subnets is not None:
         print(PREFIX + "Option '--subnets' ignored; only valid with local cache")
@@ -471,19 +987,22 @@ def main() -> None:
     try:
         print(PREFIX + "Loading speakers ... ", end="", flush=True)
         if USE_LOCAL:
-            SPEAKER_LIST.load()
-            print(SPEAKER_LIST.get_all_speaker_names())
+            CONTEXT.ensure_speaker_list()
+            print(CONTEXT.speaker_list.get_all_speaker_names())
         else:
             try:
                 # This forces speaker discovery
                 # For some reason, using 'get_all_speakers()' generates Uvicorn errors
-                get_speaker("", USE_LOCAL)
-                print(get_all_speaker_names())
+                get_speaker("", USE_LOCAL, context=CONTEXT)
+                print(get_all_speaker_names(context=CONTEXT))
             except:
                 print(PREFIX + "Discovery failed: try '/rediscover'")
 
         # Start the server
         uvicorn.run(sc_app, host="0.0.0.0", use_colors=False, port=PORT)
+        if RESULT_CACHE is not None:
+            RESULT_CACHE.unwatch_all()
+        EVENT_HUB.close()
         print(PREFIX + INFO + " stopped")
         exit(0)
 
@@ -492,7 +1011,7 @@ def main() -> None:
         exit(1)
 
 
-def _process_macro(macro_name: str, *args) -> Tuple[str, str]:
+async def _process_macro(macro_name: str, *args) -> Tuple[str, str]:
     # Look up the macro
     try:
         macro = _lookup_macro(macro_name)
@@ -502,26 +1021,41 @@ def _process_macro(macro_name: str, *args) -> Tuple[str, str]:
         return "", "Error: macro '{}' not found".format(macro_name)
 
     # Substitute variable arguments
-    sonos_command_line = _substitute_variables(macro, args)
+    command_line = _substitute_variables(macro, args)
 
-    # Finalise the command line
+    # The equivalent 'sonos' command line
     if USE_LOCAL:
-        sonos_command_line = "sonos -l " + sonos_command_line
+        sonos_command_line = "sonos -l " + command_line
     else:
-        # Substitute speaker names for IP addresses, for efficiency
-        sonos_command_line = _substitute_speaker_ips(sonos_command_line)
-        sonos_command_line = "sonos " + sonos_command_line
+        sonos_command_line = "sonos " + command_line
 
-    # Execute the command
-    print(PREFIX_MACRO + "Executing: '" + sonos_command_line + "' in a subprocess")
+    # Execute the command sequences in-process, using the server's speaker
+    # cache, without occupying a thread while waiting. Output and errors are
+    # combined, as for the 'sonos' command.
+    print(PREFIX_MACRO + "Executing: '" + sonos_command_line + "'")
+    start_time = time.monotonic()
     try:
-        output = check_output(sonos_command_line, stderr=STDOUT, shell=True)
+        cli_parser = CLIParser()
+        cli_parser.parse(shlex.split(command_line))
+        exit_code, output = await aio.run_sequences(
+            cli_parser.get_sequences(),
+            use_local_speaker_list=USE_LOCAL,
+            context=CONTEXT,
+        )
+    except Exception as error:
+        exit_code, output = 1, "Error: {}\n".format(error)
+    if RESULT_CACHE is not None:
+        # Macros can contain any actions
+        RESULT_CACHE.invalidate()
+    MACROS_RUN.inc(macro_name, exit_code)
+    MACRO_DURATION.observe(time.monotonic() - start_time, macro_name)
+    _record_timing("macro", start_time)
+    if exit_code == 0:
         print(PREFIX_MACRO + "Exit code = 0")
-        return sonos_command_line, output.decode("utf-8").rstrip()
-    except CalledProcessError as exc:
-        error = exc.output.decode("utf-8").rstrip().replace("\n", "; ")
-        print(PREFIX_MACRO + "Exit code = {} [{}]".format(exc.returncode, error))
-        return sonos_command_line, error
+        return sonos_command_line, output.rstrip()
+    error = output.rstrip().replace("\n", "; ")
+    print(PREFIX_MACRO + "Exit code = {} [{}]".format(exit_code, error))
+    return sonos_command_line, error
 
 
 def _lookup_macro(macro_name: str) -> str:
@@ -605,28 +1139,6 @@ def _substitute_variables(macro: str, args: Tuple) -> str:
     return " ".join(sonos_command_line_terms)
 
 
-def _substitute_speaker_ips(macro: str, use_local: bool = False) -> str:
-    """
-    Substitute speaker names for IP addresses, for efficiency.
-    Speaker names must be exact.
-    """
-    elements = shlex.split(macro)
-    new_macro_list = []
-    for element in elements:
-        device, error_msg = get_speaker(element, use_local_speaker_list=use_local)
-        if device is not None and device.player_name == element:
-            new_macro_list.append(device.ip_address)
-            print(
-                PREFIX_MACRO
-                + "Substituting speaker name '{}' by IP address '{}'".format(
-                    device.player_name, device.ip_address
-                )
-            )
-        else:
-            new_macro_list.append(_quote_if_contains_space(element))
-    return " ".join(new_macro_list)
-
-
 def _load_macros(macros: dict, filename: str) -> bool:
     print(PREFIX_MACRO + "Attempting to (re)load macros from '{}'".format(filename))
     # Create the 'generic' macro
@@ -19,7 +19,7 @@ except ImportError:
 from copy import deepcopy
 from os import chdir
 from shlex import split as shlex_split
-from typing import List, Union
+from typing import List, Optional, Union
 
 from soco import SoCo  # type: ignore
 
@@ -28,7 +28,10 @@ from soco_cli.aliases import AliasManager
 from soco_cli.api import get_soco_object, run_command
 from soco_cli.check_for_update import print_update_status
 from soco_cli.cmd_parser import CLIParser
+from soco_cli.jobs import JobManager
 from soco_cli.keystroke_capture import get_keystroke
+from soco_cli.speaker_sets import is_speaker_set, speaker_set_members
+from soco_cli.track_follow import track_follow
 from soco_cli.utils import (
     RewindableList,
     docs,
@@ -46,6 +49,9 @@ from soco_cli.utils import (
 # Alias Manager
 am = AliasManager()
 
+# Background jobs
+jobs = JobManager()
+
 # The following actions are run in a subprocess, to allow them to be terminated
 # without dropping out of the interactive shell.
 ACTIONS_TO_EXEC = [
@@ -113,7 +119,11 @@ def interactive_loop(
 
     # Is the speaker name set on the command line?
     # Note: ignores SPKR set as part of the environment
-    if speaker_name:
+    if speaker_name and is_speaker_set(speaker_name):
+        speaker = _get_speaker_set(speaker_name)
+        if not speaker:
+            speaker_name = None
+    elif speaker_name:
         try:
             speaker, error_msg = get_soco_object(
                 speaker_name, use_local_speaker_list=use_local_speaker_list
@@ -152,6 +162,8 @@ def interactive_loop(
     while True:
         # Catch all exceptions raised in the input loop
         try:
+            jobs.report_finished_jobs()
+
             if speaker_name and speaker:
                 prompt = (root_prompt + " [{}] > ").format(speaker_name)
             else:
@@ -182,13 +194,20 @@ def interactive_loop(
                 continue
 
             # Parse multiple action sequences
-            cli_parser = CLIParser()
+            cli_parser = CLIParser(parallel_blocks=False)
             try:
-                cli_parser.parse(shlex_split(command_line))
+                command_line_args = shlex_split(command_line)
             except ValueError as error:
                 print("Error: {}".format(error))
                 continue
 
+            # A trailing '&' runs the last action in the background
+            background = False
+            if len(command_line_args) > 0 and command_line_args[-1] == "&":
+                background = True
+                command_line_args.pop()
+            cli_parser.parse(command_line_args)
+
             # Loop through action sequences
             command_sequences = RewindableList(cli_parser.get_sequences())
             logging.info("Command sequences = {}".format(command_sequences))
@@ -233,9 +252,20 @@ def interactive_loop(
 
                 if command_lower.startswith("exit"):
                     logging.info("Exiting interactive mode")
+                    if len(jobs.running_jobs()) > 0:
+                        print("Cancelling running jobs ...")
+                        jobs.cancel_all()
                     _save_readline_history()
                     return True
 
+                if command_lower == "jobs":
+                    jobs.print_jobs()
+                    continue
+
+                if command_lower in ["fg", "cancel"]:
+                    _job_control(command)
+                    continue
+
                 if command_lower in ["help", "?"]:
                     _interactive_help()
                     continue
@@ -327,7 +357,7 @@ def interactive_loop(
                         pushed = True
                         logging.info(
                             "Pushing current active speaker: {}".format(
-                                speaker.player_name
+                                _speaker_label(speaker)
                             )
                         )
                     else:
@@ -345,7 +375,7 @@ def interactive_loop(
                     logging.info("Popping the saved speaker state")
                     if saved_speaker:
                         speaker = saved_speaker
-                        speaker_name = speaker.player_name
+                        speaker_name = _speaker_label(speaker)
                         logging.info("Saved speaker = '{}'".format(speaker_name))
                         saved_speaker = None
                     elif pushed:
@@ -409,9 +439,14 @@ def interactive_loop(
                     try:
                         if args[0] == "set":
                             new_speaker_name = args[1]
-                            new_speaker = get_speaker(
-                                new_speaker_name, use_local_speaker_list
-                            )
+                            if is_speaker_set(new_speaker_name):
+                                new_speaker = _get_speaker_set(new_speaker_name)
+                                if not new_speaker:
+                                    continue
+                            else:
+                                new_speaker = get_speaker(
+                                    new_speaker_name, use_local_speaker_list
+                                )
                             if not new_speaker:
                                 print(
                                     "Error: Speaker '{}' not found".format(
@@ -425,7 +460,7 @@ def interactive_loop(
                                     )
                                 )
                                 speaker = new_speaker
-                                speaker_name = speaker.player_name
+                                speaker_name = _speaker_label(speaker)
                             continue
                     except IndexError:
                         # No speaker name given
@@ -447,6 +482,10 @@ def interactive_loop(
                                 .format(name)
                             )
                             continue
+                        elif is_speaker_set(name):
+                            speaker = _get_speaker_set(name)
+                            if not speaker:
+                                continue
                         else:
                             speaker = get_speaker(name, use_local_speaker_list)
                             if not speaker:
@@ -458,13 +497,14 @@ def interactive_loop(
                         if len(args) == 0:
                             print(
                                 "Error: no action or arguments supplied for speaker"
-                                " '{}'".format(speaker.player_name)
+                                " '{}'".format(_speaker_label(speaker))
                             )
+                            speaker = None
                             continue
 
                         # Temporarily establish an active speaker
                         temp_active_speaker = True
-                        speaker_name = speaker.player_name
+                        speaker_name = _speaker_label(speaker)
                         logging.info(
                             "Temporarily establish active speaker: '{}'".format(
                                 speaker_name
@@ -478,12 +518,15 @@ def interactive_loop(
 
                     action = args.pop(0).lower()
                     logging.info("Action = '{}'; args = {}".format(action, args))
+                    # Run the last action in the command line as a background job?
+                    if background and len(command_sequences) == 0:
+                        _start_job(speaker, action, args, use_local_speaker_list)
                     # Commands often requiring CTRL-C to exit are run in a subprocess
-                    if (
+                    elif (
                         action in ACTIONS_TO_EXEC
                         or action in ACTIONS_TO_EXEC_NO_SPEAKER
                     ):
-                        _exec_action(speaker.ip_address, action, args)
+                        _exec_action(_speaker_target(speaker), action, args)
                     else:
                         exit_code, output, error_msg = run_command(
                             speaker,
@@ -497,7 +540,7 @@ def interactive_loop(
                         else:
                             if output != "":
                                 print(output)
-                            if action == "rename":
+                            if action == "rename" and not is_speaker_set(speaker):
                                 speaker_name = speaker.get_speaker_info(refresh=True)[
                                     "zone_name"
                                 ]
@@ -524,12 +567,15 @@ def interactive_loop(
 SHELL_COMMANDS = [
     "actions",
     "alias ",
+    "cancel",
     "cd",
     "check_for_update",
     "docs",
     "exec",
     "exit",
+    "fg",
     "help",
+    "jobs",
     "pop",
     "push",
     "rescan",
@@ -605,14 +651,20 @@ This is SoCo-CLI interactive mode. Interactive commands are as follows:
                     aliases.
                     Aliases override existing actions and can contain
                     sequences of actions.
+    'cancel'     :  Cancel a background job: 'cancel <job_number>'. With no
+                    job number, cancels the most recent running job.
     'cd'         :  Change the working directory of the shell, e.g. 'cd ..'.
                     Note that on Windows, backslashes must be doubled, e.g.:
                     'cd C:\\'
     'check_for_update' : Check whether an update is available
     'docs'       :  Print a link to the online documentation.
     'exec'       :  Run a shell command, e.g.: 'exec ls -l'.
-    'exit'       :  Exit the shell.
+    'exit'       :  Exit the shell. Any running background jobs are cancelled.
+    'fg'         :  Wait for a background job to finish: 'fg <job_number>'.
+                    With no job number, waits for the most recent running job.
+                    CTRL-C cancels the job and returns to the shell prompt.
     'help'       :  Show this help message (available shell commands).
+    'jobs'       :  List background jobs, and their status.
     'pop'        :  Restore saved active speaker state.
     'push'       :  Save the current active speaker, and unset the active
                     speaker.
@@ -624,6 +676,7 @@ This is SoCo-CLI interactive mode. Interactive commands are as follows:
                     Use quotes when needed for the speaker name, e.g.,
                     'set "Front Reception"'. Unambiguous, partial,
                     case-insensitive matches are supported, e.g., 'set front'.
+                    A speaker set can also be used, e.g., 'set @downstairs'.
                     To unset the active speaker, omit the speaker name,
                     or just enter '0'.
     'sk'         :  Enters 'single keystroke' mode. (Also 'single-keystroke'.)
@@ -634,6 +687,11 @@ This is SoCo-CLI interactive mode. Interactive commands are as follows:
     If a speaker has been set in the shell, omit the speaker name from the
     action.
 
+    End a command line with ' &' to run its last action as a background job,
+    e.g.: 'kitchen wait_stop &', or 'lounge track_follow &'. Background jobs
+    run concurrently within the shell, which remains available for other
+    commands. Use 'jobs', 'fg' and 'cancel' to manage them.
+
     Use the arrow keys for command history and command editing.
     
     [Not Available on Windows] Use the TAB key for autocompletion of shell
@@ -726,7 +784,7 @@ class AliasProcessor:
             print("Error: {}".format(error))
             return False
 
-        cli_parser = CLIParser()
+        cli_parser = CLIParser(parallel_blocks=False)
         cli_parser.parse(action_elements)
         sequences = cli_parser.get_sequences()
 
@@ -841,14 +899,91 @@ def _exec(command_args: List[str]) -> None:
 CTRL_C_MSG_ISSUED = False
 
 
-def _exec_action(speaker_ip: str, action: str, args: List[str]) -> None:
+def _speaker_label(speaker: Union[SoCo, str]) -> str:
+    """The name of the active speaker, or speaker set."""
+    return speaker if isinstance(speaker, str) else speaker.player_name
+
+
+def _speaker_target(speaker: Union[SoCo, str]) -> str:
+    """Identifies the active speaker, or speaker set, in a 'sonos' command."""
+    return speaker if isinstance(speaker, str) else speaker.ip_address
+
+
+def _get_speaker_set(set_name: str) -> Optional[str]:
+    """Check that a speaker set is defined. Speaker sets are used in place of
+    speakers, as the set name."""
+    try:
+        speaker_set_members(set_name)
+    except ValueError as error:
+        print("Error: {}".format(error))
+        return None
+    return set_name
+
+
+def _start_job(
+    speaker: Union[SoCo, str], action: str, args: List[str], use_local: bool
+) -> None:
+    """Run an action as a background job."""
+    description = " ".join([_speaker_label(speaker), action] + args)
+    job = jobs.start_job(description, _run_job, speaker, action, args, use_local)
+    print("[{}] Started: {}".format(job.job_id, description))
+
+
+def _run_job(
+    speaker: Union[SoCo, str], action: str, args: List[str], use_local: bool
+) -> None:
+    if action in ["track_follow", "tf", "track_follow_compact", "tfc"]:
+        if is_speaker_set(speaker):
+            print("Error: '{}' can't be used with speaker sets".format(action))
+            return
+        track_follow(
+            speaker,
+            use_local_speaker_list=use_local,
+            break_on_pause=False,
+            compact=action in ["track_follow_compact", "tfc"],
+        )
+        return
+
+    exit_code, output, error_msg = run_command(
+        speaker, action, *args, use_local_speaker_list=use_local
+    )
+    if exit_code:
+        if error_msg != "":
+            print(error_msg)
+    elif output != "":
+        print(output)
+
+
+def _job_control(command: List[str]) -> None:
+    """Process the 'fg' and 'cancel' shell commands."""
+    job_id = None
+    if len(command) > 1:
+        try:
+            job_id = int(command[1].lstrip("%"))
+        except ValueError:
+            print("Error: Job number must be an integer")
+            return
+    job = jobs.get_job(job_id)
+    if job is None:
+        print("Error: No such job" if job_id else "Error: No running jobs")
+        return
+    if command[0].lower() == "cancel":
+        job.cancel()
+        print("[{}] Cancelling: {}".format(job.job_id, job.description))
+    else:
+        print("[{}] {}".format(job.job_id, job.description))
+        print("(Use CTRL-C to cancel the job and return to the Sonos shell prompt.)")
+        jobs.foreground(job)
+
+
+def _exec_action(speaker_target: str, action: str, args: List[str]) -> None:
     # Commands to run in a subprocess, to allow CTRL-C
     # to exit the subprocess only, and not the shell.
 
     if action in ACTIONS_TO_EXEC_NO_SPEAKER:
         command_line = [sys.argv[0], action, *args]
     else:
-        command_line = [sys.argv[0], speaker_ip, action, *args]
+        command_line = [sys.argv[0], speaker_target, action, *args]
 
     # Pass through logging option
     command_line.insert(1, LOG_SETTING)
@@ -890,7 +1025,7 @@ def _loop_in_command_sequences(command_sequences: RewindableList) -> bool:
 
 
 def _exec_loop(
-    speaker: Union[SoCo, None],
+    speaker: Union[SoCo, str, None],
     current_command: list,
     remaining_sequences: RewindableList,
     use_local: bool,
@@ -898,8 +1033,8 @@ def _exec_loop(
     """If there's a loop statement, run the actions in a subprocess.
 
     Args:
-        speaker (SoCo, None): The speaker to which the command is targeted, or
-            None if the speaker is in the command line.
+        speaker (SoCo, str, None): The speaker or speaker set to which the
+            command is targeted, or None if the speaker is in the command line.
         current_command (list): The current command sequence
         remaining_sequences (RewindableList): The remaining list of command sequences
         use_local (bool): use the local speaker list.
@@ -934,7 +1069,7 @@ def _exec_loop(
             if UNIX:
                 command_line = (
                     "export SPKR="
-                    + speaker.ip_address
+                    + _speaker_target(speaker)
                     + " && "
                     + sonos_command
                     + command_line
@@ -942,7 +1077,7 @@ def _exec_loop(
             elif WINDOWS:
                 command_line = (
                     'set "SPKR='
-                    + speaker.ip_address
+                    + _speaker_target(speaker)
                     + '" && '
                     + sonos_command
                     + command_line
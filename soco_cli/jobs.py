@@ -0,0 +1,151 @@
+"""Manages background jobs for the interactive shell.
+
+Jobs run in threads within the shell process, so they share speaker objects,
+the speaker cache and event subscriptions with the shell and with each other.
+Cancellation is cooperative: long-running actions check for cancellation
+while they wait.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from soco_cli.utils import set_cancel_event, set_foreground_cancel_event
+
+
+class Job:
+    def __init__(self, job_id: int, description: str, function: Callable, *args):
+        self.job_id = job_id
+        self.description = description
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+        self.error = None  # type: Optional[Exception]
+        self._function = function
+        self._args = args
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="Job-{}".format(job_id), daemon=True
+        )
+
+    def start(self) -> None:
+        logging.info("Starting job [{}]: '{}'".format(self.job_id, self.description))
+        self._thread.start()
+
+    def _run(self) -> None:
+        set_cancel_event(self._cancel_event)
+        try:
+            self._function(*self._args)
+        except Exception as e:
+            logging.info("Job [{}] failed: {}".format(self.job_id, e))
+            self.error = e
+        self.end_time = time.time()
+        logging.info("Job [{}] finished".format(self.job_id))
+
+    def cancel(self) -> None:
+        logging.info("Cancelling job [{}]".format(self.job_id))
+        self._cancel_event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the job to finish. Returns True if it has finished."""
+        self._thread.join(timeout)
+        return not self.is_running
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        return self._cancel_event
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def status(self) -> str:
+        if self.is_running:
+            return "Cancelling" if self.is_cancelled else "Running"
+        if self.is_cancelled:
+            return "Cancelled"
+        if self.error:
+            return "Failed ({})".format(self.error)
+        return "Done"
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self.end_time if self.end_time else time.time()
+        return end_time - self.start_time
+
+
+class JobManager:
+    def __init__(self):
+        self._jobs = OrderedDict()  # type: OrderedDict
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def start_job(self, description: str, function: Callable, *args) -> Job:
+        with self._lock:
+            job = Job(self._next_id, description, function, *args)
+            self._jobs[job.job_id] = job
+            self._next_id += 1
+        job.start()
+        return job
+
+    def get_job(self, job_id: Optional[int] = None) -> Optional[Job]:
+        """Return the job with 'job_id', or the most recent running job if no
+        job_id is supplied."""
+        if job_id is not None:
+            return self._jobs.get(job_id, None)
+        running = self.running_jobs()
+        return running[-1] if running else None
+
+    def running_jobs(self) -> List[Job]:
+        return [job for job in self._jobs.values() if job.is_running]
+
+    def foreground(self, job: Job) -> None:
+        """Wait for a job to finish. CTRL-C cancels the job."""
+        logging.info("Bringing job [{}] to the foreground".format(job.job_id))
+        set_foreground_cancel_event(job.cancel_event)
+        try:
+            while not job.wait(timeout=0.5):
+                pass
+        finally:
+            set_foreground_cancel_event(None)
+
+    def cancel_all(self, timeout: float = 5.0) -> None:
+        for job in self.running_jobs():
+            job.cancel()
+        for job in self.running_jobs():
+            job.wait(timeout)
+
+    def print_jobs(self) -> None:
+        if len(self._jobs) == 0:
+            print("No jobs")
+            return
+        print()
+        for job in self._remove_finished_jobs(all_jobs=True):
+            print(
+                "  [{}] {:<12} {:>7.0f}s   {}".format(
+                    job.job_id, job.status, job.elapsed, job.description
+                )
+            )
+        print()
+
+    def report_finished_jobs(self) -> None:
+        """Print and remove finished jobs, as a shell does before showing the
+        prompt."""
+        for job in self._remove_finished_jobs():
+            print("[{}] {}: {}".format(job.job_id, job.status, job.description))
+
+    def _remove_finished_jobs(self, all_jobs: bool = False) -> List[Job]:
+        """Remove finished jobs. Returns the finished jobs, or all jobs if
+        'all_jobs' is True."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            finished = [job for job in jobs if not job.is_running]
+            for job in finished:
+                del self._jobs[job.job_id]
+        return jobs if all_jobs else finished
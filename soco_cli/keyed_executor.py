@@ -0,0 +1,65 @@
+"""A thread pool executor that runs tasks with the same key in order.
+
+Tasks submitted with the same key (e.g., a speaker name) are run one at a
+time, in the order in which they were submitted. Tasks with different keys
+run in parallel, up to the maximum number of worker threads.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+
+class KeyedExecutor:
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queues = {}  # type: Dict[Hashable, deque]
+
+    def submit(self, key: Hashable, function: Callable, *args: Any) -> Future:
+        """Submit a task to run after all previously submitted tasks with the
+        same key have finished.
+
+        Returns:
+            Future: A future representing the result of the task.
+        """
+        future = Future()  # type: Future
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # A worker is already processing this key's tasks
+                queue.append((future, function, args))
+                return future
+            self._queues[key] = deque()
+        self._executor.submit(self._run, key, future, function, args)
+        return future
+
+    def _run(self, key: Hashable, future: Future, function: Callable, args) -> None:
+        """Run a task, then the remaining tasks queued for the same key."""
+        while True:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = function(*args)
+                except BaseException as e:
+                    logging.info("Task for key '{}' failed: {}".format(key, e))
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._lock:
+                queue = self._queues[key]
+                if len(queue) == 0:
+                    del self._queues[key]
+                    return
+                future, function, args = queue.popleft()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
@@ -0,0 +1,208 @@
+"""Per-speaker request limits.
+
+Sonos devices, especially older ones, can drop or reject requests that arrive
+in bursts, e.g., from concurrent HTTP API requests or parallel command
+sequences. All SoCo requests made by SoCo-CLI actions (see 'soap_requests')
+pass through two limiters:
+
+    - The device limiter, keyed by the IP address of the speaker receiving the
+      request.
+    - The coordinator limiter, keyed by the IP address of the speaker's group
+      coordinator, when the coordinator is already known. Requests to any
+      member of a group are subject to the group's limits.
+
+Alarm changes are also made one at a time for each household, and paced to
+allow the speakers to stabilise, using the alarms limiter, keyed by household
+ID.
+
+Each limiter restricts the number of requests in flight to each speaker, and
+paces requests using a token bucket: a burst of up to 'burst' requests is sent
+immediately, after which requests are sent at up to 'rate' per second.
+
+Functions registered using 'add_request_observer()' are told about each
+request sent, e.g., to count requests.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from soco import SoCo  # type: ignore
+
+DEVICE = "device"
+COORDINATOR = "coordinator"
+ALARMS = "alarms"
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning the time to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.burst), self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class Limiter:
+    """Limits the requests in flight to, and the request rate for, each key.
+
+    'max_in_flight', 'rate' and 'burst' can be None, for no limit.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._semaphores = {}  # type: Dict[str, threading.BoundedSemaphore]
+        self._buckets = {}  # type: Dict[str, _TokenBucket]
+
+    def set_limits(
+        self,
+        max_in_flight: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+    ) -> None:
+        """Replace the limits. Requests already waiting keep the old limits."""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            self.rate = rate
+            self.burst = burst
+            self._semaphores.clear()
+            self._buckets.clear()
+
+    @contextmanager
+    def slot(self, key: str):
+        """Wait until a request to 'key' is allowed, and hold its in-flight
+        slot for the duration of the 'with' block."""
+        with self._lock:
+            semaphore = None  # type: Optional[threading.BoundedSemaphore]
+            if self.max_in_flight is not None:
+                semaphore = self._semaphores.get(key)
+                if semaphore is None:
+                    semaphore = threading.BoundedSemaphore(self.max_in_flight)
+                    self._semaphores[key] = semaphore
+            bucket = None  # type: Optional[_TokenBucket]
+            if self.rate is not None:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    burst = self.burst if self.burst is not None else 1
+                    bucket = _TokenBucket(self.rate, burst)
+                    self._buckets[key] = bucket
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if bucket is not None:
+                delay = bucket.reserve()
+                if delay > 0:
+                    logging.info("Pacing request to {}: {:.2f}s".format(key, delay))
+                    time.sleep(delay)
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+
+_limiters = {
+    DEVICE: Limiter(max_in_flight=4, rate=20.0, burst=10),
+    COORDINATOR: Limiter(max_in_flight=6),
+    ALARMS: Limiter(max_in_flight=1, rate=1.0, burst=1),
+}  # type: Dict[str, Limiter]
+
+
+def limiter(kind: str) -> Limiter:
+    """Return the 'device', 'coordinator' or 'alarms' limiter."""
+    return _limiters[kind]
+
+
+def set_limits(
+    kind: str,
+    max_in_flight: Optional[int] = None,
+    rate: Optional[float] = None,
+    burst: Optional[int] = None,
+) -> None:
+    """Change the limits for the 'device', 'coordinator' or 'alarms'
+    limiter."""
+    _limiters[kind].set_limits(max_in_flight=max_in_flight, rate=rate, burst=burst)
+
+
+def _known_coordinator(speaker: SoCo) -> Optional[SoCo]:
+    """Return the speaker's coordinator, if it's already known, without
+    making a network request."""
+    for zone_group_state in list(SoCo.zone_group_states.values()):
+        for group in list(zone_group_state.groups):
+            if speaker in group:
+                return group.coordinator
+    return None
+
+
+# The functions called after each request is sent
+_request_observers = []  # type: List[Callable]
+
+
+def add_request_observer(observer: Callable) -> None:
+    """Register a function to be called after each request is sent to a
+    speaker, with the arguments (service, action, duration, error), where
+    'duration' is in seconds and 'error' is the exception raised by the
+    request, or None. Observers are called by the requesting thread."""
+    _request_observers.append(observer)
+
+
+# Set while the current thread holds the limiter slots for a request
+_in_request = threading.local()
+
+
+def _send_observed(send_command, service, action, args=None, cache=None, **kwargs):
+    if not _request_observers:
+        return send_command(service, action, args=args, cache=cache, **kwargs)
+    error = None
+    start_time = time.monotonic()
+    try:
+        return send_command(service, action, args=args, cache=cache, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        duration = time.monotonic() - start_time
+        for observer in list(_request_observers):
+            observer(service, action, duration, error)
+
+
+def send_limited(send_command, service, action, args=None, cache=None, **kwargs):
+    """Send a request using 'send_command', once the request limits for the
+    speaker (and its coordinator) allow it. Used by 'soap_requests'."""
+    send = partial(_send_observed, send_command)
+    if getattr(_in_request, "active", False):
+        return send(service, action, args=args, cache=cache, **kwargs)
+    speaker = service.soco
+    coordinator = _known_coordinator(speaker)
+    _in_request.active = True
+    try:
+        with _limiters[DEVICE].slot(speaker.ip_address):
+            if coordinator is None:
+                return send(service, action, args=args, cache=cache, **kwargs)
+            with _limiters[COORDINATOR].slot(coordinator.ip_address):
+                return send(service, action, args=args, cache=cache, **kwargs)
+    finally:
+        _in_request.active = False
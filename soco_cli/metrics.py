@@ -0,0 +1,242 @@
+"""Metrics in the Prometheus text exposition format.
+
+Used by the HTTP API server's '/metrics' endpoint. Counters, gauges and
+histograms are kept in a 'Registry'; values can also be supplied by functions
+that are called when the metrics are rendered.
+
+Importing this module also counts the SOAP requests sent to speakers by
+actions, using a request observer registered with the limiter, so only
+requests that are actually sent are counted.
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from soco_cli import limiter
+
+# The default histogram buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric:
+    """A metric. Counter and gauge values can instead be supplied by a
+    function returning a map of labels tuple -> value."""
+
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._function = function
+        self._values = {}  # type: Dict
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise ValueError(
+                "Metric '{}' requires labels {}".format(self.name, self.label_names)
+            )
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, _escape_help(self.help_text)),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            values = sorted(self._function().items())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [self._sample(self.name, key, value) for key, value in values]
+
+    def _sample(
+        self,
+        name: str,
+        labels: Tuple[str, ...],
+        value: float,
+        extra: Optional[Tuple[str, str]] = None,
+    ) -> str:
+        pairs = list(zip(self.label_names, labels))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return "{} {}".format(name, _format_value(value))
+        return "{}{{{}}} {}".format(
+            name,
+            ",".join('{}="{}"'.format(k, _escape_label(v)) for k, v in pairs),
+            _format_value(value),
+        )
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = entry
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return 0 if entry is None else entry[2]
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(entry[0]), entry[1], entry[2]))
+                for key, entry in self._values.items()
+            )
+        lines = []
+        for key, (bucket_counts, total, count) in values:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(
+                    self._sample(
+                        self.name + "_bucket",
+                        key,
+                        bucket_count,
+                        ("le", _format_value(bound)),
+                    )
+                )
+            lines.append(
+                self._sample(self.name + "_bucket", key, count, ("le", "+Inf"))
+            )
+            lines.append(self._sample(self.name + "_sum", key, total))
+            lines.append(self._sample(self.name + "_count", key, count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []  # type: List[_Metric]
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(
+        self, name: str, help_text: str, label_names=(), function=None
+    ) -> Counter:
+        return self.register(Counter(name, help_text, label_names, function))
+
+    def gauge(self, name: str, help_text: str, label_names=(), function=None) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names, function))
+
+    def histogram(
+        self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self) -> str:
+        lines = []  # type: List[str]
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+# SOAP requests sent to speakers
+REGISTRY = Registry()
+SOAP_REQUESTS = REGISTRY.counter(
+    "sococli_soap_requests_total",
+    "SOAP requests sent to speakers",
+    ["speaker_ip", "service", "action"],
+)
+SOAP_ERRORS = REGISTRY.counter(
+    "sococli_soap_errors_total",
+    "SOAP requests that failed",
+    ["speaker_ip", "service", "action"],
+)
+SOAP_DURATION = REGISTRY.histogram(
+    "sococli_soap_request_duration_seconds",
+    "The time taken by SOAP requests",
+    ["speaker_ip"],
+)
+
+
+def _count_request(service, action: str, duration: float, error) -> None:
+    labels = (service.soco.ip_address, service.service_type, action)
+    SOAP_REQUESTS.inc(*labels)
+    if error is not None:
+        SOAP_ERRORS.inc(*labels)
+    SOAP_DURATION.observe(duration, service.soco.ip_address)
+
+
+limiter.add_request_observer(_count_request)
@@ -0,0 +1,430 @@
+"""Compile command sequences into an execution plan.
+
+Planning is done once, before any commands are run: speaker names are resolved
+to SoCo objects, actions are bound to their processing functions, and the
+numbers of parameters supplied are checked. The 'loop' actions then re-execute
+the plan without repeating this work.
+
+Parallel blocks are planned as a step containing one plan per branch.
+
+The planner can also find runs of consecutive actions that target different
+speakers. These are independent of each other, and can be run concurrently.
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+from soco import SoCo  # type: ignore
+
+from soco_cli.action_processor import SonosFunction, actions
+from soco_cli.api import get_all_speakers
+from soco_cli.cmd_parser import ParallelSequences
+from soco_cli.speaker_sets import is_speaker_set, speaker_set_members
+from soco_cli.utils import (
+    check_parameter_count,
+    convert_to_seconds,
+    create_time_from_str,
+    get_speaker,
+    local_speaker_list,
+)
+
+LOOP_ACTIONS = ["loop", "loop_for", "loop_until", "loop_to_start"]
+WAIT_ACTIONS = ["wait", "wait_for", "wait_until"]
+TRACK_FOLLOW_ACTIONS = ["track_follow", "tf", "track_follow_compact", "tfc"]
+
+# Modifiers that take another action as their parameters
+CONDITIONAL_ACTIONS = [
+    "if_stopped",
+    "if_playing",
+    "if_coordinator",
+    "if_not_coordinator",
+    "if_queue",
+    "if_no_queue",
+]
+
+# Actions that must not run concurrently with neighbouring actions, either
+# because they wait for something to happen, or because they operate on
+# speakers other than the target speaker
+SEQUENTIAL_ACTIONS = [
+    "wait",
+    "wait_for",
+    "wait_until",
+    "wait_start",
+    "wait_stop",
+    "wait_stop_not_pause",
+    "wsnp",
+    "wait_stopped_for",
+    "wsf",
+    "wait_stopped_for_not_pause",
+    "wsfnp",
+    "wait_end_track",
+    "play_file",
+    "play_local_file",
+    "play_m3u",
+    "play_local_m3u",
+    "play_directory",
+    "play_dir",
+    "play_cd",
+    "group",
+    "g",
+    "multi_group",
+    "mg",
+    "ungroup",
+    "ungroup_all",
+    "ungroup_all_in_group",
+    "ugaig",
+    "party_mode",
+    "party",
+    "pair",
+    "unpair",
+    "transfer_playback",
+    "transfer_to",
+    "transfer",
+    "pause_all",
+    "stop_all",
+]
+
+
+class ErrorStep:
+    """A command that can't be run, with the reason why."""
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class WaitStep:
+    """A 'wait', 'wait_for' or 'wait_until' command."""
+
+    def __init__(self, sequence: List[str]):
+        self.sequence = sequence
+
+
+class LoopStep:
+    """A 'loop' action. The parameter is the number of iterations for 'loop'
+    (None to loop forever), the duration in seconds for 'loop_for', and the
+    stop time string for 'loop_until'."""
+
+    def __init__(self, action: str, parameter=None):
+        self.action = action
+        self.parameter = parameter
+
+
+class ActionStep:
+    """An action to be performed on a speaker, or on all the speakers in
+    'all_speakers' (for '_all_' and speaker sets)."""
+
+    def __init__(
+        self,
+        speaker_name: str,
+        speaker: Optional[SoCo],
+        action: str,
+        args: List[str],
+        sonos_function: SonosFunction,
+        all_speakers: Optional[List[SoCo]] = None,
+    ):
+        self.speaker_name = speaker_name
+        self.speaker = speaker
+        self.action = action
+        self.args = args
+        self.sonos_function = sonos_function
+        self.all_speakers = all_speakers
+
+
+class TrackFollowStep:
+    """A 'track_follow' action."""
+
+    def __init__(self, speaker_name: str, speaker: Optional[SoCo], compact: bool):
+        self.speaker_name = speaker_name
+        self.speaker = speaker
+        self.compact = compact
+
+
+class ParallelStep:
+    """A parallel block. Each branch is a plan of its own."""
+
+    def __init__(self, branches: List["Plan"]):
+        self.branches = branches
+
+
+class Plan:
+    def __init__(self):
+        self.steps = []  # type: List
+        # Runs of independent steps that can be run concurrently, as a map of
+        # start index -> end index (exclusive)
+        self.concurrent_runs = {}  # type: Dict[int, int]
+
+    @property
+    def errors(self) -> List[str]:
+        errors = []
+        for step in self.steps:
+            if isinstance(step, ErrorStep):
+                errors.append(step.message)
+            elif isinstance(step, ParallelStep):
+                for branch in step.branches:
+                    errors.extend(branch.errors)
+        return errors
+
+
+class Planner:
+    def __init__(
+        self, use_local_speaker_list: bool = False, env_speaker: Optional[str] = None
+    ):
+        self._use_local_speaker_list = use_local_speaker_list
+        self._env_speaker = env_speaker
+        self._speakers = {}  # type: Dict[str, Optional[SoCo]]
+        self._all_speakers = None  # type: Optional[List[SoCo]]
+
+    def plan(self, sequences: List[List[str]], find_concurrent: bool = False) -> Plan:
+        """Compile a list of command sequences into a plan.
+
+        Args:
+            sequences (list): The command sequences, each of which is a list of
+                strings of the form [speaker, action, arg, ...].
+            find_concurrent (bool): Whether to find runs of steps that can be
+                run concurrently.
+        """
+        plan = self._plan_sequences(sequences, find_concurrent)
+        logging.info(
+            "Planned {} step(s), with {} error(s) and {} concurrent run(s)".format(
+                len(plan.steps), len(plan.errors), len(plan.concurrent_runs)
+            )
+        )
+        return plan
+
+    def _plan_sequences(self, sequences: List, find_concurrent: bool) -> Plan:
+        plan = Plan()
+        for sequence in sequences:
+            if isinstance(sequence, ParallelSequences):
+                plan.steps.append(
+                    ParallelStep([
+                        self._plan_sequences(branch, find_concurrent)
+                        for branch in sequence.branches
+                    ])
+                )
+            else:
+                plan.steps.append(self._plan_step(sequence))
+        if find_concurrent:
+            self._find_concurrent_runs(plan)
+        return plan
+
+    def resolve_speaker(self, speaker_name: str) -> Optional[SoCo]:
+        """Look up a speaker, caching the result. Speakers that aren't found
+        are looked up again on the next call."""
+        key = speaker_name.lower()
+        speaker = self._speakers.get(key)
+        if speaker is None:
+            try:
+                speaker = get_speaker(speaker_name, self._use_local_speaker_list)
+            except Exception as e:
+                logging.info(
+                    "Unable to resolve speaker '{}': {}".format(speaker_name, e)
+                )
+                speaker = None
+            self._speakers[key] = speaker
+        return speaker
+
+    def resolve_all_speakers(self) -> List[SoCo]:
+        """Find all visible speakers, caching the result."""
+        if self._all_speakers is None:
+            if self._use_local_speaker_list:
+                speakers = local_speaker_list().get_all_speakers()
+            else:
+                speakers = get_all_speakers(use_scan=True)
+            self._all_speakers = [s for s in speakers or [] if s.is_visible]
+        return self._all_speakers
+
+    def _plan_step(self, sequence: List[str]):
+        speaker_name = sequence[0]
+
+        if speaker_name.lower() in LOOP_ACTIONS:
+            return _plan_loop(speaker_name.lower(), sequence[1:])
+
+        if speaker_name in WAIT_ACTIONS:
+            return WaitStep(sequence)
+
+        # Use the speaker name from the environment?
+        if self._env_speaker:
+            logging.info(
+                "Getting speaker name '{}' from the $SPKR environment variable".format(
+                    self._env_speaker
+                )
+            )
+            sequence = [self._env_speaker] + sequence
+            speaker_name = self._env_speaker
+
+        if len(sequence) < 2:
+            return ErrorStep(
+                "At least 2 parameters required in action sequence '{}'; did you"
+                " supply a speaker name?".format(sequence)
+            )
+        action = sequence[1].lower()
+        args = sequence[2:]
+
+        if action in TRACK_FOLLOW_ACTIONS:
+            if is_speaker_set(speaker_name):
+                return ErrorStep(
+                    "Action '{}' can't be used with speaker sets".format(action)
+                )
+            if len(args) > 0:
+                return ErrorStep("Action '{}' takes no parameters".format(action))
+            return TrackFollowStep(
+                speaker_name,
+                self.resolve_speaker(speaker_name),
+                action in ["track_follow_compact", "tfc"],
+            )
+
+        sonos_function = actions.get(action, None)
+        if sonos_function is None:
+            hint = " ... missing spaces around ':'?" if ":" in action else ""
+            return ErrorStep("Action '{}' not recognised{}".format(action, hint))
+        message = _check_action(action, args)
+        if message:
+            return ErrorStep(message)
+
+        if speaker_name.lower() == "_all_":
+            return ActionStep(
+                speaker_name,
+                None,
+                action,
+                args,
+                sonos_function,
+                all_speakers=self.resolve_all_speakers(),
+            )
+        if is_speaker_set(speaker_name):
+            return self._plan_speaker_set_step(
+                speaker_name, action, args, sonos_function
+            )
+        return ActionStep(
+            speaker_name,
+            self.resolve_speaker(speaker_name),
+            action,
+            args,
+            sonos_function,
+        )
+
+    def resolve_speaker_set(self, set_name: str) -> List[SoCo]:
+        """Look up the speakers in a speaker set.
+
+        Raises:
+            ValueError: If the set isn't defined, or if a speaker isn't found.
+        """
+        speakers = []
+        for member in speaker_set_members(set_name):
+            speaker = self.resolve_speaker(member)
+            if speaker is None:
+                raise ValueError(
+                    "Speaker '{}' in set '{}' not found".format(member, set_name)
+                )
+            speakers.append(speaker)
+        return speakers
+
+    def _plan_speaker_set_step(
+        self,
+        set_name: str,
+        action: str,
+        args: List[str],
+        sonos_function: SonosFunction,
+    ):
+        try:
+            speakers = self.resolve_speaker_set(set_name)
+        except ValueError as e:
+            return ErrorStep(str(e))
+        return ActionStep(
+            set_name, None, action, args, sonos_function, all_speakers=speakers
+        )
+
+    def _find_concurrent_runs(self, plan: Plan) -> None:
+        """Find runs of consecutive action steps that target different speakers
+        (and different groups), and which can therefore run concurrently."""
+        run_start = 0
+        run_targets = set()
+        for index, step in enumerate(plan.steps + [None]):
+            targets = _step_targets(step)
+            if targets is None or not run_targets.isdisjoint(targets):
+                # End the current run
+                if index - run_start > 1:
+                    plan.concurrent_runs[run_start] = index
+                run_start = index if targets is not None else index + 1
+                run_targets = set()
+            if targets is not None:
+                run_targets.update(targets)
+
+
+def _plan_loop(action: str, args: List[str]):
+    if action == "loop_to_start":
+        if len(args) != 0:
+            return ErrorStep("Action 'loop_to_start' takes no parameters")
+        return LoopStep(action)
+
+    if action == "loop":
+        if len(args) == 0:
+            return LoopStep(action)
+        try:
+            iterations = int(args[0])
+            if len(args) != 1 or iterations <= 0:
+                raise ValueError
+        except ValueError:
+            return ErrorStep(
+                "Action 'loop' takes no parameters, or a number of iterations (> 0)"
+            )
+        return LoopStep(action, iterations)
+
+    if len(args) != 1:
+        return ErrorStep(
+            "Action '{}' requires one parameter (check spaces around the ':'"
+            " separator)".format(action)
+        )
+
+    if action == "loop_for":
+        try:
+            return LoopStep(action, convert_to_seconds(args[0]))
+        except ValueError:
+            return ErrorStep("Action 'loop_for' requires one parameter (duration >= 0)")
+
+    # 'loop_until'
+    try:
+        create_time_from_str(args[0])
+    except ValueError:
+        return ErrorStep("Action 'loop_until' requires one parameter (stop time)")
+    return LoopStep(action, args[0])
+
+
+def _check_action(action: str, args: List[str]) -> Optional[str]:
+    """Check the parameter count of an action, and of the action controlled by
+    any conditional modifiers. Returns an error message, or None."""
+    while True:
+        message = check_parameter_count(
+            actions[action].processing_function, action, args
+        )
+        if message or action not in CONDITIONAL_ACTIONS:
+            return message
+        action = args[0].lower()
+        args = args[1:]
+        if action not in actions:
+            return "Action '{}' not recognised".format(action)
+
+
+def _effective_action(action: str, args: List[str]) -> str:
+    """Skip over any conditional modifiers to find the action to be run."""
+    while action in CONDITIONAL_ACTIONS and len(args) > 0:
+        action = args[0].lower()
+        args = args[1:]
+    return action
+
+
+def _step_targets(step) -> Optional[set]:
+    """Return the IP addresses of the speakers affected by a step, or None if
+    the step can't be run concurrently with other steps."""
+    if not isinstance(step, ActionStep) or step.all_speakers is not None:
+        return None
+    if step.speaker is None:
+        return None
+    if _effective_action(step.action, step.args) in SEQUENTIAL_ACTIONS:
+        return None
+    try:
+        # Actions can be redirected to the group coordinator, so treat the
+        # whole group as the target
+        return {member.ip_address for member in step.speaker.group.members}
+    except Exception as e:
+        logging.info("Unable to get group for '{}': {}".format(step.speaker_name, e))
+        return None
@@ -18,6 +18,7 @@ from RangeHTTPServer import RangeRequestHandler  # type: ignore
 from soco import SoCo  # type: ignore
 
 from soco_cli.utils import (
+    cancelled,
     error_report,
     event_unsubscribe,
     forget_event_sub,
@@ -182,6 +183,9 @@ def wait_until_stopped(speaker: SoCo, uri: str, end_on_pause: bool):
         return
 
     while True:
+        if cancelled():
+            logging.info("Cancelled while waiting for playback to stop")
+            break
         try:
             event = sub.events.get(timeout=1.0)
             state = event.variables["transport_state"]
@@ -272,6 +276,9 @@ def play_local_file(speaker: SoCo, pathname: str, end_on_pause: bool = False) ->
     time.sleep(1.0)
     logging.info("Waiting for playback to stop")
     wait_until_stopped(speaker, uri, end_on_pause)
+    if cancelled():
+        logging.info("Stopping speaker '{}'".format(speaker.player_name))
+        speaker.stop()
     logging.info("Playback stopped ... terminating web server")
     httpd.shutdown()
     logging.info("Web server terminated")
@@ -13,7 +13,7 @@ from soco import SoCo  # type: ignore
 
 from soco_cli.m3u_parser import parse_m3u
 from soco_cli.play_local_file import is_supported_type, play_local_file
-from soco_cli.utils import error_report
+from soco_cli.utils import cancelled, error_report, release_output
 
 
 def interaction_manager(speaker_ip: str) -> None:
@@ -75,7 +75,7 @@ def play_file_list(speaker: SoCo, tracks: List[str], options: str = "") -> bool:
 
     if options != "":
         # Grab back stdout from api.run_command()
-        sys.stdout = sys.__stdout__
+        release_output()
 
     if "r" in options:
         # Choose a single random track
@@ -105,6 +105,10 @@ def play_file_list(speaker: SoCo, tracks: List[str], options: str = "") -> bool:
 
     zero_pad = len(str(len(tracks)))
     for index, track in enumerate(tracks):
+        if cancelled():
+            logging.info("Cancelled ... not playing remaining files")
+            break
+
         if not path.exists(track):
             print("Error: file not found:", track)
             continue
@@ -0,0 +1,91 @@
+"""Memoisation of speaker reads within a single action.
+
+Processing an action often reads the same values from a speaker more than
+once, e.g., the queue size or the current transport state. While a read scope
+is active, the results of read requests ('Get...' and 'Browse' SOAP actions)
+made by the current thread's action (see 'soap_requests') are remembered, and repeated reads are answered
+without contacting the speaker. Any other request (a write) forgets all the
+remembered results. Results are also forgotten after 'MEMO_MAX_AGE' seconds,
+so that polling loops always see fresh values.
+
+The number of requests saved is logged at the 'debug' level when the scope
+ends.
+"""
+
+import copy
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# The maximum age (in seconds) of a remembered result
+MEMO_MAX_AGE = 1.0
+
+READ_ACTION_PREFIXES = ("Get", "Browse")
+
+
+class _ReadScope:
+    def __init__(self, name: str):
+        self.name = name
+        # Request key -> (result, time recorded)
+        self.results = {}  # type: dict
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+
+_scope = threading.local()
+
+
+@contextmanager
+def read_scope(name: str, enabled: bool = True):
+    """Memoise the reads made by the current thread for the duration of the
+    'with' block. Nested scopes share the outermost scope."""
+    if not enabled or getattr(_scope, "scope", None) is not None:
+        yield
+        return
+    scope = _ReadScope(name)
+    _scope.scope = scope
+    try:
+        yield
+    finally:
+        _scope.scope = None
+        if scope.hits or scope.misses:
+            logging.debug(
+                "Read memoisation for '{}': {} request(s) saved, {} read(s) and {}"
+                " write(s) sent".format(name, scope.hits, scope.misses, scope.writes)
+            )
+
+
+def send_memoised(send_command, service, action, args=None, cache=None, **kwargs):
+    """Send a request using 'send_command', unless it's a read that has
+    already been made in the current read scope. Used by 'soap_requests'."""
+    scope = getattr(_scope, "scope", None)
+    if scope is None:
+        return send_command(service, action, args=args, cache=cache, **kwargs)
+
+    if not action.startswith(READ_ACTION_PREFIXES):
+        scope.writes += 1
+        scope.results.clear()
+        return send_command(service, action, args=args, cache=cache, **kwargs)
+
+    key = (
+        service.soco.ip_address,
+        service.service_type,
+        action,
+        repr(args),
+        repr(sorted(kwargs.items())),
+    )
+    entry = scope.results.get(key)
+    if entry is not None and time.monotonic() - entry[1] <= MEMO_MAX_AGE:
+        scope.hits += 1
+        return _copy(entry[0])
+    scope.misses += 1
+    result = send_command(service, action, args=args, cache=cache, **kwargs)
+    scope.results[key] = (result, time.monotonic())
+    return _copy(result)
+
+
+def _copy(result):
+    # Results are dicts of strings; callers may modify them
+    return copy.copy(result)
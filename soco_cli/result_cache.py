@@ -0,0 +1,230 @@
+"""A cache of the results of read-only actions, invalidated by speaker events.
+
+Used by the HTTP API server to answer frequently polled queries, such as
+'volume', 'state' and 'shuffle', without contacting the speaker. A result is
+only cached while the server holds event subscriptions for the speaker
+services it depends on:
+
+    RenderingControl (on the speaker)      volume, mute, bass, treble, ...
+    AVTransport (on the group coordinator) state, shuffle, repeat, ...
+    ZoneGroupTopology (on the coordinator) as above, for group changes
+
+Any event from a service forgets the results that depend on it, and any
+action that isn't a read forgets all results. Results are also forgotten after
+'RESULT_MAX_AGE' seconds, in case events are lost.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from soco import SoCo  # type: ignore
+
+from soco_cli.action_processor import READ, action_class, actions
+
+# The maximum age (in seconds) of a cached result
+RESULT_MAX_AGE = 60.0
+
+RENDERING_CONTROL = "renderingControl"
+AV_TRANSPORT = "avTransport"
+ZONE_GROUP_TOPOLOGY = "zoneGroupTopology"
+
+# The actions whose results can be cached (when used without parameters), and
+# the services on whose events they depend. 'track' isn't included: its
+# playback position changes without any event being sent.
+CACHED_ACTIONS = {
+    "volume": [RENDERING_CONTROL],
+    "v": [RENDERING_CONTROL],
+    "vol": [RENDERING_CONTROL],
+    "mute": [RENDERING_CONTROL],
+    "bass": [RENDERING_CONTROL],
+    "treble": [RENDERING_CONTROL],
+    "loudness": [RENDERING_CONTROL],
+    "balance": [RENDERING_CONTROL],
+    "night_mode": [RENDERING_CONTROL],
+    "night": [RENDERING_CONTROL],
+    "dialog_mode": [RENDERING_CONTROL],
+    "dialogue_mode": [RENDERING_CONTROL],
+    "dialog": [RENDERING_CONTROL],
+    "state": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "playback": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "playback_state": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "status": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "shuffle": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "sh": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "repeat": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "rpt": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "play_mode": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "mode": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "cross_fade": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "crossfade": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "fade": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "queue_position": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+    "qp": [AV_TRANSPORT, ZONE_GROUP_TOPOLOGY],
+}
+
+CachedResult = NamedTuple(
+    "CachedResult",
+    [
+        ("player_name", str),
+        ("exit_code", int),
+        ("output", str),
+        ("data", Any),
+        ("error_msg", str),
+        ("recorded", float),
+    ],
+)
+
+
+class ResultCache:
+    def __init__(self, max_age: float = RESULT_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # (speaker name, action) -> (result, dependencies)
+        self._results = {}  # type: Dict[Tuple[str, str], Tuple[CachedResult, List]]
+        # (IP address, service) -> event subscription
+        self._subscriptions = {}  # type: Dict[Tuple[str, str], Any]
+        # Incremented whenever results are forgotten
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(action: str, args) -> bool:
+        return len(args) == 0 and action.lower() in CACHED_ACTIONS
+
+    @staticmethod
+    def is_write(action: str, args) -> bool:
+        sonos_function = actions.get(action.lower())
+        if sonos_function is None:
+            return False
+        return action_class(sonos_function, list(args)) != READ
+
+    @property
+    def generation(self) -> int:
+        """A value that changes whenever results are forgotten. Take it before
+        running an action, and pass it to 'store()'."""
+        return self._generation
+
+    def get(self, speaker_name: str, action: str) -> Optional[CachedResult]:
+        key = (speaker_name.lower(), action.lower())
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                result, dependencies = entry
+                if time.monotonic() - result.recorded <= self.max_age and all(
+                    self._subscriptions.get(d) is not None for d in dependencies
+                ):
+                    self.hits += 1
+                    return result
+                del self._results[key]
+            self.misses += 1
+            return None
+
+    def watch(self, speaker: SoCo, action: str) -> Optional[List[Tuple[str, str]]]:
+        """Subscribe to the events on which the action's result depends, if
+        not already subscribed. Call before running the action. Returns the
+        dependencies to pass to 'store()', or None if the subscriptions fail.
+        Makes network calls."""
+        services = CACHED_ACTIONS[action.lower()]
+        if AV_TRANSPORT in services and not speaker.is_coordinator:
+            speaker = speaker.group.coordinator
+        for service in services:
+            if not self._watch(speaker, service):
+                return None
+        return [(speaker.ip_address, service) for service in services]
+
+    def store(
+        self,
+        speaker_name: str,
+        action: str,
+        result: CachedResult,
+        dependencies: List[Tuple[str, str]],
+        generation: int,
+    ) -> None:
+        """Cache a result, unless results have been forgotten since
+        'generation' was taken."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._results[(speaker_name.lower(), action.lower())] = (
+                result,
+                dependencies,
+            )
+
+    def invalidate(self, dependency: Optional[Tuple[str, str]] = None) -> None:
+        """Forget the results that depend on (IP address, service), or all
+        results."""
+        with self._lock:
+            self._generation += 1
+            if dependency is None:
+                self._results.clear()
+                return
+            for key in [k for k, v in self._results.items() if dependency in v[1]]:
+                del self._results[key]
+
+    def subscription_count(self) -> int:
+        with self._lock:
+            return len([s for s in self._subscriptions.values() if s is not None])
+
+    def _watch(self, speaker: SoCo, service: str) -> bool:
+        """Subscribe to events from a speaker's service, if not already
+        subscribed. Returns whether there's a subscription."""
+        key = (speaker.ip_address, service)
+        with self._lock:
+            if key in self._subscriptions:
+                return self._subscriptions[key] is not None
+            # Reserve the slot while subscribing
+            self._subscriptions[key] = None
+        try:
+            subscription = getattr(speaker, service).subscribe(
+                auto_renew=True, event_queue=_EventInvalidator(self, key)
+            )
+        except Exception as e:
+            logging.info("Failed to subscribe to {}: {}".format(key, e))
+            with self._lock:
+                self._subscriptions.pop(key, None)
+            return False
+        logging.info("Caching results using events from {}".format(key))
+        subscription.auto_renew_fail = lambda e: self._unwatch(key)
+        with self._lock:
+            self._subscriptions[key] = subscription
+        return True
+
+    def _unwatch(self, key: Tuple[str, str]) -> None:
+        logging.info("Stopped caching results using events from {}".format(key))
+        with self._lock:
+            self._subscriptions.pop(key, None)
+        self.invalidate(key)
+
+    def unwatch_all(self) -> None:
+        """Cancel all event subscriptions, and forget all results."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+            self._subscriptions.clear()
+        self.invalidate()
+        for subscription in subscriptions:
+            if subscription is None:
+                continue
+            try:
+                subscription.unsubscribe()
+            except Exception as e:
+                logging.info("Failed to unsubscribe: {}".format(e))
+
+
+class _EventInvalidator:
+    """Forgets the results that depend on a subscription when it receives an
+    event. SoCo puts received events on a subscription's queue by calling
+    'put()'."""
+
+    def __init__(self, cache: ResultCache, key: Tuple[str, str]):
+        self._cache = cache
+        self._key = key
+
+    def put(self, event, *args, **kwargs) -> None:
+        # The initial event reports the state at the time of subscription,
+        # which results read after subscribing already reflect
+        if str(getattr(event, "seq", "")) == "0":
+            return
+        self._cache.invalidate(self._key)
@@ -0,0 +1,448 @@
+"""Run command sequences on a schedule, in a single long-running process.
+
+Each line of a schedule file contains a schedule followed by the command
+sequences to run, in the same form as they would be supplied to 'sonos':
+
+    # Weekday mornings at 07:30
+    30 7 * * 1-5  Kitchen play_fav "Radio 4" : Kitchen volume 20
+    # Every 15 minutes
+    every 15m     Study if_stopped volume 25
+    @daily        Bedroom stop
+
+Schedules are either cron-style (five fields: minute, hour, day of month,
+month, day of week; or one of the '@hourly', '@daily', '@weekly', '@monthly' and
+'@yearly' shorthands), or 'every <duration>'. The policy for runs that are
+missed, e.g., because the computer was asleep, can be set using:
+
+    set missed_runs skip|run
+    set grace <duration>
+
+A run that starts more than 'grace' (default 1m) after its scheduled time is
+either skipped ('skip', the default) or run once ('run').
+
+Pending runs are held in a priority queue ordered by a monotonic clock, so
+intervals are unaffected by changes to the system clock. Cron-style entries are
+evaluated in local time, allowing for DST, and their run times are recalculated
+if the system clock is changed. A run scheduled during a skipped DST hour
+happens after the clock change; a run during a repeated hour happens once.
+"""
+
+import datetime
+import heapq
+import logging
+import sys
+import threading
+import time
+from typing import List, Optional, Set
+
+from soco_cli.cmd_parser import CLIParser
+from soco_cli.planner import Planner
+from soco_cli.script import parse_script
+from soco_cli.sequence_processor import MAX_PARALLEL, process_sequences
+from soco_cli.utils import (
+    cancelled,
+    convert_to_seconds,
+    error_report,
+    interruptible_sleep,
+    set_api,
+)
+
+# The longest time to sleep before checking the clock again
+MAX_SLEEP = 60.0
+
+# Resynchronise cron entries if the wall clock moves by more than this,
+# relative to the monotonic clock
+CLOCK_JUMP_THRESHOLD = 2.0
+
+MISSED_RUN_POLICIES = ["skip", "run"]
+
+CRON_SHORTHANDS = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+MONTH_NAMES = [
+    "jan",
+    "feb",
+    "mar",
+    "apr",
+    "may",
+    "jun",
+    "jul",
+    "aug",
+    "sep",
+    "oct",
+    "nov",
+    "dec",
+]
+DAY_NAMES = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+
+def _parse_cron_field(
+    field: str, minimum: int, maximum: int, names: Optional[List[str]] = None
+) -> Set[int]:
+    """Parse a cron field, e.g., '*', '*/15', '1-5', 'mon-fri', '0,30'.
+
+    Raises:
+        ValueError: If the field is invalid.
+    """
+
+    def value(text):
+        if names and text in names:
+            return names.index(text) + minimum
+        return int(text)
+
+    values = set()
+    for part in field.lower().split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError("Invalid step '{}'".format(step_text))
+        if part == "*":
+            start, end = minimum, maximum
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = value(start_text), value(end_text)
+        else:
+            start = value(part)
+            end = maximum if step != 1 else start
+        if not minimum <= start <= end <= maximum:
+            raise ValueError("Invalid cron field '{}'".format(field))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    def __init__(self, spec: str):
+        spec = CRON_SHORTHANDS.get(spec.lower(), spec)
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError("Cron schedule '{}' must have five fields".format(spec))
+        self.spec = spec
+        self._minutes = sorted(_parse_cron_field(fields[0], 0, 59))
+        self._hours = sorted(_parse_cron_field(fields[1], 0, 23))
+        self._days = _parse_cron_field(fields[2], 1, 31)
+        self._months = _parse_cron_field(fields[3], 1, 12, MONTH_NAMES)
+        # Sunday can be 0 or 7
+        self._weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7, DAY_NAMES)}
+        # As in cron, if both day fields are restricted, either can match
+        self._days_restricted = not fields[2].startswith("*")
+        self._weekdays_restricted = not fields[4].startswith("*")
+
+    def _matches_date(self, date: datetime.date) -> bool:
+        if date.month not in self._months:
+            return False
+        day_match = date.day in self._days
+        weekday_match = (date.weekday() + 1) % 7 in self._weekdays
+        if self._days_restricted and self._weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_after(self, after: datetime.datetime) -> datetime.datetime:
+        """Return the first matching (naive, local) time after 'after'.
+
+        Raises:
+            ValueError: If there is no matching time, e.g., for February 30th.
+        """
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Allow for schedules that only match on February 29th
+        for day_offset in range(366 * 8):
+            date = start.date() + datetime.timedelta(days=day_offset)
+            if not self._matches_date(date):
+                continue
+            for hour in self._hours:
+                for minute in self._minutes:
+                    candidate = datetime.datetime.combine(
+                        date, datetime.time(hour, minute)
+                    )
+                    if candidate >= start:
+                        return candidate
+        raise ValueError("Cron schedule '{}' never matches".format(self.spec))
+
+
+class ScheduleEntry:
+    def __init__(
+        self,
+        line_number: int,
+        args: List[str],
+        cron: Optional[CronSchedule] = None,
+        interval: Optional[float] = None,
+    ):
+        self.line_number = line_number
+        self.args = args
+        self.cron = cron
+        self.interval = interval
+        cli_parser = CLIParser()
+        cli_parser.parse(args)
+        self.sequences = cli_parser.get_sequences()
+        # The next run time, on the monotonic clock
+        self.due = 0.0
+        # For cron entries, the (naive, local) time of the next run
+        self.slot = None  # type: Optional[datetime.datetime]
+        self.running = False
+
+
+def parse_schedule(lines):
+    """Parse the lines of a schedule file.
+
+    Returns:
+        (list, dict): The schedule entries, and the settings.
+
+    Raises:
+        ValueError: If the schedule is invalid.
+    """
+    entries = []
+    settings = {"missed_runs": "skip", "grace": 60.0}
+    for line_number, args in parse_script(lines):
+        try:
+            first = args[0].lower()
+            if first == "set":
+                if len(args) != 3 or args[1] not in settings:
+                    raise ValueError(
+                        "Use 'set missed_runs skip|run' or 'set grace <duration>'"
+                    )
+                if args[1] == "grace":
+                    settings["grace"] = convert_to_seconds(args[2])
+                elif args[2].lower() in MISSED_RUN_POLICIES:
+                    settings["missed_runs"] = args[2].lower()
+                else:
+                    raise ValueError("'missed_runs' must be one of 'skip' or 'run'")
+                continue
+            if first == "every":
+                interval = convert_to_seconds(args[1])
+                if interval <= 0:
+                    raise ValueError("The interval must be greater than zero")
+                entry = ScheduleEntry(line_number, args[2:], interval=interval)
+            elif first in CRON_SHORTHANDS:
+                entry = ScheduleEntry(line_number, args[1:], cron=CronSchedule(first))
+            else:
+                cron = CronSchedule(" ".join(args[:5]))
+                entry = ScheduleEntry(line_number, args[5:], cron=cron)
+            # Check that the schedule can be satisfied
+            if entry.cron:
+                entry.cron.next_after(datetime.datetime.now())
+        except IndexError:
+            raise ValueError("Line {}: incomplete schedule entry".format(line_number))
+        except ValueError as error:
+            raise ValueError("Line {}: {}".format(line_number, error))
+        if len(entry.sequences) == 0:
+            raise ValueError("Line {}: no commands to run".format(line_number))
+        entries.append(entry)
+    return entries, settings
+
+
+def _local_timestamp(local_time: datetime.datetime) -> float:
+    """Convert a naive local time to a timestamp. For a time that doesn't
+    exist because of a DST change, this is the equivalent time after the
+    change."""
+    return time.mktime(local_time.timetuple())
+
+
+class Scheduler:
+    def __init__(
+        self,
+        entries: List[ScheduleEntry],
+        missed_runs: str = "skip",
+        grace: float = 60.0,
+        use_local_speaker_list: bool = False,
+        env_speaker: Optional[str] = None,
+        max_parallel: int = MAX_PARALLEL,
+    ):
+        self._entries = entries
+        self._missed_runs = missed_runs
+        self._grace = grace
+        self._use_local_speaker_list = use_local_speaker_list
+        self._env_speaker = env_speaker
+        self._max_parallel = max_parallel
+        self._queue = []  # type: List
+        self._counter = 0
+        self._clock_offset = self._wall_clock_offset()
+
+    @staticmethod
+    def _wall_clock_offset() -> float:
+        return time.time() - time.monotonic()
+
+    def _push(self, entry: ScheduleEntry) -> None:
+        # The counter keeps entries with the same due time in file order
+        self._counter += 1
+        heapq.heappush(self._queue, (entry.due, self._counter, entry))
+
+    def _schedule_cron(self, entry: ScheduleEntry, after: datetime.datetime) -> None:
+        entry.slot = entry.cron.next_after(after)
+        entry.due = time.monotonic() + (_local_timestamp(entry.slot) - time.time())
+        logging.info(
+            "Line {}: next run at {}".format(entry.line_number, entry.slot.isoformat())
+        )
+        self._push(entry)
+
+    def _schedule_next(self, entry: ScheduleEntry) -> None:
+        now = time.monotonic()
+        if entry.cron:
+            # Don't repeat a slot, e.g., during a repeated DST hour
+            self._schedule_cron(entry, max(entry.slot, datetime.datetime.now()))
+            return
+        entry.due += entry.interval
+        if entry.due <= now:
+            missed = int((now - entry.due) // entry.interval) + 1
+            logging.info(
+                "Line {}: {} interval(s) missed".format(entry.line_number, missed)
+            )
+            # The late run, whether run or skipped, stands in for the missed
+            # intervals: keep to the original alignment
+            entry.due += missed * entry.interval
+        self._push(entry)
+
+    def _resync_cron_entries(self) -> None:
+        """Recalculate cron entry run times if the wall clock has jumped
+        relative to the monotonic clock."""
+        offset = self._wall_clock_offset()
+        if abs(offset - self._clock_offset) < CLOCK_JUMP_THRESHOLD:
+            return
+        logging.info(
+            "Wall clock moved by {:.1f}s: rescheduling cron entries".format(
+                offset - self._clock_offset
+            )
+        )
+        self._clock_offset = offset
+        queue = self._queue
+        self._queue = []
+        for _, _, entry in queue:
+            if entry.cron:
+                entry.due = time.monotonic() + (
+                    _local_timestamp(entry.slot) - time.time()
+                )
+            self._push(entry)
+
+    def _fire(self, entry: ScheduleEntry) -> None:
+        if entry.running:
+            logging.info(
+                "Line {}: previous run still in progress; skipping".format(
+                    entry.line_number
+                )
+            )
+            return
+        entry.running = True
+        threading.Thread(
+            target=self._run_entry,
+            args=(entry,),
+            name="Schedule-{}".format(entry.line_number),
+            daemon=True,
+        ).start()
+
+    def _run_entry(self, entry: ScheduleEntry) -> None:
+        start_time = time.time()
+        try:
+            exit_code = process_sequences(
+                entry.sequences,
+                use_local_speaker_list=self._use_local_speaker_list,
+                env_speaker=self._env_speaker,
+                max_parallel=self._max_parallel,
+            )
+        except Exception as e:
+            print("Error:", str(e), file=sys.stderr, flush=True)
+            exit_code = 1
+        finally:
+            entry.running = False
+        print(
+            "{} Line {}: exit code = {}, time = {:.3f}s: '{}'".format(
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                entry.line_number,
+                exit_code,
+                time.time() - start_time,
+                " ".join(entry.args),
+            ),
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def run(self) -> None:
+        """Run the schedule until cancelled."""
+        now = time.monotonic()
+        for entry in self._entries:
+            if entry.cron:
+                self._schedule_cron(entry, datetime.datetime.now())
+            else:
+                entry.due = now + entry.interval
+                self._push(entry)
+
+        while len(self._queue) > 0 and not cancelled():
+            self._resync_cron_entries()
+            due, _, entry = self._queue[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                interruptible_sleep(min(delay, MAX_SLEEP))
+                continue
+            heapq.heappop(self._queue)
+            if -delay > self._grace and self._missed_runs == "skip":
+                logging.info(
+                    "Line {}: run missed by {:.0f}s; skipping".format(
+                        entry.line_number, -delay
+                    )
+                )
+            else:
+                self._fire(entry)
+            self._schedule_next(entry)
+
+
+def run_schedule(
+    filename: str,
+    use_local_speaker_list: bool = False,
+    env_speaker: Optional[str] = None,
+    max_parallel: int = MAX_PARALLEL,
+) -> int:
+    """Load a schedule file and run it until interrupted.
+
+    Returns:
+        int: 1 if the schedule can't be loaded, otherwise 0.
+    """
+    try:
+        with open(filename, "r") as f:
+            entries, settings = parse_schedule(f)
+    except (OSError, ValueError) as error:
+        error_report("Unable to load schedule '{}': {}".format(filename, error))
+        return 1
+    if len(entries) == 0:
+        error_report("No entries in schedule '{}'".format(filename))
+        return 1
+
+    # Errors must not stop the scheduler
+    set_api()
+
+    # Check all the command sequences before starting. This also warms up the
+    # speaker cache, which is shared by all the runs.
+    planner = Planner(
+        use_local_speaker_list=use_local_speaker_list, env_speaker=env_speaker
+    )
+    errors = 0
+    for entry in entries:
+        for message in planner.plan(entry.sequences).errors:
+            print(
+                "Error: Line {}: {}".format(entry.line_number, message),
+                file=sys.stderr,
+                flush=True,
+            )
+            errors += 1
+    if errors:
+        return 1
+
+    logging.info(
+        "Running {} schedule entries, missed runs = {}, grace = {}s".format(
+            len(entries), settings["missed_runs"], settings["grace"]
+        )
+    )
+    Scheduler(
+        entries,
+        missed_runs=settings["missed_runs"],
+        grace=settings["grace"],
+        use_local_speaker_list=use_local_speaker_list,
+        env_speaker=env_speaker,
+        max_parallel=max_parallel,
+    ).run()
+    return 0
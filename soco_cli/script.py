@@ -0,0 +1,141 @@
+"""Run script files containing 'sonos' command sequences.
+
+Each line of a script contains the same command sequences that would be
+supplied to the 'sonos' command, e.g.:
+
+    # Set up the kitchen
+    Kitchen volume 25 : Kitchen play_fav "Radio 4"
+    Lounge group Kitchen : \\
+        Lounge volume 20
+
+Lines are run in order, in a single process, so the speaker cache and
+connections are reused from line to line. Comments start with '#', and a
+line ending with a backslash continues on the next line.
+"""
+
+import logging
+import shlex
+import sys
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from soco_cli.cmd_parser import CLIParser
+from soco_cli.sequence_processor import MAX_PARALLEL, process_sequences
+from soco_cli.utils import error_report, set_api
+
+
+def parse_script(lines: Iterable[str]) -> List[Tuple[int, List[str]]]:
+    """Parse the lines of a script.
+
+    Args:
+        lines (iterable): The lines of the script.
+
+    Returns:
+        list: A list of (line_number, args) tuples, one for each command line
+        in the script. 'line_number' is the number of the first line of the
+        command line.
+
+    Raises:
+        ValueError: If a line can't be parsed, e.g., because of unbalanced
+            quotes.
+    """
+    command_lines = []
+    command_line = ""
+    first_line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if command_line == "":
+            first_line_number = line_number
+        if line.rstrip().endswith("\\"):
+            command_line += line.rstrip()[:-1] + " "
+            continue
+        command_line += line
+        try:
+            args = shlex.split(command_line, comments=True)
+        except ValueError as error:
+            raise ValueError("Line {}: {}".format(first_line_number, error))
+        if len(args) != 0:
+            command_lines.append((first_line_number, args))
+        command_line = ""
+
+    if command_line.strip() != "":
+        raise ValueError(
+            "Line {}: unterminated line continuation".format(first_line_number)
+        )
+
+    return command_lines
+
+
+def run_script(
+    filename: str,
+    use_local_speaker_list: bool = False,
+    env_speaker: Optional[str] = None,
+    max_parallel: int = MAX_PARALLEL,
+) -> int:
+    """Run the command lines in a script file, reporting the exit code and
+    elapsed time of each line on stderr.
+
+    Args:
+        filename (str): The script file to run. Use '-' to read from stdin.
+        use_local_speaker_list (bool): Whether to use the local speaker list.
+        env_speaker (str, optional): The speaker name to insert at the start of
+            each command sequence, e.g., from the 'SPKR' environment variable.
+        max_parallel (int): The maximum number of actions to run at the same
+            time.
+
+    Returns:
+        int: The number of script lines that returned a non-zero exit code.
+    """
+    try:
+        if filename == "-":
+            command_lines = parse_script(sys.stdin)
+        else:
+            with open(filename, "r") as f:
+                command_lines = parse_script(f)
+    except (OSError, ValueError) as error:
+        error_report("Unable to read script '{}': {}".format(filename, error))
+        return 1
+
+    # Errors are reported per line, and must not cause the script to exit
+    set_api()
+
+    logging.info(
+        "Running {} command line(s) from script '{}'".format(
+            len(command_lines), filename
+        )
+    )
+    failed = 0
+    script_start_time = time.time()
+    for line_number, args in command_lines:
+        start_time = time.time()
+        cli_parser = CLIParser()
+        try:
+            cli_parser.parse(args)
+        except ValueError as error:
+            print("Error: {}".format(error), file=sys.stderr, flush=True)
+            exit_code = 1
+        else:
+            exit_code = process_sequences(
+                cli_parser.get_sequences(),
+                use_local_speaker_list=use_local_speaker_list,
+                env_speaker=env_speaker,
+                max_parallel=max_parallel,
+            )
+        if exit_code != 0:
+            failed += 1
+        print(
+            "Line {}: exit code = {}, time = {:.3f}s: '{}'".format(
+                line_number, exit_code, time.time() - start_time, " ".join(args)
+            ),
+            file=sys.stderr,
+            flush=True,
+        )
+
+    print(
+        "Script '{}': {} line(s) run, {} failed, total time = {:.3f}s".format(
+            filename, len(command_lines), failed, time.time() - script_start_time
+        ),
+        file=sys.stderr,
+        flush=True,
+    )
+    return failed
@@ -0,0 +1,417 @@
+"""Process sequences of commands, separated using ':'.
+
+This is the engine used by the 'sonos' command. It processes a list of command
+sequences (as produced by 'CLIParser'), including the 'loop' and 'wait'
+actions. The sequences are first compiled into a plan (see 'planner.py'),
+which is then executed; the 'loop' actions re-execute parts of the plan.
+"""
+
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+from soco_cli.api import run_command
+from soco_cli.fleet import SHARD_BY_SUBNET, FleetRunner
+from soco_cli.planner import (
+    ActionStep,
+    ErrorStep,
+    LoopStep,
+    ParallelStep,
+    Plan,
+    Planner,
+    TrackFollowStep,
+    WaitStep,
+)
+from soco_cli.track_follow import track_follow
+from soco_cli.utils import (
+    cancelled,
+    capture_output,
+    current_context,
+    get_cancel_event,
+    seconds_until,
+    set_cancel_event,
+    use_context,
+)
+from soco_cli.wait_actions import process_wait
+
+# The default maximum number of actions to run at the same time
+MAX_PARALLEL = 8
+
+
+def process_sequences(
+    sequences: List[List[str]],
+    use_local_speaker_list: bool = False,
+    env_speaker: Optional[str] = None,
+    concurrent: bool = False,
+    max_parallel: int = MAX_PARALLEL,
+    processes: int = 1,
+    shard_by: str = SHARD_BY_SUBNET,
+) -> int:
+    """Process a list of command sequences.
+
+    Args:
+        sequences (list): The command sequences, each of which is a list of
+            strings of the form [speaker, action, arg, ...].
+        use_local_speaker_list (bool): Whether to use the local speaker list.
+        env_speaker (str, optional): The speaker name to insert at the start of
+            each command sequence, e.g., from the 'SPKR' environment variable.
+        concurrent (bool): Whether to run consecutive actions that target
+            different speakers concurrently.
+        max_parallel (int): The maximum number of actions to run at the same
+            time, in parallel blocks, on '_all_' speakers, or concurrently.
+        processes (int): The number of worker processes used to run actions
+            on '_all_' speakers and speaker sets; 1 to use threads only.
+        shard_by (str): How to divide speakers between the worker processes:
+            by 'subnet' or by 'household'.
+
+    Returns:
+        int: The cumulative exit code of all the actions processed.
+    """
+    logging.info("Found {} action sequence(s): {}".format(len(sequences), sequences))
+    planner = Planner(
+        use_local_speaker_list=use_local_speaker_list, env_speaker=env_speaker
+    )
+    plan = planner.plan(sequences, find_concurrent=concurrent)
+
+    # Don't start running a plan that contains errors
+    if plan.errors:
+        for message in plan.errors:
+            print("Error:", message, file=sys.stderr, flush=True)
+        return len(plan.errors)
+
+    fleet = None  # type: Optional[FleetRunner]
+    if processes > 1:
+        fleet = FleetRunner(processes=processes, shard_by=shard_by)
+    try:
+        return execute_plan(
+            plan,
+            planner,
+            use_local_speaker_list=use_local_speaker_list,
+            max_parallel=max_parallel,
+            fleet=fleet,
+        )
+    finally:
+        if fleet is not None:
+            fleet.close()
+
+
+def execute_plan(
+    plan: Plan,
+    planner: Planner,
+    use_local_speaker_list: bool = False,
+    max_parallel: int = MAX_PARALLEL,
+    fleet: Optional[FleetRunner] = None,
+) -> int:
+    """Execute a plan, returning the cumulative exit code. If 'fleet' is
+    supplied, actions on multiple speakers are run using its worker
+    processes."""
+    cumulative_exit_code = 0
+    steps = plan.steps
+    index = 0
+
+    # There is a notional 'loop' action before the first step
+    loop_pointer = -1
+
+    # Iteration counts and start times of the loops in progress, by step index
+    loop_state = {}  # type: Dict[int, Tuple]
+
+    while index < len(steps) and not cancelled():
+        step = steps[index]
+        try:
+            if isinstance(step, LoopStep):
+                if step.action == "loop_to_start":
+                    logging.info("Rewind to start of command sequences")
+                    loop_pointer = -1
+                    index = 0
+                elif loop_finished(step, index, loop_state):
+                    loop_pointer = index
+                    index += 1
+                else:
+                    logging.info(
+                        "Rewinding to command number {}".format(loop_pointer + 2)
+                    )
+                    index = loop_pointer + 1
+                continue
+
+            if index in plan.concurrent_runs:
+                end = plan.concurrent_runs[index]
+                cumulative_exit_code += _execute_concurrently(
+                    steps[index:end], planner, use_local_speaker_list, max_parallel
+                )
+                index = end
+                continue
+
+            cumulative_exit_code += _execute_step(
+                step, planner, use_local_speaker_list, max_parallel, fleet
+            )
+
+        except Exception as e:
+            print("Error:", str(e), flush=True)
+            cumulative_exit_code += 1
+
+        index += 1
+
+    return cumulative_exit_code
+
+
+def loop_finished(step: LoopStep, index: int, loop_state: Dict[int, Tuple]) -> bool:
+    """Update the state of a loop. Returns True when the loop is complete."""
+    if step.action == "loop":
+        if step.parameter is None:
+            return False
+        iterations = loop_state.get(index, (step.parameter,))[0] - 1
+        logging.info("Loop iterator countdown = {}".format(iterations))
+        if iterations <= 0:
+            loop_state.pop(index, None)
+            return True
+        loop_state[index] = (iterations,)
+        return False
+
+    # 'loop_for' and 'loop_until'
+    if index not in loop_state:
+        if step.action == "loop_for":
+            duration = step.parameter
+        else:
+            duration = seconds_until(step.parameter)
+        logging.info(
+            "Starting action '{}' for duration {}s".format(step.action, duration)
+        )
+        loop_state[index] = (time.time(), duration)
+        return False
+    start_time, duration = loop_state[index]
+    if time.time() - start_time >= duration:
+        logging.info(
+            "Ending action '{}' after duration {}s".format(step.action, duration)
+        )
+        del loop_state[index]
+        return True
+    return False
+
+
+def _execute_step(
+    step,
+    planner: Planner,
+    use_local_speaker_list: bool,
+    max_parallel: int,
+    fleet: Optional[FleetRunner] = None,
+) -> int:
+    """Execute a single step, printing its output. Returns the exit code."""
+    if isinstance(step, ErrorStep):
+        print("Error:", step.message, file=sys.stderr, flush=True)
+        return 1
+
+    if isinstance(step, WaitStep):
+        process_wait(step.sequence)
+        return 0
+
+    if isinstance(step, ParallelStep):
+        return _execute_parallel_block(
+            step, planner, use_local_speaker_list, max_parallel, fleet
+        )
+
+    if isinstance(step, ActionStep) and step.all_speakers is not None:
+        return _execute_on_all_speakers(
+            step, use_local_speaker_list, max_parallel, fleet
+        )
+
+    speaker = step.speaker or planner.resolve_speaker(step.speaker_name)
+    if not speaker:
+        print(
+            "Error: Speaker '{}' not found".format(step.speaker_name),
+            file=sys.stderr,
+            flush=True,
+        )
+        return 1
+    step.speaker = speaker
+
+    if isinstance(step, TrackFollowStep):
+        track_follow(
+            speaker,
+            use_local_speaker_list=use_local_speaker_list,
+            break_on_pause=False,
+            compact=step.compact,
+        )
+        return 0
+
+    exit_code, output_msg, error_msg = _run_action_step(
+        step, speaker, use_local_speaker_list
+    )
+    _print_result(exit_code, output_msg, error_msg)
+    return exit_code
+
+
+def _run_action_step(
+    step: ActionStep, speaker, use_local_speaker_list: bool
+) -> Tuple[int, str, str]:
+    logging.info("Invoking 'run_command' with '{} {} ...'".format(speaker, step.action))
+    return run_command(
+        speaker,
+        step.action,
+        *step.args,
+        use_local_speaker_list=use_local_speaker_list,
+        sonos_function=step.sonos_function,
+    )
+
+
+def _print_result(exit_code: int, output_msg: str, error_msg: str) -> None:
+    if exit_code == 0 and len(output_msg) != 0:
+        print(output_msg, flush=True)
+    elif len(error_msg) != 0:
+        print(error_msg, file=sys.stderr, flush=True)
+
+
+def _run_in_parallel(function: Callable, items: List, max_parallel: int) -> List:
+    """Call 'function' on each item using a pool of up to 'max_parallel'
+    threads. Returns the results in the same order as the items."""
+    cancel_event = get_cancel_event()
+    context = current_context()
+
+    def run(item):
+        # Pass on cancellation and the context to the worker threads
+        set_cancel_event(cancel_event)
+        with use_context(context):
+            return function(item)
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(items), max_parallel))
+    ) as executor:
+        return list(executor.map(run, items))
+
+
+def _execute_concurrently(
+    steps: List[ActionStep],
+    planner: Planner,
+    use_local_speaker_list: bool,
+    max_parallel: int,
+) -> int:
+    """Run independent action steps concurrently. Output is printed in step
+    order once all the steps have finished."""
+    logging.info("Running {} steps concurrently".format(len(steps)))
+    results = _run_in_parallel(
+        lambda step: _run_action_step(step, step.speaker, use_local_speaker_list),
+        steps,
+        max_parallel,
+    )
+    cumulative_exit_code = 0
+    for exit_code, output_msg, error_msg in results:
+        _print_result(exit_code, output_msg, error_msg)
+        cumulative_exit_code += exit_code
+    return cumulative_exit_code
+
+
+def _execute_parallel_block(
+    step: ParallelStep,
+    planner: Planner,
+    use_local_speaker_list: bool,
+    max_parallel: int,
+    fleet: Optional[FleetRunner] = None,
+) -> int:
+    """Run the branches of a parallel block concurrently. The output of each
+    branch is captured, and printed in branch order once all the branches have
+    finished, with each line labelled with the branch number."""
+    logging.info("Running parallel block with {} branch(es)".format(len(step.branches)))
+
+    def run(branch):
+        output = StringIO()
+        error = StringIO()
+        with capture_output(output, error):
+            try:
+                exit_code = execute_plan(
+                    branch,
+                    planner,
+                    use_local_speaker_list=use_local_speaker_list,
+                    max_parallel=max_parallel,
+                    fleet=fleet,
+                )
+            except Exception as e:
+                print("Error:", str(e), file=sys.stderr, flush=True)
+                exit_code = 1
+        return exit_code, output.getvalue(), error.getvalue()
+
+    results = _run_in_parallel(run, step.branches, max_parallel)
+
+    cumulative_exit_code = 0
+    for number, (exit_code, output_msg, error_msg) in enumerate(results, start=1):
+        label = "[{}] ".format(number)
+        for line in output_msg.splitlines():
+            print(label + line, flush=True)
+        for line in error_msg.splitlines():
+            print(label + line, file=sys.stderr, flush=True)
+        cumulative_exit_code += exit_code
+    return cumulative_exit_code
+
+
+def _execute_on_all_speakers(
+    step: ActionStep,
+    use_local_speaker_list: bool,
+    max_parallel: int,
+    fleet: Optional[FleetRunner] = None,
+) -> int:
+    """Run an action on all speakers (or on the speakers in a set), using up to
+    'max_parallel' threads. The results are printed in speaker name order once
+    all the actions have finished."""
+    logging.info(
+        "Performing action '{}' on speakers '{}', max. parallel = {}".format(
+            step.action, step.speaker_name, max_parallel
+        )
+    )
+
+    def run(speaker):
+        try:
+            speaker_name = speaker.player_name
+        except Exception as e:
+            return speaker.ip_address, (1, "", "Error: {}".format(e))
+        logging.info(
+            "Performing action '{}' on speaker '{}'".format(step.action, speaker_name)
+        )
+        return speaker_name, _run_action_step(step, speaker, use_local_speaker_list)
+
+    if fleet is not None:
+        results = _run_with_fleet(step, fleet, use_local_speaker_list)
+    else:
+        results = _run_in_parallel(run, step.all_speakers, max_parallel)
+
+    cumulative_exit_code = 0
+    last_line_was_single_line = False
+    for speaker_name, (exit_code, output_msg, error_msg) in sorted(
+        results, key=lambda result: result[0].lower()
+    ):
+        if exit_code == 0:
+            if len(output_msg) != 0:
+                num_lines = len(output_msg.splitlines())
+                if num_lines > 1 and last_line_was_single_line:
+                    print()
+                    last_line_was_single_line = False
+                if num_lines == 1:
+                    last_line_was_single_line = True
+            else:
+                output_msg = "OK"
+            print(speaker_name + ": ", end="", flush=True)
+            print(output_msg, flush=True)
+        elif len(error_msg) != 0:
+            print(speaker_name + ": ", end="", flush=True)
+            print(error_msg, file=sys.stderr, flush=True)
+        cumulative_exit_code += exit_code
+    return cumulative_exit_code
+
+
+def _run_with_fleet(
+    step: ActionStep, fleet: FleetRunner, use_local_speaker_list: bool
+) -> List[Tuple[str, Tuple[int, str, str]]]:
+    """Run an action on multiple speakers using worker processes, returning
+    (speaker name, result) for each speaker."""
+    names = []
+    for speaker in step.all_speakers:
+        try:
+            names.append(speaker.player_name)
+        except Exception as e:
+            logging.info("Unable to get name of {}: {}".format(speaker, e))
+            names.append(speaker.ip_address)
+    results = fleet.run(
+        [[speaker, step.action] + step.args for speaker in step.all_speakers],
+        use_local_speaker_list=use_local_speaker_list,
+    )
+    return [(name, result[:3]) for name, result in zip(names, results)]
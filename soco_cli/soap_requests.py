@@ -0,0 +1,73 @@
+"""The handling of the SOAP requests made by SoCo-CLI actions.
+
+SoCo sends each SOAP request to a speaker using 'Service.send_command()'. The
+requests made by a thread while it's processing an action (see
+'request_scope()') pass through the following, in order:
+
+    1. Read memoisation ('read_cache.send_memoised()'), which answers
+       repeated reads without contacting the speaker.
+    2. The request timeout of the action's policy
+       ('circuit_breaker.send_with_timeout()').
+    3. The per-speaker request limits ('limiter.send_limited()'), which also
+       tell the request observers about each request sent.
+
+This is the only place where 'Service.send_command()' is replaced. The
+replacement is installed when the first action is processed, and passes
+requests made outside an action (including by other users of SoCo in the same
+process) straight to SoCo.
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from soco.services import Service  # type: ignore
+
+from soco_cli import circuit_breaker, limiter, read_cache
+
+# The functions applied to each request made by an action, outermost first.
+# Each is called with the next function to use, followed by the arguments of
+# 'Service.send_command()'.
+LAYERS = (
+    read_cache.send_memoised,
+    circuit_breaker.send_with_timeout,
+    limiter.send_limited,
+)
+
+_soco_send_command = Service.send_command
+_send_layered = _soco_send_command
+for _layer in reversed(LAYERS):
+    _send_layered = partial(_layer, _send_layered)
+
+_install_lock = threading.Lock()
+_installed = False
+
+# Set while the current thread is processing an action
+_scope = threading.local()
+
+
+def _send_command(self, action, args=None, cache=None, **kwargs):
+    if not getattr(_scope, "active", False):
+        return _soco_send_command(self, action, args=args, cache=cache, **kwargs)
+    return _send_layered(self, action, args=args, cache=cache, **kwargs)
+
+
+def _install() -> None:
+    global _installed
+    with _install_lock:
+        if not _installed:
+            Service.send_command = _send_command
+            _installed = True
+
+
+@contextmanager
+def request_scope():
+    """Apply SoCo-CLI's request handling to the requests made by the current
+    thread for the duration of the 'with' block."""
+    _install()
+    saved = getattr(_scope, "active", False)
+    _scope.active = True
+    try:
+        yield
+    finally:
+        _scope.active = saved
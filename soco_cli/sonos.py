@@ -3,38 +3,35 @@
 import argparse
 import logging
 import pprint
-import sys
-import time
 from os import environ as env
 from signal import SIGINT, SIGTERM, signal
 
 from soco_cli.action_processor import list_actions
 from soco_cli.aliases import AliasManager
-from soco_cli.api import get_all_speakers, run_command
 from soco_cli.check_for_update import print_update_status
 from soco_cli.cmd_parser import CLIParser
+from soco_cli.fleet import SHARD_BY_HOUSEHOLD, SHARD_BY_SUBNET
 from soco_cli.interactive import interactive_loop
+from soco_cli.scheduler import run_schedule
+from soco_cli.script import run_script
+from soco_cli.sequence_processor import MAX_PARALLEL, process_sequences
 from soco_cli.speakers import Speakers
-from soco_cli.track_follow import track_follow
+from soco_cli.state_cache import state_cache
+from soco_cli.stream import run_stream
 from soco_cli.utils import (
-    RewindableList,
     check_args,
     configure_common_args,
     configure_logging,
-    convert_to_seconds,
     create_speaker_cache,
+    default_context,
     docs,
     error_report,
-    get_speaker,
     logo,
-    seconds_until,
     set_speaker_list,
     sig_handler,
     version,
 )
 
-from .wait_actions import process_wait
-
 # Globals
 pp = pprint.PrettyPrinter(width=100)
 
@@ -124,6 +121,67 @@ def main():
             " exit"
         ),
     )
+    parser.add_argument(
+        "--script",
+        type=str,
+        metavar="FILE",
+        help="Run the command sequences in FILE, one line at a time ('-' for stdin)",
+    )
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=MAX_PARALLEL,
+        help=(
+            "Maximum number of actions to run at the same time, e.g., when"
+            " using '_all_' (default {})".format(MAX_PARALLEL)
+        ),
+    )
+    parser.add_argument(
+        "--schedule",
+        type=str,
+        metavar="FILE",
+        help="Run the command sequences in schedule FILE at the times specified",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Run commands supplied as newline-delimited JSON on stdin",
+    )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        default=False,
+        help="Run consecutive actions on different speakers concurrently",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help=(
+            "Number of worker processes used for actions on '_all_' speakers and"
+            " speaker sets (default 1: don't use worker processes)"
+        ),
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=[SHARD_BY_SUBNET, SHARD_BY_HOUSEHOLD],
+        default=SHARD_BY_SUBNET,
+        help=(
+            "How to divide speakers between worker processes (default '{}');"
+            " all the speakers in a /24 subnet or a household are handled by"
+            " one process".format(SHARD_BY_SUBNET)
+        ),
+    )
+    parser.add_argument(
+        "--elide-writes",
+        action="store_true",
+        default=False,
+        help=(
+            "Skip setting values that speakers are known to have already, e.g.,"
+            " 'volume 25' when the volume is 25"
+        ),
+    )
     # The rest of the optional args are common
     configure_common_args(parser)
 
@@ -200,7 +258,9 @@ def main():
             )
         exit(0)
 
-    if len(args.parameters) == 0 and not args.interactive:
+    if len(args.parameters) == 0 and not (
+        args.interactive or args.script or args.schedule or args.stream
+    ):
         print(
             "No parameters supplied. Use 'sonos --help' for usage information.",
             flush=True,
@@ -210,6 +270,16 @@ def main():
     message = check_args(args)
     if message:
         error_report(message)
+    if args.max_parallel < 1:
+        error_report("'--max-parallel' must be at least 1")
+    if args.processes < 1:
+        error_report("'--processes' must be at least 1")
+
+    if args.elide_writes:
+        default_context().elide_writes = True
+        if args.interactive or args.schedule:
+            # Long-running: keep the known state up to date using events
+            state_cache().watch_events = True
 
     use_local_speaker_list = args.use_local_speaker_list
     env_local = env.get(ENV_LOCAL)
@@ -233,7 +303,7 @@ def main():
             speaker_list.save()
         set_speaker_list(speaker_list)
     else:
-        # Create the local speaker cache in the utils module
+        # Create the speaker cache of the default context
         create_speaker_cache(
             max_threads=args.network_discovery_threads,
             scan_timeout=args.network_discovery_timeout,
@@ -261,260 +331,53 @@ def main():
             no_env=args.no_env,
             single_keystroke=sk,
         )
+        state_cache().unwatch_all()
         exit(0)
 
+    if args.script:
+        exit(
+            1
+            if run_script(
+                args.script,
+                use_local_speaker_list=use_local_speaker_list,
+                env_speaker=env_speaker,
+                max_parallel=args.max_parallel,
+            )
+            else 0
+        )
+
+    if args.schedule:
+        exit_code = run_schedule(
+            args.schedule,
+            use_local_speaker_list=use_local_speaker_list,
+            env_speaker=env_speaker,
+            max_parallel=args.max_parallel,
+        )
+        state_cache().unwatch_all()
+        exit(exit_code)
+
+    if args.stream:
+        exit(1 if run_stream(use_local_speaker_list=use_local_speaker_list) else 0)
+
     cli_parser = CLIParser()
-    cli_parser.parse(args.parameters)
+    try:
+        cli_parser.parse(args.parameters)
+    except ValueError as error:
+        error_report(str(error))
+        exit(1)
     sequences = cli_parser.get_sequences()
 
-    cumulative_exit_code = 0
-
-    # Loop through processing command sequences
-    logging.info("Found {} action sequence(s): {}".format(len(sequences), sequences))
-    rewindable_sequences = RewindableList(sequences)
-    loop_iterator = None
-    sequence_pointer = 0
-
-    # There is a notional 'loop' action before the first command sequence
-    loop_pointer = -1
-
-    loop_start_time = None
-    loop_duration = None
-
-    # Keep track of SPKR environment label insertions, to avoid repeats
-    # when looping
-    env_spkr_inserted = [False for i in range(len(rewindable_sequences))]
-
-    for sequence in rewindable_sequences:
-        try:
-            speaker_name = sequence[0]
-
-            # Special case: the 'loop_to_start' action
-            if speaker_name.lower() == "loop_to_start":
-                if len(sequence) != 1:
-                    error_report("Action 'loop_to_start' takes no parameters")
-                # Reset pointers, rewind and continue
-                loop_pointer = -1
-                sequence_pointer = 0
-                logging.info("Rewind to start of command sequences")
-                rewindable_sequences.rewind()
-                continue
-
-            # Special case: the 'loop' action
-            if speaker_name.lower() == "loop":
-                if len(sequence) == 2:
-                    if loop_iterator is None:
-                        try:
-                            loop_iterator = int(sequence[1])
-                            if loop_iterator <= 0:
-                                raise ValueError
-                            logging.info(
-                                "Looping for {} iteration(s)".format(loop_iterator)
-                            )
-                        except ValueError:
-                            error_report(
-                                "Action 'loop' takes no parameters, or a number of"
-                                " iterations (> 0)"
-                            )
-                            cumulative_exit_code += 1
-                            continue
-                    loop_iterator -= 1
-                    logging.info("Loop iterator countdown = {}".format(loop_iterator))
-                    if loop_iterator <= 0:
-                        # Reset variables, stop iteration and continue
-                        loop_iterator = None
-                        loop_pointer = sequence_pointer
-                        sequence_pointer += 1
-                        continue
-                logging.info("Rewinding to command number {}".format(loop_pointer + 2))
-                rewindable_sequences.rewind_to(loop_pointer + 1)
-                sequence_pointer = loop_pointer + 1
-                continue
-
-            # Special case: the 'loop_for' action
-            if speaker_name.lower() == "loop_for":
-                if len(sequence) != 2:
-                    error_report(
-                        "Action 'loop_for' requires one parameter (check spaces around"
-                        " the ':' separator)"
-                    )
-                if loop_start_time is None:
-                    loop_start_time = time.time()
-                    try:
-                        loop_duration = convert_to_seconds(sequence[1])
-                    except ValueError:
-                        error_report(
-                            "Action 'loop_for' requires one parameter (duration >= 0)"
-                        )
-                        cumulative_exit_code += 1
-                    logging.info(
-                        "Starting action 'loop_for' for duration {}s".format(
-                            loop_duration
-                        )
-                    )
-                else:
-                    if time.time() - loop_start_time >= loop_duration:
-                        logging.info(
-                            "Ending action 'loop_for' after duration {}s".format(
-                                loop_duration
-                            )
-                        )
-                        loop_start_time = None
-                        continue
-                logging.info("Rewinding to command number {}".format(loop_pointer + 2))
-                rewindable_sequences.rewind_to(loop_pointer + 1)
-                sequence_pointer = loop_pointer + 1
-                continue
-
-            # Special case: the 'loop_until' action
-            if speaker_name.lower() == "loop_until":
-                if len(sequence) != 2:
-                    error_report(
-                        "Action 'loop_until' requires one parameter (check spaces"
-                        " around the ':' separator)"
-                    )
-                if loop_start_time is None:
-                    loop_start_time = time.time()
-                    try:
-                        loop_duration = seconds_until(sequence[1])
-                    except:
-                        error_report(
-                            "Action 'loop_until' requires one parameter (stop time)"
-                        )
-                        cumulative_exit_code += 1
-                    logging.info(
-                        "Starting action 'loop_until' for duration {}s".format(
-                            loop_duration
-                        )
-                    )
-                else:
-                    if time.time() - loop_start_time >= loop_duration:
-                        logging.info(
-                            "Ending action 'loop_until' after duration {}s".format(
-                                loop_duration
-                            )
-                        )
-                        loop_start_time = None
-                        continue
-                logging.info("Rewinding to command number {}".format(loop_pointer + 2))
-                rewindable_sequences.rewind_to(loop_pointer + 1)
-                sequence_pointer = loop_pointer + 1
-                continue
-
-            # Special case: the 'wait' actions
-            if speaker_name in ["wait", "wait_for", "wait_until"]:
-                process_wait(sequence)
-                continue
-
-            # Use the speaker name from the environment?
-            if env_speaker:
-                if env_spkr_inserted[sequence_pointer] is False:
-                    logging.info(
-                        "Getting speaker name '{}' from the $SPKR environment variable"
-                        .format(env_speaker)
-                    )
-                    sequence.insert(0, env_speaker)
-                    speaker_name = env_speaker
-                    env_spkr_inserted[sequence_pointer] = True
-
-            # General action processing
-            if len(sequence) < 2:
-                error_report(
-                    "At least 2 parameters required in action sequence '{}'; did you"
-                    " supply a speaker name?".format(sequence)
-                )
-            action = sequence[1].lower()
-            args = sequence[2:]
-            if speaker_name.lower() == "_all_":
-                if use_local_speaker_list:
-                    speakers = speaker_list.get_all_speakers()
-                else:
-                    speakers = get_all_speakers(use_scan=True)
-                logging.info(
-                    "Performing action '{}' on all visible speakers".format(action)
-                )
-                last_line_was_single_line = False
-                for speaker in speakers:
-                    if speaker.is_visible:
-                        logging.info(
-                            "Performing action '{}' on speaker '{}'".format(
-                                action, speaker.player_name
-                            )
-                        )
-                        exit_code, output_msg, error_msg = run_command(
-                            speaker,
-                            action,
-                            *args,
-                            use_local_speaker_list=use_local_speaker_list,
-                        )
-                        if exit_code == 0:
-                            if len(output_msg) != 0:
-                                num_lines = len(output_msg.splitlines())
-                                if num_lines > 1 and last_line_was_single_line:
-                                    print()
-                                    last_line_was_single_line = False
-                                if num_lines == 1:
-                                    last_line_was_single_line = True
-                            else:
-                                output_msg = "OK"
-                            print(speaker.player_name + ": ", end="", flush=True)
-                            print(output_msg, flush=True)
-                        elif len(error_msg) != 0:
-                            print(speaker.player_name + ": ", end="", flush=True)
-                            print(error_msg, file=sys.stderr, flush=True)
-                        cumulative_exit_code += exit_code
-            else:
-                speaker = get_speaker(speaker_name, use_local_speaker_list)
-                if not speaker:
-                    print(
-                        "Error: Speaker '{}' not found".format(speaker_name),
-                        file=sys.stderr,
-                        flush=True,
-                    )
-                    cumulative_exit_code += 1
-                else:
-                    # Special case of 'track_follow' action
-                    if action in ["track_follow", "tf", "track_follow_compact", "tfc"]:
-                        if len(args) > 0:
-                            print(
-                                "Error: Action '{}' takes no parameters".format(action),
-                                file=sys.stderr,
-                                flush=True,
-                            )
-                            continue
-                        # Does not return
-                        compact = action in ["track_follow_compact", "tfc"]
-                        track_follow(
-                            speaker,
-                            use_local_speaker_list=use_local_speaker_list,
-                            break_on_pause=False,
-                            compact=compact,
-                        )
-                    # Standard action processing
-                    logging.info(
-                        "Invoking 'run_command' with '{} {} ...'".format(
-                            speaker, action
-                        )
-                    )
-                    exit_code, output_msg, error_msg = run_command(
-                        speaker,
-                        action,
-                        *args,
-                        use_local_speaker_list=use_local_speaker_list,
-                    )
-                    if exit_code == 0 and len(output_msg) != 0:
-                        print(output_msg, flush=True)
-                    elif len(error_msg) != 0:
-                        print(error_msg, file=sys.stderr, flush=True)
-                    cumulative_exit_code += exit_code
-
-        except Exception as e:
-            print("Error:", str(e), flush=True)
-            cumulative_exit_code += 1
-
-        sequence_pointer += 1
-
-    exit(cumulative_exit_code)
+    exit(
+        process_sequences(
+            sequences,
+            use_local_speaker_list=use_local_speaker_list,
+            env_speaker=env_speaker,
+            concurrent=args.concurrent,
+            max_parallel=args.max_parallel,
+            processes=args.processes,
+            shard_by=args.shard_by,
+        )
+    )
 
 
 if __name__ == "__main__":
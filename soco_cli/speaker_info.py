@@ -4,6 +4,12 @@ import datetime
 
 import tabulate  # type: ignore
 
+from soco_cli.circuit_breaker import (
+    DeviceUnavailableError,
+    circuit_breaker,
+    is_connection_failure,
+)
+
 # Collect speaker information from each speaker in turn
 headers = [
     "Zone Name",
@@ -36,10 +42,21 @@ def print_speaker_table(device):
         )
 
     for sco in device.all_zones:
+        # Skip speakers that aren't responding
+        if circuit_breaker().is_open(sco.ip_address):
+            add_err_and_exc(
+                sco.player_name,
+                sco.ip_address,
+                DeviceUnavailableError("Not responding"),
+            )
+            continue
+
         # Load the speaker info
         try:
             sco.get_speaker_info()
         except BaseException as e:
+            if is_connection_failure(e):
+                circuit_breaker().record_failure(sco.ip_address)
             add_err_and_exc(sco.player_name, sco.ip_address, e)
             continue
 
@@ -0,0 +1,110 @@
+"""Named speaker sets.
+
+A speaker set is a named group of speakers, e.g., '@downstairs', that can be
+used wherever a speaker name is accepted. Actions on a set are performed on
+each of its members concurrently.
+
+Sets are defined in the file '~/.soco-cli/speaker_sets.txt', one per line:
+
+    # Comments start with '#'
+    downstairs = Kitchen, Lounge, Dining Room
+    bar_area = Bar, Patio
+    everywhere = @downstairs, @bar_area, Study
+
+Members can be speaker names, IP addresses, or other sets. The file is
+re-read when it changes.
+"""
+
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from soco_cli.utils import SOCO_CLI_DIR
+
+SET_PREFIX = "@"
+SPEAKER_SETS_FILE = os.path.join(SOCO_CLI_DIR, "speaker_sets.txt")
+
+_lock = threading.Lock()
+# The loaded sets, and the modification time of the file they were loaded from
+_loaded = ({}, None)  # type: Tuple[Dict[str, List[str]], Optional[float]]
+
+
+def is_speaker_set(name) -> bool:
+    return isinstance(name, str) and name.startswith(SET_PREFIX)
+
+
+def parse_speaker_sets(lines: List[str]) -> Dict[str, List[str]]:
+    """Parse speaker set definitions, returning a map of set name (lower case,
+    without the '@' prefix) -> member names.
+
+    Raises:
+        ValueError: If a line isn't a valid definition.
+    """
+    speaker_sets = {}  # type: Dict[str, List[str]]
+    for line_number, line in enumerate(lines, start=1):
+        line = line.split("#", 1)[0].strip()
+        if line == "":
+            continue
+        name, separator, members = line.partition("=")
+        name = name.strip().lstrip(SET_PREFIX).lower()
+        members_list = [m.strip() for m in members.split(",") if m.strip() != ""]
+        if separator == "" or name == "" or len(members_list) == 0:
+            raise ValueError(
+                "Line {}: expected 'name = speaker, speaker, ...'".format(line_number)
+            )
+        speaker_sets[name] = members_list
+    return speaker_sets
+
+
+def load_speaker_sets(filename: str = SPEAKER_SETS_FILE) -> Dict[str, List[str]]:
+    """Load the speaker set definitions, if the file has changed since it was
+    last loaded."""
+    global _loaded
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return {}
+    with _lock:
+        if _loaded[1] == mtime:
+            return _loaded[0]
+        logging.info("Loading speaker sets from '{}'".format(filename))
+        with open(filename, "r") as f:
+            speaker_sets = parse_speaker_sets(f.readlines())
+        _loaded = (speaker_sets, mtime)
+        return speaker_sets
+
+
+def speaker_set_members(
+    set_name: str, speaker_sets: Optional[Dict[str, List[str]]] = None
+) -> List[str]:
+    """Return the names of the speakers in a set, expanding any sets that it
+    contains. Each speaker is included once.
+
+    Raises:
+        ValueError: If the set (or a set it contains) isn't defined, or if sets
+            contain each other.
+    """
+    if speaker_sets is None:
+        speaker_sets = load_speaker_sets()
+    members = []  # type: List[str]
+    _expand(set_name, speaker_sets, members, [])
+    return members
+
+
+def _expand(
+    set_name: str,
+    speaker_sets: Dict[str, List[str]],
+    members: List[str],
+    expanding: List[str],
+) -> None:
+    key = set_name.lstrip(SET_PREFIX).lower()
+    if key in expanding:
+        raise ValueError("Speaker set '{}{}' contains itself".format(SET_PREFIX, key))
+    if key not in speaker_sets:
+        raise ValueError("Speaker set '{}{}' not defined".format(SET_PREFIX, key))
+    for member in speaker_sets[key]:
+        if is_speaker_set(member):
+            _expand(member, speaker_sets, members, expanding + [key])
+        elif member.lower() not in [m.lower() for m in members]:
+            members.append(member)
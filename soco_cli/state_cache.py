@@ -0,0 +1,152 @@
+"""A cache of recently known speaker state, used for write elision.
+
+When write elision is enabled (see 'SoCoCLIContext.elide_writes'), setting a
+value that a speaker is already known to have, e.g., 'volume 25' when the
+volume is already 25, is skipped instead of sending a request to the speaker.
+
+The cache is fed by the values read and written by SoCo-CLI actions, which are
+trusted for 'max_age' seconds, and optionally by RenderingControl events from
+speakers that are being watched. The attributes reported by the events (e.g.,
+volume and mute) are trusted for as long as the event subscription is active;
+other attributes (e.g., the status light) are never refreshed by events, so are
+still only trusted for 'max_age' seconds. Speaker state is shared by all
+contexts.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from soco import SoCo  # type: ignore
+
+# How long (in seconds) read or written values are trusted
+STATE_MAX_AGE = 10.0
+
+# The speaker attributes reported by RenderingControl events, and how to
+# convert them from event variables
+_EVENT_VARIABLES = {
+    "volume": ("volume", lambda v: int(v["Master"])),
+    "mute": ("mute", lambda v: v["Master"] == "1"),
+    "loudness": ("loudness", lambda v: v["Master"] == "1"),
+    "night_mode": ("night_mode", lambda v: v == "1"),
+    "dialog_level": ("dialog_mode", lambda v: v == "1"),
+}
+_EVENT_ATTRIBUTES = {attribute for attribute, _ in _EVENT_VARIABLES.values()}
+
+
+class StateCache:
+    def __init__(self, max_age: float = STATE_MAX_AGE, watch_events: bool = False):
+        self.max_age = max_age
+        # Whether to subscribe to events from the speakers passed to 'watch()'
+        self.watch_events = watch_events
+        self._lock = threading.Lock()
+        # (IP address, attribute) -> (value, time recorded)
+        self._state = {}  # type: Dict[Tuple[str, str], Tuple[Any, float]]
+        # IP address -> event subscription
+        self._subscriptions = {}  # type: Dict[str, Any]
+
+    def get(self, ip_address: str, attribute: str) -> Tuple[bool, Any]:
+        """Return (True, value) if the attribute's value is known, or
+        (False, None) if it isn't."""
+        with self._lock:
+            entry = self._state.get((ip_address, attribute))
+            if entry is None:
+                return False, None
+            value, recorded = entry
+            if (
+                attribute in _EVENT_ATTRIBUTES
+                and self._subscriptions.get(ip_address) is not None
+            ):
+                return True, value
+            if time.monotonic() - recorded <= self.max_age:
+                return True, value
+            del self._state[(ip_address, attribute)]
+            return False, None
+
+    def record(self, ip_address: str, attribute: str, value: Any) -> None:
+        with self._lock:
+            self._state[(ip_address, attribute)] = (value, time.monotonic())
+
+    def invalidate(self, ip_address: Optional[str] = None) -> None:
+        """Forget the state of one speaker, or of all speakers."""
+        with self._lock:
+            if ip_address is None:
+                self._state.clear()
+            else:
+                for key in [k for k in self._state if k[0] == ip_address]:
+                    del self._state[key]
+
+    def record_event(self, ip_address: str, event) -> None:
+        """Record the state reported by a RenderingControl event."""
+        for variable, (attribute, convert) in _EVENT_VARIABLES.items():
+            if variable not in event.variables:
+                continue
+            try:
+                self.record(ip_address, attribute, convert(event.variables[variable]))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    def watch(self, speaker: SoCo) -> None:
+        """Subscribe to RenderingControl events from the speaker, if event
+        watching is enabled and the speaker isn't already being watched."""
+        if not self.watch_events:
+            return
+        ip_address = speaker.ip_address
+        with self._lock:
+            if ip_address in self._subscriptions:
+                return
+            # Reserve the slot while subscribing
+            self._subscriptions[ip_address] = None
+        try:
+            subscription = speaker.renderingControl.subscribe(
+                auto_renew=True, event_queue=_EventRecorder(self, ip_address)
+            )
+        except Exception as e:
+            logging.info("Failed to subscribe to {}: {}".format(ip_address, e))
+            with self._lock:
+                self._subscriptions.pop(ip_address, None)
+            return
+        logging.info("Watching state of {}".format(ip_address))
+        subscription.auto_renew_fail = lambda e: self._unwatch(ip_address)
+        with self._lock:
+            self._subscriptions[ip_address] = subscription
+
+    def _unwatch(self, ip_address: str) -> None:
+        logging.info("Stopped watching state of {}".format(ip_address))
+        with self._lock:
+            self._subscriptions.pop(ip_address, None)
+        self.invalidate(ip_address)
+
+    def unwatch_all(self) -> None:
+        """Cancel all event subscriptions."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.items())
+            self._subscriptions.clear()
+        for ip_address, subscription in subscriptions:
+            self.invalidate(ip_address)
+            if subscription is None:
+                continue
+            try:
+                subscription.unsubscribe()
+            except Exception as e:
+                logging.info("Failed to unsubscribe: {}".format(e))
+
+
+class _EventRecorder:
+    """Records the state from a speaker's events. SoCo puts received events
+    on a subscription's queue by calling 'put()'."""
+
+    def __init__(self, cache: StateCache, ip_address: str):
+        self._cache = cache
+        self._ip_address = ip_address
+
+    def put(self, event, *args, **kwargs) -> None:
+        self._cache.record_event(self._ip_address, event)
+
+
+_state_cache = StateCache()
+
+
+def state_cache() -> StateCache:
+    return _state_cache
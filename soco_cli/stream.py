@@ -0,0 +1,139 @@
+"""Run commands supplied as newline-delimited JSON on stdin.
+
+Each input line is a JSON object describing a single command:
+
+    {"id": "req-1", "speaker": "Kitchen", "action": "volume", "args": ["25"]}
+
+One JSON result line is written to stdout for each command, as soon as it
+completes:
+
+    {"id": "req-1", "speaker": "Kitchen", "action": "volume", "exit_code": 0,
+     "output": "", "error": "", "latency": 0.042}
+
+Commands for the same speaker are run in the order in which they are received.
+Commands for different speakers run concurrently, so results may be written in
+a different order from the input; the 'id' (which defaults to the input line
+number) identifies the command to which each result belongs.
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+from soco_cli.api import run_command
+from soco_cli.keyed_executor import KeyedExecutor
+
+# The maximum number of commands to run concurrently
+MAX_STREAM_WORKERS = 16
+
+
+class _ResultWriter:
+    """Writes JSON result lines, one at a time."""
+
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self.failed = 0
+
+    def write(self, result: Dict[str, Any]) -> None:
+        line = json.dumps(result)
+        with self._lock:
+            if result["exit_code"] != 0:
+                self.failed += 1
+            self._stream.write(line + "\n")
+            self._stream.flush()
+
+
+def _parse_command(line: str, line_number: int) -> Dict[str, Any]:
+    """Parse and check a JSON command line.
+
+    Raises:
+        ValueError: If the line is not a valid command.
+    """
+    command = json.loads(line)
+    if not isinstance(command, dict):
+        raise ValueError("Command must be a JSON object")
+    command.setdefault("id", line_number)
+    for field in ["speaker", "action"]:
+        if not isinstance(command.get(field), str):
+            raise ValueError("Command must include a '{}' string".format(field))
+    args = command.get("args", [])
+    if not isinstance(args, list):
+        raise ValueError("'args' must be a list")
+    command["args"] = [str(arg) for arg in args]
+    return command
+
+
+def _run_stream_command(
+    command: Dict[str, Any], use_local_speaker_list: bool, writer: _ResultWriter
+) -> None:
+    start_time = time.time()
+    exit_code, output, error = run_command(
+        command["speaker"],
+        command["action"],
+        *command["args"],
+        use_local_speaker_list=use_local_speaker_list,
+    )
+    writer.write({
+        "id": command["id"],
+        "speaker": command["speaker"],
+        "action": command["action"],
+        "exit_code": exit_code,
+        "output": output.strip("\n"),
+        "error": error,
+        "latency": round(time.time() - start_time, 4),
+    })
+
+
+def run_stream(
+    input_stream: Optional[TextIO] = None,
+    output_stream: Optional[TextIO] = None,
+    use_local_speaker_list: bool = False,
+    max_workers: int = MAX_STREAM_WORKERS,
+) -> int:
+    """Read JSON commands from 'input_stream' until EOF, and write a JSON result
+    line to 'output_stream' for each command.
+
+    Args:
+        input_stream (TextIO, optional): The input stream. Defaults to stdin.
+        output_stream (TextIO, optional): The output stream. Defaults to stdout.
+        use_local_speaker_list (bool): Whether to use the local speaker list.
+        max_workers (int): The maximum number of commands to run concurrently.
+
+    Returns:
+        int: The number of commands that returned a non-zero exit code.
+    """
+    if input_stream is None:
+        input_stream = sys.stdin
+    writer = _ResultWriter(output_stream if output_stream else sys.stdout)
+    logging.info("Reading JSON commands from input stream")
+    with KeyedExecutor(max_workers=max_workers) as executor:
+        for line_number, line in enumerate(input_stream, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                command = _parse_command(line, line_number)
+            except ValueError as error:
+                logging.info(
+                    "Invalid command on line {}: {}".format(line_number, error)
+                )
+                writer.write({
+                    "id": line_number,
+                    "exit_code": 1,
+                    "output": "",
+                    "error": "Error: Invalid command: {}".format(error),
+                    "latency": 0.0,
+                })
+                continue
+            executor.submit(
+                command["speaker"].lower(),
+                _run_stream_command,
+                command,
+                use_local_speaker_list,
+                writer,
+            )
+        logging.info("End of input stream: waiting for commands to complete")
+    return writer.failed
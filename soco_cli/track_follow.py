@@ -1,10 +1,10 @@
 import logging
-import re
 from datetime import datetime, timezone
 
 from soco import SoCo  # type: ignore
 
-from soco_cli.api import run_command
+from soco_cli.api import run_command, run_command_structured
+from soco_cli.utils import cancelled, pretty_print_values
 
 
 def track_follow(
@@ -24,7 +24,8 @@ def track_follow(
 
     This function operates as if 'outside' the main program logic, because
     it needs to output intermediate results as it executes. Hence, the
-    'run_command()' API call is used.
+    'run_command_structured()' API call is used, and the track details are
+    formatted here.
     """
 
     def timestamp(short=False):
@@ -36,11 +37,11 @@ def track_follow(
 
     counter = 1
     print()
-    while True:
+    while not cancelled():
         # If stopped, wait for the speaker to start playback
-        _, state, _ = run_command(
+        state = run_command_structured(
             speaker, "state", use_local_speaker_list=use_local_speaker_list
-        )
+        ).data
         if state in [
             "STOPPED",
             "PAUSED_PLAYBACK",
@@ -65,65 +66,53 @@ def track_follow(
             run_command(
                 speaker, "wait_start", use_local_speaker_list=use_local_speaker_list
             )
+            if cancelled():
+                break
             logging.info("Speaker has started playback")
 
         # Print the track info
-        exit_code, output, error_msg = run_command(
+        result = run_command_structured(
             speaker, "track", use_local_speaker_list=use_local_speaker_list
         )
-        if exit_code == 0:
-            # Manipulate output
-            if "Using Line In" in output:
-                line_in = True
-                output = "   Playing from Line In\n"
-            else:
-                line_in = False
-                output = output.split("\n ", 1)[1]
+        if result.exit_code == 0:
+            track = result.data
             if not compact:
-                # Remove some of the line entries
-                output = re.sub(".*Playback.*\\n", "", output)
-                # output = re.sub(".*Elapsed.*\\n", "", output)
-                output = re.sub(".*URI.*\\n", "", output)
-                output = re.sub(".*Uri.*\\n", "", output)
-                # Prefix speaker name and timestamp
-                output = (
-                    " [{}] Playing at ".format(speaker.player_name)
-                    + timestamp()
-                    + ":\n"
-                    + output
-                )
+                print(" [{}] Playing at {}:".format(speaker.player_name, timestamp()))
+                if track["line_in"]:
+                    print("   Playing from Line In")
+                else:
+                    pretty_print_values(
+                        track["details"], indent=3, spacing=5, sort_by_key=False
+                    )
+                print()
             else:  # Compact (one line) output
-                if line_in:
+                if track["line_in"]:
                     output = "{:5d}: [{}] Playing from Line In".format(
                         counter, timestamp(short=True)
                     )
                 else:
                     # Ordering of keys determines output order
                     keys = [
-                        "Channel:",
-                        "Radio Show:",
-                        "Artist:",
-                        "Creator(s):",
-                        "Book Title:",
-                        "Chapter:",
-                        "Album:",
-                        "Podcast:",
-                        "Title:",
-                        "Episode:",
-                        "Release Date:",
-                        "Narrator(s):",
+                        "Channel",
+                        "Radio Show",
+                        "Artist",
+                        "Creator(s)",
+                        "Book Title",
+                        "Chapter",
+                        "Album",
+                        "Podcast",
+                        "Title",
+                        "Episode",
+                        "Release Date",
+                        "Narrator(s)",
                     ]
-                    elements = {}
-                    for line in output.splitlines():
-                        for key in keys:
-                            if key in line:
-                                elements[key] = line.replace(key, "").lstrip()
+                    elements = dict(track["details"])
                     output = "{:5d}: [{}] ".format(counter, timestamp(short=True))
 
                     # Prune fields for audio books
-                    if "Book Title:" in elements:
-                        elements.pop("Title:", None)
-                        elements.pop("Narrator(s):", None)
+                    if "Book Title" in elements:
+                        elements.pop("Title", None)
+                        elements.pop("Narrator(s)", None)
                     first = True
                     for key in keys:
                         value = elements.pop(key, None)
@@ -132,11 +121,11 @@ def track_follow(
                                 output = output + "| "
                             else:
                                 first = False
-                            output = output + key + " " + value + " "
-            print(output)
+                            output = output + key + ": " + str(value) + " "
+                print(output)
         else:
             error_out = "{:5d}: [{}] {}".format(
-                counter, timestamp(short=True), error_msg
+                counter, timestamp(short=True), result.error_msg
             )
             print(error_out)
 
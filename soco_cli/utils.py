@@ -5,13 +5,17 @@ import logging
 import os
 import pickle
 import signal
+import threading
 
 try:
     import readline
 except ImportError:
     pass
 import sys
+from collections import Counter
 from collections.abc import Sequence
+from contextlib import contextmanager
+from functools import wraps
 from platform import python_version
 from time import sleep
 
@@ -35,19 +39,32 @@ def event_unsubscribe(sub):
     logging.info("Unsubscribed")
 
 
-INTERACTIVE = False
-API = False
 SINGLE_KEYSTROKE = False
 
 
 def set_interactive():
-    global INTERACTIVE
-    INTERACTIVE = True
+    default_context().interactive = True
 
 
 def set_api():
-    global API
-    API = True
+    default_context().api = True
+
+
+# Thread-local equivalent of the context's 'api' flag, set for the duration of
+# 'api_mode()'
+_api_mode = threading.local()
+
+
+@contextmanager
+def api_mode():
+    """Prevent errors from causing exit, in the current thread only, for the
+    duration of the context. Used by 'api.run_command()'."""
+    saved = getattr(_api_mode, "active", False)
+    _api_mode.active = True
+    try:
+        yield
+    finally:
+        _api_mode.active = saved
 
 
 def set_single_keystroke(sk):
@@ -60,11 +77,20 @@ def error_report(msg):
     # Print to stderr
     print("Error:", msg, file=sys.stderr, flush=True)
     # Use os._exit() to avoid the catch-all 'except'
-    if not (INTERACTIVE or API):
+    if errors_exit():
         logging.info("Exiting program using os._exit(1)")
         os._exit(1)
 
 
+def errors_exit():
+    """Whether 'error_report()' exits the program when called by the current
+    thread, i.e., outside interactive and API use."""
+    context = current_context()
+    return not (
+        context.interactive or context.api or getattr(_api_mode, "active", False)
+    )
+
+
 def parameter_type_error(action, required_params):
     msg = "Action '{}' takes parameter(s): {}".format(action, required_params)
     error_report(msg)
@@ -75,76 +101,79 @@ def parameter_number_error(action, parameter_number):
     error_report(msg)
 
 
-# Parameter count checking
-def zero_parameters(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) != 0:
-            parameter_number_error(args[1], "no")
-            return False
-
-        return f(*args, **kwargs)
+class ActionResult:
+    """Structured data returned by an action processing function, in place of
+    printing it. 'render' prints the data as the text shown by the CLI; it
+    must depend only on the data."""
 
-    return wrapper
-
-
-def one_parameter(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) != 1:
-            parameter_number_error(args[1], "1")
-            return False
-        return f(*args, **kwargs)
+    def __init__(self, data, render=None):
+        self.data = data
+        self._render = render
 
-    return wrapper
+    def render(self):
+        if self._render is None:
+            print(self.data)
+        else:
+            self._render(self.data)
 
+    def __bool__(self):
+        return True
 
-def zero_or_one_parameter(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) not in [0, 1]:
-            parameter_number_error(args[1], "0 or 1")
-            return False
-        return f(*args, **kwargs)
 
-    return wrapper
+# Parameter count checking
+def parameter_count(minimum, maximum, description):
+    """Create a decorator that checks the number of parameters supplied to an
+    action processing function.
+
+    The allowed range is recorded on the decorated function as
+    'parameter_counts', so that it can be checked before the action is run (see
+    'check_parameter_count()'). A 'maximum' of None means there is no upper
+    limit.
+    """
 
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _parameter_count_ok(len(args[2]), minimum, maximum):
+                parameter_number_error(args[1], description)
+                return False
+            return f(*args, **kwargs)
 
-def one_or_two_parameters(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) not in [1, 2]:
-            parameter_number_error(args[1], "1 or 2")
-            return False
-        return f(*args, **kwargs)
+        wrapper.parameter_counts = (minimum, maximum, description)
+        return wrapper
 
-    return wrapper
+    return decorator
 
 
-def two_parameters(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) != 2:
-            parameter_number_error(args[1], "2")
-            return False
-        return f(*args, **kwargs)
+def _parameter_count_ok(count, minimum, maximum):
+    return count >= minimum and (maximum is None or count <= maximum)
 
-    return wrapper
 
+def check_parameter_count(function, action, args):
+    """Check the number of parameters for an action processing function,
+    without running it.
 
-def zero_one_or_two_parameters(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) > 2:
-            parameter_number_error(args[1], "zero, one or two")
-            return False
-        return f(*args, **kwargs)
-
-    return wrapper
-
+    Returns:
+        str: An error message if the parameter count is wrong, otherwise None.
+        None is also returned if the function doesn't use a parameter count
+        decorator.
+    """
+    parameter_counts = getattr(function, "parameter_counts", None)
+    if parameter_counts is None:
+        return None
+    minimum, maximum, description = parameter_counts
+    if _parameter_count_ok(len(args), minimum, maximum):
+        return None
+    return "Action '{}' takes {} parameter(s)".format(action, description)
 
-def one_or_more_parameters(f):
-    def wrapper(*args, **kwargs):
-        if len(args[2]) < 1:
-            parameter_number_error(args[1], "1 or more")
-            return False
-        return f(*args, **kwargs)
 
-    return wrapper
+zero_parameters = parameter_count(0, 0, "no")
+one_parameter = parameter_count(1, 1, "1")
+zero_or_one_parameter = parameter_count(0, 1, "0 or 1")
+one_or_two_parameters = parameter_count(1, 2, "1 or 2")
+two_parameters = parameter_count(2, 2, "2")
+zero_one_or_two_parameters = parameter_count(0, 2, "zero, one or two")
+one_or_more_parameters = parameter_count(1, None, "1 or more")
 
 
 # Time manipulation
@@ -250,6 +279,124 @@ def logo():
     print("SoCo-CLI Logo: {}".format(url), flush=True)
 
 
+# Per-thread output redirection
+#
+# Output is captured by swapping in per-thread streams behind proxy objects
+# installed as 'sys.stdout' and 'sys.stderr'. Threads that have not set up a
+# capture continue to write to the streams that were in place when the proxies
+# were installed, so capturing output in one thread (e.g., 'api.run_command()')
+# does not swallow output from other threads (e.g., interactive shell jobs).
+_output = threading.local()
+
+
+class ThreadRoutedStream:
+    """A stream proxy that writes to the current thread's capture stream, if
+    there is one, or to the default stream otherwise."""
+
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    @property
+    def target(self):
+        return getattr(_output, self._name, None) or self._default
+
+    def write(self, text):
+        return self.target.write(text)
+
+    def flush(self):
+        return self.target.flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self.target, attribute)
+
+
+def _install_output_routing():
+    if not isinstance(sys.stdout, ThreadRoutedStream):
+        sys.stdout = ThreadRoutedStream("stdout", sys.stdout)
+    if not isinstance(sys.stderr, ThreadRoutedStream):
+        sys.stderr = ThreadRoutedStream("stderr", sys.stderr)
+
+
+@contextmanager
+def capture_output(stdout, stderr):
+    """Redirect this thread's stdout and stderr to the supplied streams for
+    the duration of the context."""
+    _install_output_routing()
+    saved = (getattr(_output, "stdout", None), getattr(_output, "stderr", None))
+    _output.stdout, _output.stderr = stdout, stderr
+    try:
+        yield
+    finally:
+        _output.stdout, _output.stderr = saved
+
+
+def output_targets():
+    """Return the streams (stdout, stderr) that this thread's output is
+    written to: its capture streams, if output is being captured, or the
+    default streams otherwise."""
+    return tuple(
+        getattr(stream, "target", stream) for stream in (sys.stdout, sys.stderr)
+    )
+
+
+def output_streamed():
+    """Whether this thread's output is being streamed (see
+    'api.stream_command()'), i.e., delivered as it's printed."""
+    return getattr(getattr(_output, "stdout", None), "streaming", False)
+
+
+def release_output():
+    """Stop capturing output in this thread, and write to the default streams
+    instead. Used by actions that need to print progress as they execute.
+    Output that is being streamed is already delivered as it's printed, so it
+    isn't released."""
+    if output_streamed():
+        return
+    _output.stdout = None
+    _output.stderr = None
+
+
+# Cooperative cancellation of actions running as interactive shell jobs
+_job = threading.local()
+
+
+def set_cancel_event(event):
+    """Associate a threading.Event with the current thread. Long-running
+    actions will return early once the event is set."""
+    _job.cancel_event = event
+
+
+def get_cancel_event():
+    """Return the current thread's cancellation event, if any, so that it can
+    be passed on to worker threads."""
+    return getattr(_job, "cancel_event", None)
+
+
+def cancelled():
+    event = getattr(_job, "cancel_event", None)
+    return event is not None and event.is_set()
+
+
+def interruptible_sleep(duration):
+    """Sleep for 'duration' seconds, returning early if the current thread's
+    action is cancelled. Returns False if cancelled."""
+    event = getattr(_job, "cancel_event", None)
+    if event is None:
+        sleep(duration)
+        return True
+    return not event.wait(duration)
+
+
+# Cancelled by CTRL-C when an interactive shell job is in the foreground
+foreground_cancel_event = None
+
+
+def set_foreground_cancel_event(event):
+    global foreground_cancel_event
+    foreground_cancel_event = event
+
+
 # Suspend signal handling processing for 'exec' in interactive shell
 suspend_sighandling = False
 
@@ -284,26 +431,30 @@ def sig_handler(signal_received, frame):
 
     # Restore stdout and stderr ... these have been redirected if
     # api.run_command() was used
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
+    release_output()
 
     # Prevent SIGINT (CTRL-C) exit: untidy exit from readline can leave
     # some terminals in a broken state
     if signal_received == signal.SIGINT:
+        if foreground_cancel_event:
+            logging.info("Cancelling foreground job")
+            foreground_cancel_event.set()
+            return
+
         if SINGLE_KEYSTROKE:
             logging.info("SINGLE_KEYSTROKE set ... preventing exit")
             print("\nPlease use 'x' to exit >> ", end="", flush=True)
             return
 
-        if INTERACTIVE:
-            logging.info("INTERACTIVE set ... preventing exit")
+        if current_context().interactive:
+            logging.info("Interactive ... preventing exit")
             print("\nPlease use 'exit' to terminate the shell > ", end="", flush=True)
             if os.name == "nt":
                 print(flush=True)
             return
 
     # Allow SIGTERM termination, but issue warning if interactive
-    if signal_received == signal.SIGTERM and INTERACTIVE:
+    if signal_received == signal.SIGTERM and current_context().interactive:
         print("\nSoCo-CLI process terminating ...", flush=True)
         print(
             "This can leave some terminals in a misconfigured state.",
@@ -407,54 +558,62 @@ def configure_logging(log_level: str) -> None:
             )
 
 
-# Local speaker list operations
-speaker_list = None
-
-
-def set_speaker_list(s):
-    global speaker_list
-    speaker_list = s
-
-
 class SpeakerCache:
     def __init__(self, max_threads=256, scan_timeout=0.1, min_netmask=24):
         # _cache contains (soco_instance, speaker_name) tuples
         self._cache = set()
         self._scan_done = False
         self._discovery_done = False
+        # Held while the cache is updated. The cache set is replaced rather
+        # than modified in place, so readers can iterate over it without
+        # holding the lock.
+        self._lock = threading.RLock()
         self._max_threads = max_threads
         self._scan_timeout = scan_timeout
         self._min_netmask = min_netmask
+        # The number of name lookups resolved by each method (see
+        # 'get_speaker()'), or that failed
+        self.lookups = Counter()
 
     @property
     def exists(self):
         return bool(self._cache)
 
+    def names(self):
+        return sorted(speaker_name for _, speaker_name in self._cache)
+
     def cache_speakers(self, speakers):
         logging.info("Adding speakers to cache: {}".format(speakers))
-        for speaker in speakers:
-            self._cache.add((speaker, speaker.player_name))
+        entries = {(speaker, speaker.player_name) for speaker in speakers}
+        with self._lock:
+            self._cache = self._cache | entries
 
     def discover(self, reset=False):
-        if not self._discovery_done or reset:
-            # Clear the current cache
-            self._cache = set()
-            speakers = soco.discovery.discover(
-                allow_network_scan=True,
-                max_threads=self._max_threads,
-                scan_timeout=self._scan_timeout,
-                min_netmask=self._min_netmask,
-            )
-            if speakers:
-                self.cache_speakers(speakers)
-            else:
-                logging.info("No speakers found to cache")
-            self._discovery_done = True
+        with self._lock:
+            if not self._discovery_done or reset:
+                self._discover()
+
+    def _discover(self):
+        speakers = soco.discovery.discover(
+            allow_network_scan=True,
+            max_threads=self._max_threads,
+            scan_timeout=self._scan_timeout,
+            min_netmask=self._min_netmask,
+        )
+        # Replace the current cache
+        self._cache = set()
+        if speakers:
+            self.cache_speakers(speakers)
+        else:
+            logging.info("No speakers found to cache")
+        self._discovery_done = True
 
     def scan(self, reset=False, scan_timeout_override=None):
+        with self._lock:
+            self._scan(reset=reset, scan_timeout_override=scan_timeout_override)
+
+    def _scan(self, reset=False, scan_timeout_override=None):
         if not self._scan_done or reset:
-            # Clear the current cache
-            self._cache = set()
             scan_timeout = (
                 scan_timeout_override if scan_timeout_override else self._scan_timeout
             )
@@ -467,6 +626,8 @@ class SpeakerCache:
                 scan_timeout=scan_timeout,
                 min_netmask=self._min_netmask,
             )
+            # Replace the current cache
+            self._cache = set()
             if speakers:
                 self.cache_speakers(speakers)
                 self._scan_done = True
@@ -477,7 +638,7 @@ class SpeakerCache:
 
     def add(self, speaker):
         logging.info("Adding speaker to cache")
-        self._cache.add((speaker, speaker.player_name))
+        self.cache_speakers([speaker])
 
     def find_indirect(self, name):
         speakers_found = set()
@@ -539,35 +700,148 @@ class SpeakerCache:
         return names
 
     def rename_speaker(self, old_name, new_name):
-        for speaker in self._cache:
-            if speaker[1] == old_name:
-                logging.info("Updating speaker cache with new name")
-                self._cache.remove(speaker)
-                self._cache.add((speaker[0], new_name))
-                return True
+        with self._lock:
+            for speaker in self._cache:
+                if speaker[1] == old_name:
+                    logging.info("Updating speaker cache with new name")
+                    self._cache = (self._cache - {speaker}) | {(speaker[0], new_name)}
+                    return True
         logging.info("Speaker with name '{}' not found".format(old_name))
         return False
 
 
-SPKR_CACHE = None
+class SoCoCLIContext:
+    """The state used to find speakers and run actions: the speaker cache used
+    for discovery, the local speaker list, the discovery settings, whether
+    errors should cause exit, and whether writes of values that speakers
+    already have should be skipped ('elide_writes').
+
+    Contexts are isolated from each other, so one process can host several
+    of them (e.g., one per site or household). Actions use the context passed
+    to 'process_action()' or 'api.run_command()', or else the default context.
+    """
+
+    def __init__(
+        self,
+        max_threads=256,
+        scan_timeout=1.0,
+        min_netmask=24,
+        speaker_list=None,
+        api=False,
+        elide_writes=False,
+    ):
+        self.max_threads = max_threads
+        self.scan_timeout = scan_timeout
+        self.min_netmask = min_netmask
+        self.speaker_cache = None
+        self.speaker_list = speaker_list
+        # Prevent errors from causing exit
+        self.api = api
+        self.interactive = False
+        self.elide_writes = elide_writes
+        self._speaker_list_loaded = False
+        self._lock = threading.Lock()
+
+    def create_speaker_cache(
+        self, max_threads=None, scan_timeout=None, min_netmask=None
+    ):
+        """Replace the speaker cache, optionally changing the discovery
+        settings."""
+        with self._lock:
+            if max_threads is not None:
+                self.max_threads = max_threads
+            if scan_timeout is not None:
+                self.scan_timeout = scan_timeout
+            if min_netmask is not None:
+                self.min_netmask = min_netmask
+            self.speaker_cache = self._new_speaker_cache()
+
+    def ensure_speaker_cache(self):
+        """Return the speaker cache, creating it if necessary."""
+        with self._lock:
+            if self.speaker_cache is None:
+                self.speaker_cache = self._new_speaker_cache()
+            return self.speaker_cache
+
+    def _new_speaker_cache(self):
+        return SpeakerCache(
+            max_threads=self.max_threads,
+            scan_timeout=self.scan_timeout,
+            min_netmask=self.min_netmask,
+        )
+
+    def set_speaker_list(self, speaker_list):
+        """Use an already loaded local speaker list."""
+        with self._lock:
+            self.speaker_list = speaker_list
+            self._speaker_list_loaded = True
+
+    def ensure_speaker_list(self):
+        """Return the local speaker list, loading it from its file (or
+        discovering speakers, if there's no file) if necessary."""
+        with self._lock:
+            if not self._speaker_list_loaded:
+                if self.speaker_list is None:
+                    self.speaker_list = Speakers()
+                if not self.speaker_list.load():
+                    logging.info("Start speaker discovery")
+                    self.speaker_list.discover()
+                    self.speaker_list.save()
+                self._speaker_list_loaded = True
+            return self.speaker_list
+
+
+_default_context = SoCoCLIContext()
+
+# The context in use by the current thread, if not the default context
+_current_context = threading.local()
+
+
+def default_context():
+    return _default_context
+
+
+def current_context():
+    """Return the context in use by the current thread."""
+    context = getattr(_current_context, "context", None)
+    return context if context is not None else _default_context
+
+
+@contextmanager
+def use_context(context):
+    """Use 'context' in the current thread for the duration of the context
+    manager. If 'context' is None, the current context continues in use."""
+    if context is None:
+        yield
+        return
+    saved = getattr(_current_context, "context", None)
+    _current_context.context = context
+    try:
+        yield
+    finally:
+        _current_context.context = saved
 
 
-# Single instance of the speaker cache
 def create_speaker_cache(max_threads=256, scan_timeout=1.0, min_netmask=24):
-    global SPKR_CACHE
-    SPKR_CACHE = SpeakerCache(
+    """Create the speaker cache of the current context."""
+    current_context().create_speaker_cache(
         max_threads=max_threads, scan_timeout=scan_timeout, min_netmask=min_netmask
     )
 
 
 def speaker_cache():
-    """Return the global speaker cache object"""
-    return SPKR_CACHE
+    """Return the speaker cache of the current context."""
+    return current_context().speaker_cache
+
+
+def set_speaker_list(s):
+    """Set the local speaker list of the current context."""
+    current_context().set_speaker_list(s)
 
 
 def local_speaker_list():
-    """Return the global speaker list object"""
-    return speaker_list
+    """Return the local speaker list of the current context."""
+    return current_context().speaker_list
 
 
 def get_speaker(name, local=False):
@@ -580,30 +854,37 @@ def get_speaker(name, local=False):
     # Use the local speaker list
     if local:
         logging.info("Using local speaker list")
-        return speaker_list.find(name)
+        return local_speaker_list().find(name)
 
     # Use discovery
     # Try various lookup methods in order of expense,
     # and cache results where possible
+    cache = speaker_cache()
     speaker = None
+    method = "direct"
     if not speaker:
         logging.info("Trying direct cache lookup")
-        speaker = SPKR_CACHE.find(name)
+        speaker = cache.find(name)
     if not speaker:
         logging.info("Trying indirect cache lookup")
-        speaker = SPKR_CACHE.find_indirect(name)
+        method = "indirect"
+        speaker = cache.find_indirect(name)
     if not speaker:
         logging.info("Trying standard discovery with network scan fallback")
-        SPKR_CACHE.discover()
-        speaker = SPKR_CACHE.find(name)
+        method = "discovery"
+        cache.discover()
+        speaker = cache.find(name)
     if not speaker:
         logging.info("Trying network scan discovery")
-        SPKR_CACHE.scan()
-        speaker = SPKR_CACHE.find(name)
+        method = "scan"
+        cache.scan()
+        speaker = cache.find(name)
     if speaker:
         logging.info("Successful speaker discovery")
     else:
         logging.info("Failed to discover speaker")
+        method = "failed"
+    cache.lookups[method] += 1
     return speaker
 
 
@@ -635,8 +916,8 @@ def get_right_hand_speaker(left_hand_speaker):
 
 def rename_speaker_in_cache(old_name, new_name, use_local_speaker_list=True):
     if use_local_speaker_list:
-        return speaker_list.rename(old_name, new_name)
-    return SPKR_CACHE.rename_speaker(old_name, new_name)
+        return local_speaker_list().rename(old_name, new_name)
+    return speaker_cache().rename_speaker(old_name, new_name)
 
 
 # Argument processing
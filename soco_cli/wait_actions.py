@@ -1,10 +1,14 @@
 """Process the speaker-independent 'wait' actions."""
 
 import logging
-import time
 from typing import List
 
-from soco_cli.utils import convert_to_seconds, error_report, seconds_until
+from soco_cli.utils import (
+    convert_to_seconds,
+    error_report,
+    interruptible_sleep,
+    seconds_until,
+)
 
 
 def process_wait(sequence: List):
@@ -25,7 +29,7 @@ def process_wait(sequence: List):
                 " 'h/m/s', or HH:MM(:SS)"
             )
         logging.info("Waiting for {}s".format(duration))
-        time.sleep(duration)
+        interruptible_sleep(duration)
 
     # Special case: the 'wait_until' action
     elif sequence[0] in ["wait_until"]:
@@ -39,7 +43,7 @@ def process_wait(sequence: List):
             action = sequence[1].lower()
             duration = seconds_until(action)
             logging.info("Waiting for {}s".format(duration))
-            time.sleep(duration)
+            interruptible_sleep(duration)
         except ValueError:
             error_report(
                 "'wait_until' requires parameter: time in 24hr HH:MM(:SS) format"
@@ -1,6 +1,65 @@
+import asyncio
+import datetime
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from functools import partial
+from io import StringIO
+from unittest import mock
 
-from soco_cli.utils import convert_to_seconds
+import requests
+from soco import SoCo
+from soco.services import Service
+
+from soco_cli import (
+    aio,
+    alarms,
+    fleet,
+    http_api,
+    interactive,
+    limiter,
+    metrics,
+    read_cache,
+    soap_requests,
+    utils,
+)
+from soco_cli.action_processor import actions
+from soco_cli.api import (
+    get_soco_object,
+    run_command,
+    run_command_structured,
+    run_commands,
+    stream_command,
+)
+from soco_cli.circuit_breaker import (
+    ActionPolicy,
+    CircuitBreaker,
+    DeviceUnavailableError,
+)
+from soco_cli.cmd_parser import CLIParser, ParallelSequences
+from soco_cli.event_hub import EventHub
+from soco_cli.fleet import FleetRunner
+from soco_cli.jobs import JobManager
+from soco_cli.keyed_executor import KeyedExecutor
+from soco_cli.limiter import Limiter
+from soco_cli.planner import ActionStep, LoopStep, Plan, Planner, WaitStep
+from soco_cli.result_cache import CachedResult, ResultCache
+from soco_cli.scheduler import CronSchedule, Scheduler, parse_schedule
+from soco_cli.script import parse_script
+from soco_cli.sequence_processor import execute_plan
+from soco_cli.speaker_sets import parse_speaker_sets, speaker_set_members
+from soco_cli.state_cache import StateCache, state_cache
+from soco_cli.utils import (
+    ActionResult,
+    SoCoCLIContext,
+    api_mode,
+    capture_output,
+    convert_to_seconds,
+    interruptible_sleep,
+    local_speaker_list,
+)
 
 
 class ConvertToSeconds(unittest.TestCase):
@@ -17,5 +76,1017 @@ class ConvertToSeconds(unittest.TestCase):
         assert convert_to_seconds("2h") == 2 * 60 * 60
 
 
+class CaptureOutput(unittest.TestCase):
+    def test_capture_is_per_thread(self):
+        def worker(text, stream):
+            with capture_output(stream, StringIO()):
+                for _ in range(100):
+                    print(text)
+
+        streams = [StringIO() for _ in range(4)]
+        threads = [
+            threading.Thread(target=worker, args=(str(i), stream))
+            for i, stream in enumerate(streams)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i, stream in enumerate(streams):
+            assert stream.getvalue() == (str(i) + "\n") * 100
+
+
+class ConcurrentRunCommand(unittest.TestCase):
+    def test_run_command_is_thread_safe(self):
+        # Parameter count errors are reported without contacting the speaker
+        speaker = SoCo("192.168.0.1")
+        results = {}
+
+        def worker(action):
+            for _ in range(50):
+                results.setdefault(action, set()).add(
+                    run_command(speaker, action, "1", "2", "3")
+                )
+
+        actions = ["volume", "bass", "treble", "relative_volume"]
+        threads = [threading.Thread(target=worker, args=(a,)) for a in actions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for action in actions:
+            assert len(results[action]) == 1
+            exit_code, output, error = results[action].pop()
+            assert exit_code == 1
+            assert output == ""
+            assert error.startswith("Error: Action '{}' takes".format(action))
+
+
+class StructuredResults(unittest.TestCase):
+    def test_structured_and_text_results(self):
+        speaker = SoCo("192.168.0.1")
+        action_result = ActionResult(
+            {"state": "PLAYING", "volume": 25},
+            lambda data: print("Volume is {}".format(data["volume"])),
+        )
+        with mock.patch("soco_cli.api.process_action", lambda *a, **k: action_result):
+            assert run_command(speaker, "test") == (0, "Volume is 25", "")
+            result = run_command_structured(speaker, "test")
+        assert result.exit_code == 0
+        assert result.data == {"state": "PLAYING", "volume": 25}
+        assert result.output == "Volume is 25"
+
+    def test_render_failure(self):
+        speaker = SoCo("192.168.0.1")
+
+        def render(data):
+            print("Partial")
+            raise ValueError("Bad data")
+
+        action_result = ActionResult({}, render)
+        with mock.patch("soco_cli.api.process_action", lambda *a, **k: action_result):
+            assert run_command(speaker, "test") == (1, "Partial", "Error: Bad data")
+
+
+class StreamCommand(unittest.TestCase):
+    def test_output_streamed_by_line(self):
+        speaker = SoCo("192.168.0.1")
+
+        def fake_process_action(*args, **kwargs):
+            print("first")
+            print("second", end="")
+            return ActionResult({"volume": 25}, lambda data: print(data["volume"]))
+
+        with mock.patch("soco_cli.api.process_action", fake_process_action):
+            events = list(stream_command(speaker, "test"))
+        assert events[:2] == [("output", "first\n"), ("output", "second25\n")]
+        assert len(events) == 3
+        kind, result = events[2]
+        assert kind == "result"
+        assert result.exit_code == 0
+        assert result.data == {"volume": 25}
+
+    def test_errors_streamed(self):
+        events = list(stream_command(SoCo("192.168.0.1"), "volume", "1", "2", "3"))
+        assert events[0][0] == "error"
+        assert events[-1][0] == "result"
+        assert events[-1][1].exit_code == 1
+
+
+class HttpMacros(unittest.TestCase):
+    def test_macro_runs_in_process(self):
+        calls = []
+
+        def fake_process_action(speaker, action, args, *rest, **kwargs):
+            calls.append((speaker.ip_address, action, args))
+            print(action)
+            return True
+
+        macros = {"m": "192.168.0.1 volume %1 : 192.168.0.2 mute"}
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.dict(http_api.MACROS, macros), mock.patch(
+                "soco_cli.api.process_action", fake_process_action
+            ), capture_output(StringIO(), StringIO()):
+                command, result = loop.run_until_complete(
+                    http_api._process_macro("m", "25")
+                )
+        finally:
+            loop.close()
+        assert command == "sonos 192.168.0.1 volume 25 : 192.168.0.2 mute"
+        assert result == "volume\nmute"
+        assert calls == [
+            ("192.168.0.1", "volume", ("25",)),
+            ("192.168.0.2", "mute", ()),
+        ]
+
+    def test_macro_waits_dont_occupy_workers(self):
+        macros = {
+            "slow": "wait 0.5s : par [ 192.168.0.1 volume ] [ 192.168.0.2 volume ]",
+            "fast": "192.168.0.1 volume",
+        }
+
+        async def run():
+            waits = [
+                asyncio.ensure_future(http_api.run_macro("slow")) for _ in range(4)
+            ]
+            await asyncio.sleep(0.1)
+            start = time.time()
+            fast = await http_api.run_macro("fast")
+            elapsed = time.time() - start
+            return fast, elapsed, await asyncio.gather(*waits)
+
+        loop = asyncio.new_event_loop()
+        max_workers = aio.AIO_MAX_WORKERS
+        aio.set_max_workers(1)
+        try:
+            with mock.patch.dict(http_api.MACROS, macros), mock.patch(
+                "soco_cli.api.process_action",
+                lambda *a, **k: ActionResult(25, lambda data: print(data)),
+            ), capture_output(StringIO(), StringIO()):
+                fast, elapsed, slow = loop.run_until_complete(run())
+        finally:
+            aio.set_max_workers(max_workers)
+            loop.close()
+        assert fast["result"] == "25"
+        assert elapsed < 0.4
+        # Parallel branches are labelled, in branch order
+        assert slow[0]["result"] == "[1] 25\n[2] 25"
+
+
+class HttpBatch(unittest.TestCase):
+    def test_batch(self):
+        def fake_run_command(speaker, action, *args, **kwargs):
+            if action == "bad":
+                return 1, "", "Error: bad"
+            return 0, " ".join(args), ""
+
+        request = http_api.BatchRequest(
+            commands=[
+                ["192.168.0.1", "volume", "25"],
+                ["192.168.0.2", "bad"],
+                ["192.168.0.1", "volume", "30"],
+            ]
+        )
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch("soco_cli.api.run_command", fake_run_command), mock.patch(
+                "soco_cli.api._coordinator_key", lambda s: s.ip_address
+            ), capture_output(StringIO(), StringIO()):
+                response = loop.run_until_complete(http_api.batch(request))
+        finally:
+            loop.close()
+        assert [r["result"] for r in response["results"]] == ["25", "", "30"]
+        assert response["results"][1]["error_msg"] == "Error: bad"
+        assert response["failed"] == 1
+        assert all(isinstance(r["duration"], float) for r in response["results"])
+
+
+class ResultCaching(unittest.TestCase):
+    def test_results_forgotten_on_events(self):
+        cache = ResultCache()
+        queues = {}
+
+        def subscribe(service, auto_renew=False, event_queue=None):
+            queues[service.service_type] = event_queue
+            return mock.Mock()
+
+        speaker = SoCo("192.168.0.1")
+        result = CachedResult("Kitchen", 0, "25", 25, "", time.monotonic())
+        with mock.patch.object(Service, "subscribe", subscribe):
+            dependencies = cache.watch(speaker, "volume")
+        assert cache.cacheable("volume", []) and not cache.cacheable("volume", [1])
+        # The playback position in 'track' output changes without events
+        assert not cache.cacheable("track", [])
+        assert cache.is_write("volume", ["30"]) and not cache.is_write("volume", [])
+
+        cache.store("kitchen", "volume", result, dependencies, cache.generation)
+        assert cache.get("Kitchen", "volume") == result
+
+        # The initial event is ignored; later events forget the result
+        queues["RenderingControl"].put(mock.Mock(seq="0"))
+        assert cache.get("Kitchen", "volume") == result
+        generation = cache.generation
+        queues["RenderingControl"].put(mock.Mock(seq="1"))
+        assert cache.get("Kitchen", "volume") is None
+
+        # Results read before an invalidation aren't stored
+        cache.store("Kitchen", "volume", result, dependencies, generation)
+        assert cache.get("Kitchen", "volume") is None
+        assert cache.subscription_count() == 1
+
+
+class PrometheusMetrics(unittest.TestCase):
+    def test_registry_rendering(self):
+        registry = metrics.Registry()
+        requests_total = registry.counter(
+            "requests_total", "Requests", ["speaker", "action"]
+        )
+        duration = registry.histogram("duration_seconds", "Durations", [], [0.1, 1])
+        registry.gauge("clients", "Clients", function=lambda: {(): 3})
+        requests_total.inc("Kitchen", "volume")
+        requests_total.inc('Dining "Room"', "play", amount=2)
+        duration.observe(0.05)
+        duration.observe(0.5)
+        duration.observe(5)
+        lines = registry.render().splitlines()
+
+        assert "# TYPE requests_total counter" in lines
+        assert 'requests_total{speaker="Kitchen",action="volume"} 1' in lines
+        assert 'requests_total{speaker="Dining \\"Room\\"",action="play"} 2' in lines
+        assert 'duration_seconds_bucket{le="0.1"} 1' in lines
+        assert 'duration_seconds_bucket{le="1"} 2' in lines
+        assert 'duration_seconds_bucket{le="+Inf"} 3' in lines
+        assert "duration_seconds_count 3" in lines
+        assert "clients 3" in lines
+        with self.assertRaises(ValueError):
+            requests_total.inc("Kitchen")
+
+    def test_soap_requests_counted(self):
+        service = SoCo("192.168.0.9").renderingControl
+        labels = ("192.168.0.9", "RenderingControl", "GetVolume")
+        before = metrics.SOAP_REQUESTS.value(*labels)
+        send_command = mock.Mock(return_value={})
+        limiter.send_limited(send_command, service, "GetVolume", [("InstanceID", 0)])
+        assert metrics.SOAP_REQUESTS.value(*labels) == before + 1
+        assert metrics.SOAP_ERRORS.value(*labels) == 0
+
+    def test_unknown_command_labels(self):
+        with mock.patch("soco_cli.http_api.load_speaker_sets", lambda: {"up": []}):
+            assert http_api._command_labels("Kitchen", "VOLUME") == (
+                "Kitchen",
+                "volume",
+            )
+            assert http_api._command_labels(None, "no_such_action") == (
+                "unknown",
+                "unknown",
+            )
+            assert http_api._command_labels("@Up", "play")[0] == "@up"
+            assert http_api._command_labels("@down", "play")[0] == "unknown"
+
+
+class SharedEventSubscriptions(unittest.TestCase):
+    def test_clients_share_subscriptions(self):
+        hub = EventHub()
+        queues = {}
+        subscriptions = []
+
+        def subscribe(service, auto_renew=False, event_queue=None):
+            queues[(service.soco.ip_address, service.service_type)] = event_queue
+            subscriptions.append(mock.Mock())
+            return subscriptions[-1]
+
+        kitchen = SoCo("192.168.0.1")
+        study = SoCo("192.168.0.2")
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.object(Service, "subscribe", subscribe), mock.patch.object(
+                SoCo, "player_name", new_callable=mock.PropertyMock
+            ) as player_name:
+                player_name.return_value = "Speaker"
+                both = hub.add_client([kitchen, study], ["rendering"], loop)
+                kitchen_only = hub.add_client([kitchen], ["rendering"], loop)
+            assert hub.subscription_count() == 2 and len(subscriptions) == 2
+
+            queues[("192.168.0.2", "RenderingControl")].put(
+                mock.Mock(seq="1", variables={"volume": {"Master": "25"}})
+            )
+            loop.run_until_complete(asyncio.sleep(0))
+            message = both.queue.get_nowait()
+            assert message["ip_address"] == "192.168.0.2"
+            assert message["variables"] == {"volume": {"Master": "25"}}
+            assert kitchen_only.queue.empty()
+
+            hub.remove_client(both)
+            assert hub.subscription_count() == 1
+            hub.remove_client(kitchen_only)
+            assert hub.subscription_count() == 0
+            assert all(s.unsubscribe.called for s in subscriptions)
+        finally:
+            loop.close()
+
+    def test_one_topology_subscription_per_household(self):
+        hub = EventHub()
+        subscribed = []
+
+        def subscribe(service, auto_renew=False, event_queue=None):
+            subscribed.append(service.soco.ip_address)
+            return mock.Mock()
+
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.object(Service, "subscribe", subscribe), mock.patch.object(
+                SoCo, "player_name", new_callable=mock.PropertyMock
+            ) as player_name, mock.patch.object(
+                SoCo, "household_id", new_callable=mock.PropertyMock
+            ) as household_id:
+                player_name.return_value = "Speaker"
+                household_id.return_value = "Sonos_Test"
+                kitchen = hub.add_client([SoCo("192.168.0.1")], ["topology"], loop)
+                study = hub.add_client([SoCo("192.168.0.2")], ["topology"], loop)
+                assert subscribed == ["192.168.0.1"]
+                assert kitchen.keys == study.keys
+
+                # Once unused, a new client subscribes through its own speaker
+                hub.remove_client(kitchen)
+                hub.remove_client(study)
+                hub.add_client([SoCo("192.168.0.2")], ["topology"], loop)
+                assert subscribed == ["192.168.0.1", "192.168.0.2"]
+        finally:
+            loop.close()
+
+
+class Contexts(unittest.TestCase):
+    def test_contexts_are_isolated(self):
+        contexts = {}
+        for site, ip_address in [("a", "192.168.0.10"), ("b", "192.168.1.10")]:
+            speaker_list = mock.Mock()
+            speaker_list.find.return_value = SoCo(ip_address)
+            contexts[site] = SoCoCLIContext()
+            contexts[site].set_speaker_list(speaker_list)
+
+        for site, ip_address in [("a", "192.168.0.10"), ("b", "192.168.1.10")]:
+            speaker, _ = get_soco_object(
+                "Kitchen", use_local_speaker_list=True, context=contexts[site]
+            )
+            assert speaker.ip_address == ip_address
+        assert local_speaker_list() is None
+
+
+class CircuitBreakers(unittest.TestCase):
+    def test_retries_and_opening(self):
+        breaker = CircuitBreaker(failure_threshold=3, probe_interval=3600)
+        attempts = []
+
+        def unresponsive():
+            attempts.append(1)
+            print("Not printed")
+            raise requests.exceptions.ConnectionError("No response")
+
+        # Output is held back in API mode, so the failed attempt is retried
+        read = ActionPolicy(timeout=1.0, retries=1, retry_delay=0)
+        with api_mode(), self.assertRaises(requests.exceptions.ConnectionError):
+            breaker.call("192.168.0.1", read, unresponsive)
+        assert len(attempts) == 2
+        assert not breaker.is_open("192.168.0.1")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            breaker.call("192.168.0.1", ActionPolicy(), unresponsive)
+        assert breaker.is_open("192.168.0.1")
+        with self.assertRaises(DeviceUnavailableError):
+            breaker.call("192.168.0.1", read, unresponsive)
+        assert len(attempts) == 3
+        assert breaker.call("192.168.0.2", read, lambda: True)
+
+    def test_streamed_output_not_held_back(self):
+        breaker = CircuitBreaker(failure_threshold=10, probe_interval=3600)
+        stream = mock.Mock(streaming=True)
+        attempts = []
+
+        def unresponsive():
+            attempts.append(1)
+            if len(attempts) > 1:
+                print("Printed")
+                # Delivered straight away, not when the attempt completes
+                stream.write.assert_any_call("Printed")
+            raise requests.exceptions.ConnectionError("No response")
+
+        # An attempt that has printed output isn't retried
+        read = ActionPolicy(timeout=1.0, retries=3, retry_delay=0)
+        with capture_output(stream, stream), self.assertRaises(
+            requests.exceptions.ConnectionError
+        ):
+            breaker.call("192.168.0.1", read, unresponsive)
+        assert len(attempts) == 2
+
+    def test_read_timeouts_are_not_failures(self):
+        breaker = CircuitBreaker(failure_threshold=1, probe_interval=3600)
+        attempts = []
+
+        def slow():
+            attempts.append(1)
+            raise requests.exceptions.ReadTimeout("Slow response")
+
+        read = ActionPolicy(retries=1, retry_delay=0)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            breaker.call("192.168.0.1", read, slow)
+        assert len(attempts) == 1
+        assert not breaker.is_open("192.168.0.1")
+
+        def unreachable():
+            raise requests.exceptions.ConnectTimeout("No connection")
+
+        with self.assertRaises(requests.exceptions.ConnectTimeout):
+            breaker.call("192.168.0.1", read, unreachable)
+        assert breaker.is_open("192.168.0.1")
+
+    def test_output_not_held_back_if_errors_exit(self):
+        breaker = CircuitBreaker(failure_threshold=10, probe_interval=3600)
+        output = StringIO()
+
+        def action():
+            print("Error: reported")
+            # An error report would exit here, so the output must be printed
+            assert output.getvalue() == "Error: reported\n"
+            return True
+
+        read = ActionPolicy(retries=1, retry_delay=0)
+        with capture_output(output, output), mock.patch(
+            "soco_cli.circuit_breaker.errors_exit", return_value=True
+        ):
+            assert breaker.call("192.168.0.1", read, action)
+        assert output.getvalue() == "Error: reported\n"
+
+
+class Limits(unittest.TestCase):
+    def test_in_flight_and_rate(self):
+        limiter = Limiter(max_in_flight=2, rate=50.0, burst=5)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def request():
+            with limiter.slot("192.168.0.1"):
+                with lock:
+                    in_flight.append(1)
+                    peak.append(len(in_flight))
+                time.sleep(0.01)
+                with lock:
+                    in_flight.pop()
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=request) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert max(peak) <= 2
+        # Five requests are paced, at 50 per second
+        assert time.monotonic() - start >= 0.09
+
+    def test_alarm_updates_paced_per_household(self):
+        updates = []
+
+        def update(speaker):
+            with alarms._alarm_update(speaker):
+                start = time.monotonic()
+                time.sleep(0.02)
+                updates.append((start, time.monotonic()))
+
+        with mock.patch.object(
+            SoCo, "household_id", new_callable=mock.PropertyMock
+        ) as household_id, mock.patch.dict(
+            limiter._limiters,
+            {limiter.ALARMS: Limiter(max_in_flight=1, rate=20.0, burst=1)},
+        ):
+            household_id.return_value = "Sonos_Test"
+            threads = [
+                threading.Thread(target=update, args=(SoCo(ip),))
+                for ip in ["192.168.0.1", "192.168.0.2"]
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Updates in the same household are made one at a time, and paced
+        updates.sort()
+        assert updates[1][0] >= updates[0][1]
+        assert updates[1][0] - updates[0][0] >= 0.045
+
+
+class WriteElision(unittest.TestCase):
+    def test_known_value_is_not_written(self):
+        speaker = SoCo("192.168.0.50")
+        state_cache().record(speaker.ip_address, "volume", 25)
+        state_cache().record(speaker.ip_address, "mute", False)
+        context = SoCoCLIContext(elide_writes=True)
+        for action, value in [("volume", "25"), ("mute", "off")]:
+            result = run_command_structured(speaker, action, value, context=context)
+            assert result.exit_code == 0
+            assert result.data == {"elided": True}
+            assert result.output == ""
+        state_cache().invalidate(speaker.ip_address)
+
+    def test_only_event_attributes_trusted_while_watched(self):
+        cache = StateCache(max_age=0)
+        cache._subscriptions["192.168.0.50"] = mock.Mock()
+        cache.record("192.168.0.50", "volume", 25)
+        cache.record("192.168.0.50", "status_light", True)
+        time.sleep(0.01)
+        # Events don't report the status light, so it can't be trusted
+        assert cache.get("192.168.0.50", "volume") == (True, 25)
+        assert cache.get("192.168.0.50", "status_light") == (False, None)
+        assert actions["cross_fade"].switch_to_coordinator
+
+
+class SpeakerSets(unittest.TestCase):
+    def test_speaker_sets(self):
+        speaker_sets = parse_speaker_sets([
+            "# Sets\n",
+            "downstairs = Kitchen, Lounge  # Trailing comment\n",
+            "\n",
+            "@Everywhere = @downstairs, Study, kitchen\n",
+            "loop = @loop\n",
+        ])
+        assert speaker_set_members("@everywhere", speaker_sets) == [
+            "Kitchen",
+            "Lounge",
+            "Study",
+        ]
+        for set_name in ["@loop", "@upstairs"]:
+            with self.assertRaises(ValueError):
+                speaker_set_members(set_name, speaker_sets)
+        with self.assertRaises(ValueError):
+            parse_speaker_sets(["downstairs Kitchen\n"])
+
+    def test_speaker_sets_in_shell_jobs(self):
+        calls = []
+
+        def fake_run_command(speaker, action, *args, **kwargs):
+            calls.append((speaker, action, args))
+            return 0, "", ""
+
+        sets = {"downstairs": ["Kitchen", "Lounge"]}
+        with mock.patch(
+            "soco_cli.interactive.speaker_set_members",
+            lambda name: speaker_set_members(name, sets),
+        ), mock.patch("soco_cli.interactive.run_command", fake_run_command):
+            with capture_output(StringIO(), StringIO()):
+                assert interactive._get_speaker_set("@upstairs") is None
+            speaker = interactive._get_speaker_set("@downstairs")
+            interactive._run_job(speaker, "volume", ["20"], False)
+        assert interactive._speaker_label(speaker) == "@downstairs"
+        assert calls == [("@downstairs", "volume", ("20",))]
+
+
+class ReadMemoisation(unittest.TestCase):
+    def test_reads_are_memoised_until_a_write(self):
+        requests_sent = []
+
+        def send_command(service, action, args=None, cache=None, **kwargs):
+            requests_sent.append(action)
+            return {"CurrentVolume": "25"}
+
+        service = mock.Mock(service_type="RenderingControl")
+        service.soco.ip_address = "192.168.0.1"
+        memoised = partial(read_cache.send_memoised, send_command)
+        with read_cache.read_scope("test"):
+            for action in ["GetVolume", "GetVolume", "SetVolume", "GetVolume"]:
+                memoised(service, action, [("InstanceID", 0)])
+        memoised(service, "GetVolume", [("InstanceID", 0)])
+        assert requests_sent == ["GetVolume", "SetVolume", "GetVolume", "GetVolume"]
+
+        # Reads that differ in their keyword arguments are sent separately
+        requests_sent.clear()
+        with read_cache.read_scope("test"):
+            memoised(service, "GetVolume", [("InstanceID", 0)], timeout=1)
+            memoised(service, "GetVolume", [("InstanceID", 0)], timeout=2)
+            memoised(service, "GetVolume", [("InstanceID", 0)], timeout=1)
+        assert requests_sent == ["GetVolume", "GetVolume"]
+
+
+class SoapRequests(unittest.TestCase):
+    def test_handling_applies_only_within_actions(self):
+        service = SoCo("192.168.0.1").renderingControl
+        with mock.patch.object(
+            soap_requests, "_soco_send_command", return_value={"Direct": "1"}
+        ), mock.patch.object(
+            soap_requests, "_send_layered", return_value={"Layered": "1"}
+        ):
+            with soap_requests.request_scope():
+                assert service.send_command("GetVolume") == {"Layered": "1"}
+            assert service.send_command("GetVolume") == {"Direct": "1"}
+        assert soap_requests.LAYERS[-1] is limiter.send_limited
+
+
+class RunCommands(unittest.TestCase):
+    def test_order_within_groups(self):
+        speakers = [SoCo("192.168.0.{}".format(i)) for i in range(1, 5)]
+        groups = {s.ip_address: "group{}".format(i % 2) for i, s in enumerate(speakers)}
+        calls = []
+
+        def fake_run_command(speaker, action, *args, **kwargs):
+            time.sleep(0.001)
+            calls.append((groups[speaker.ip_address], int(args[0])))
+            return 0, args[0], ""
+
+        commands = [(speakers[i % 4], "volume", str(i)) for i in range(20)]
+        with mock.patch(
+            "soco_cli.api._coordinator_key", lambda s: groups[s.ip_address]
+        ), mock.patch("soco_cli.api.run_command", fake_run_command):
+            results = run_commands(commands, max_parallel=4)
+
+        assert [r[1] for r in results] == [str(i) for i in range(20)]
+        assert all(isinstance(r[3], float) for r in results)
+        for group in ["group0", "group1"]:
+            order = [i for g, i in calls if g == group]
+            assert order == sorted(order)
+
+
+class Fleet(unittest.TestCase):
+    def test_shards_and_result_order(self):
+        shards = []
+
+        class Pool:
+            def imap_unordered(self, function, items):
+                return [function(item) for item in reversed(items)]
+
+        def fake_run_commands(commands, **kwargs):
+            shards.append([command[0] for command in commands])
+            return [(0, command[0], "", 0.0) for command in commands]
+
+        ips = ["10.0.{}.{}".format(i % 2, i) for i in range(6)]
+        runner = FleetRunner(processes=2)
+        with mock.patch.object(runner, "_get_pool", lambda _: Pool()), mock.patch(
+            "soco_cli.fleet.run_commands", fake_run_commands
+        ):
+            results = runner.run([(SoCo(ip), "volume") for ip in ips])
+        assert [r[1] for r in results] == ips
+        assert sorted(shards) == [ips[0::2], ips[1::2]]
+
+    def test_worker_settings(self):
+        context = SoCoCLIContext(min_netmask=16, elide_writes=True)
+        with mock.patch("soco_cli.fleet._worker_context"):
+            fleet._init_worker(fleet._worker_settings(context))
+            assert fleet._worker_context.elide_writes
+            assert fleet._worker_context.min_netmask == 16
+            assert fleet._worker_context.api
+
+
+class AsyncRunCommand(unittest.TestCase):
+    def test_run_command(self):
+        speaker = SoCo("192.168.0.1")
+
+        async def run():
+            return await asyncio.gather(
+                aio.run_command(speaker, "volume", "1", "2", "3"),
+                aio.run_command(speaker, "wait_stop", "1"),
+                aio.run_command(speaker, "wait_for", "0s"),
+            )
+
+        loop = asyncio.new_event_loop()
+        try:
+            volume, wait_stop, wait_for = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        assert volume[0] == 1 and volume[2].startswith("Error: Action 'volume'")
+        assert wait_stop == (1, "", "Error: Action 'wait_stop' takes no parameter(s)")
+        assert wait_for == (0, "", "")
+
+    def test_http_waits_dont_occupy_workers(self):
+        speaker = SoCo("192.168.0.1")
+        action_result = ActionResult(25, lambda data: print(data))
+
+        async def run():
+            waits = [
+                asyncio.ensure_future(
+                    http_api.command_core("192.168.0.1", "wait_for", "0.5s")
+                )
+                for _ in range(4)
+            ]
+            await asyncio.sleep(0.1)
+            start = time.time()
+            volume = await http_api.command_core("192.168.0.1", "volume")
+            elapsed = time.time() - start
+            await asyncio.gather(*waits)
+            return volume, elapsed
+
+        loop = asyncio.new_event_loop()
+        max_workers = aio.AIO_MAX_WORKERS
+        aio.set_max_workers(1)
+        try:
+            with mock.patch(
+                "soco_cli.api.process_action", lambda *a, **k: action_result
+            ), mock.patch(
+                "soco_cli.api.get_soco_object", lambda *a, **k: (speaker, "")
+            ), mock.patch.object(
+                SoCo, "player_name", new_callable=mock.PropertyMock
+            ) as player_name, capture_output(
+                StringIO(), StringIO()
+            ):
+                player_name.return_value = "Kitchen"
+                volume, elapsed = loop.run_until_complete(run())
+        finally:
+            aio.set_max_workers(max_workers)
+            loop.close()
+        assert volume["data"] == 25
+        assert elapsed < 0.4
+
+
+class ParseScript(unittest.TestCase):
+    def test_comments_and_continuations(self):
+        lines = [
+            "# A comment\n",
+            "\n",
+            'Kitchen play_fav "Radio 4"  # Trailing comment\n',
+            "Kitchen volume 25 : \\\n",
+            "    Lounge volume 20\n",
+        ]
+        assert parse_script(lines) == [
+            (3, ["Kitchen", "play_fav", "Radio 4"]),
+            (4, ["Kitchen", "volume", "25", ":", "Lounge", "volume", "20"]),
+        ]
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            parse_script(['Kitchen play_fav "Radio 4\n'])
+        with self.assertRaises(ValueError):
+            parse_script(["Kitchen volume 25 \\\n"])
+
+
+class ShellJobs(unittest.TestCase):
+    def test_job_states_and_cancellation(self):
+        manager = JobManager()
+        slept = []
+
+        def sleeper():
+            slept.append(interruptible_sleep(60))
+
+        job = manager.start_job("Kitchen wait_for 60s", sleeper)
+        assert job.job_id == 1
+        assert job.status == "Running"
+        assert manager.get_job() is job
+        assert manager.get_job(1) is job
+        assert manager.get_job(2) is None
+        output = StringIO()
+        with capture_output(output, StringIO()):
+            manager.print_jobs()
+        assert "[1] Running" in output.getvalue()
+        assert "Kitchen wait_for 60s" in output.getvalue()
+
+        # Cancelling ends the job's sleep
+        with mock.patch.object(interactive, "jobs", manager), capture_output(
+            output, StringIO()
+        ):
+            interactive._job_control(["cancel", "%1"])
+        assert job.wait(timeout=5)
+        assert slept == [False]
+        assert job.status == "Cancelled"
+        assert job.elapsed < 60
+        assert manager.running_jobs() == []
+
+    def test_foreground_and_finished_jobs(self):
+        manager = JobManager()
+        foreground_events = []
+
+        def short_job():
+            time.sleep(0.1)
+            foreground_events.append(utils.foreground_cancel_event)
+
+        def failing_job():
+            raise ValueError("Failed")
+
+        job = manager.start_job("Kitchen volume", short_job)
+        failed = manager.start_job("Lounge volume", failing_job)
+        manager.foreground(job)
+        assert job.status == "Done"
+        # CTRL-C cancels the foreground job while it's running
+        assert foreground_events == [job.cancel_event]
+        assert utils.foreground_cancel_event is None
+        assert failed.wait(timeout=5)
+        assert failed.status == "Failed (Failed)"
+
+        output = StringIO()
+        with capture_output(output, StringIO()):
+            manager.report_finished_jobs()
+            manager.print_jobs()
+        assert output.getvalue().splitlines() == [
+            "[1] Done: Kitchen volume",
+            "[2] Failed (Failed): Lounge volume",
+            "No jobs",
+        ]
+
+    def test_job_output_goes_to_its_own_stream(self):
+        shell_output = StringIO()
+        job_output = StringIO()
+
+        def fake_run_command(speaker, action, *args, **kwargs):
+            return 0, "25", ""
+
+        manager = JobManager()
+        with mock.patch.object(interactive, "jobs", manager), mock.patch(
+            "soco_cli.interactive.run_command", fake_run_command
+        ), capture_output(shell_output, StringIO()):
+            # Jobs write to the default stream, not to the shell's capture
+            with mock.patch.object(sys.stdout, "_default", job_output):
+                interactive._start_job("@downstairs", "volume", [], False)
+                assert manager.get_job(1).wait(timeout=5)
+        assert shell_output.getvalue() == "[1] Started: @downstairs volume\n"
+        assert job_output.getvalue() == "25\n"
+
+
+class KeyedExecutorOrdering(unittest.TestCase):
+    def test_tasks_with_same_key_run_in_order(self):
+        results = {"a": [], "b": []}
+
+        def task(key, i):
+            time.sleep(0.001)
+            results[key].append(i)
+            return i
+
+        with KeyedExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(key, task, key, i)
+                for i in range(20)
+                for key in ["a", "b"]
+            ]
+        assert results["a"] == list(range(20))
+        assert results["b"] == list(range(20))
+        assert [f.result() for f in futures[::2]] == list(range(20))
+
+
+class AllSpeakersFanOut(unittest.TestCase):
+    def test_results_in_name_order(self):
+        names = ["Study", "kitchen", "Lounge", "Bedroom"]
+        speakers = [mock.Mock(player_name=name, ip_address=name) for name in names]
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def fake_run_command(speaker, action, *args, **kwargs):
+            with lock:
+                in_flight.append(speaker)
+                peak.append(len(in_flight))
+            # Complete in the reverse of the order started
+            time.sleep(0.05 * (len(names) - names.index(speaker.player_name)))
+            with lock:
+                in_flight.remove(speaker)
+            if speaker.player_name == "Lounge":
+                return 1, "", "Error: Lounge failed"
+            if speaker.player_name == "Study":
+                return 0, "", ""
+            return 0, "25", ""
+
+        plan = Plan()
+        plan.steps.append(
+            ActionStep("_all_", None, "volume", [], None, all_speakers=speakers)
+        )
+        # Output and errors are combined, as in a terminal
+        output = StringIO()
+        with mock.patch(
+            "soco_cli.sequence_processor.run_command", fake_run_command
+        ), capture_output(output, output):
+            exit_code = execute_plan(plan, Planner(), max_parallel=2)
+        assert exit_code == 1
+        assert max(peak) == 2
+        assert output.getvalue().splitlines() == [
+            "Bedroom: 25",
+            "kitchen: 25",
+            "Lounge: Error: Lounge failed",
+            "Study: OK",
+        ]
+
+    def test_max_parallel_must_be_positive(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from soco_cli.sonos import main; main()",
+                "--max-parallel",
+                "0",
+                "Kitchen",
+                "volume",
+            ],
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        assert result.returncode == 1
+        assert "'--max-parallel' must be at least 1" in result.stderr
+
+
+class ParallelBlocks(unittest.TestCase):
+    def parse(self, command_line):
+        cli_parser = CLIParser()
+        cli_parser.parse(command_line.split())
+        return cli_parser.get_sequences()
+
+    def test_parallel_blocks(self):
+        block = ParallelSequences([[["A", "x"], ["B", "y"]], [["C", "z"]]])
+        assert self.parse("par [ A x : B y ] [ C z ] : D w") == [block, ["D", "w"]]
+        assert self.parse("{ A x : B y } & { C z }") == [block]
+        assert self.parse("D w : par x") == [["D", "w"], ["par", "x"]]
+
+    def test_malformed_blocks(self):
+        for command_line in ["{ A x", "{ A x } B y", "{ A x } &", "par [ A x"]:
+            with self.assertRaises(ValueError):
+                self.parse(command_line)
+
+
+class PlanSequences(unittest.TestCase):
+    def test_plan(self):
+        planner = Planner()
+        plan = planner.plan([
+            ["192.168.0.1", "volume", "25"],
+            ["wait", "10s"],
+            ["192.168.0.1", "if_stopped", "vol", "30"],
+            ["loop", "3"],
+        ])
+        assert plan.errors == []
+        assert isinstance(plan.steps[0], ActionStep)
+        assert isinstance(plan.steps[1], WaitStep)
+        assert isinstance(plan.steps[3], LoopStep)
+        assert plan.steps[3].parameter == 3
+        # The speaker is only resolved once
+        assert plan.steps[0].speaker is plan.steps[2].speaker
+
+    def test_plan_errors(self):
+        plan = Planner().plan([
+            ["192.168.0.1", "volume", "25", "30"],
+            ["192.168.0.1", "if_playing", "stop", "now"],
+            ["192.168.0.1", "no_such_action"],
+            ["loop", "0"],
+            ["loop_for", "x"],
+            ["loop_until", "25:00"],
+        ])
+        assert plan.errors == [
+            "Action 'volume' takes 0 or 1 parameter(s)",
+            "Action 'stop' takes no parameter(s)",
+            "Action 'no_such_action' not recognised",
+            "Action 'loop' takes no parameters, or a number of iterations (> 0)",
+            "Action 'loop_for' requires one parameter (duration >= 0)",
+            "Action 'loop_until' requires one parameter (stop time)",
+        ]
+
+
+class Schedules(unittest.TestCase):
+    def test_cron_next_after(self):
+        start = datetime.datetime(2024, 3, 1, 7, 30)  # A Friday
+        weekdays = CronSchedule("30 7 * * mon-fri")
+        assert weekdays.next_after(start) == datetime.datetime(2024, 3, 4, 7, 30)
+        quarter_hours = CronSchedule("*/15 * * * *")
+        assert quarter_hours.next_after(start) == datetime.datetime(2024, 3, 1, 7, 45)
+        leap_day = CronSchedule("0 12 29 2 *")
+        assert leap_day.next_after(start) == datetime.datetime(2028, 2, 29, 12, 0)
+        assert CronSchedule("@daily").next_after(start) == datetime.datetime(
+            2024, 3, 2, 0, 0
+        )
+        with self.assertRaises(ValueError):
+            CronSchedule("0 12 30 2 *").next_after(start)
+        with self.assertRaises(ValueError):
+            CronSchedule("60 * * * *")
+
+    def test_parse_schedule(self):
+        entries, settings = parse_schedule([
+            "set missed_runs run\n",
+            "every 15m Kitchen volume 25\n",
+            "0 8 * * * Kitchen play : Study play\n",
+        ])
+        assert settings["missed_runs"] == "run"
+        assert entries[0].interval == 15 * 60
+        assert entries[1].sequences == [["Kitchen", "play"], ["Study", "play"]]
+        with self.assertRaises(ValueError):
+            parse_schedule(["every 15m\n"])
+
+    def _simulate_missed_runs(self, missed_runs):
+        # A 10s interval entry started at 5s (so due at 15s, 25s, ...), with
+        # the computer asleep from 5s to 35s
+        entries, _ = parse_schedule(["every 10s Kitchen volume 25\n"])
+        clock = [0.0]
+        fired = []
+
+        def sleep(duration):
+            clock[0] = 35.0 if clock[0] == 5.0 else clock[0] + duration
+
+        fake_time = mock.Mock()
+        fake_time.monotonic = lambda: clock[0]
+        fake_time.time = lambda: clock[0] + 1000.0
+        scheduler = Scheduler(entries, missed_runs=missed_runs, grace=1.0)
+        with mock.patch("soco_cli.scheduler.time", fake_time), mock.patch(
+            "soco_cli.scheduler.interruptible_sleep", sleep
+        ), mock.patch(
+            "soco_cli.scheduler.cancelled", lambda: clock[0] > 60
+        ), mock.patch.object(
+            Scheduler, "_fire", lambda _, e: fired.append(clock[0])
+        ):
+            clock[0] = 5.0
+            scheduler.run()
+        return fired
+
+    def test_missed_runs(self):
+        # The missed run happens once, late, then runs keep their alignment
+        assert self._simulate_missed_runs("run") == [35.0, 45.0, 55.0]
+        assert self._simulate_missed_runs("skip") == [45.0, 55.0]
+
+
 if __name__ == "__main__":
     unittest.main()